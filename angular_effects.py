@@ -18,10 +18,40 @@ from scipy.optimize import curve_fit
 import pandas as pd
 import argparse
 
+import angular_response
+import profiling
+
+def on_axis_amplitudes(table, model):
+    """
+    Function to get the on axis (angle 0) amplitude of every line, to scale the off-axis model by
+    Inputs: results dataframe (energy, angle, amp), AngularModel
+    Output: series of energy -> amplitude at angle 0. Lines measured on axis use the measurement, the others the scale
+            that best fits the model to their off-axis points (the model is 1 at angle 0). Lines with nothing to go on
+            are left out with a warning
+    """
+    table = table.dropna(subset=["amp"])
+    on_axis = table[table["angle"] == 0].groupby("energy")["amp"].mean()
+    for energy, rows in table[~table["energy"].isin(on_axis.index)].groupby("energy"):
+        response = model(energy, rows["angle"].to_numpy())
+        if np.sum(response**2) <= 0:
+            print(f"{energy} keV: no angle 0 measurement and the model gives no response, left out of the plot")
+            continue
+        print(f"{energy} keV: no angle 0 measurement, on axis amplitude taken from the off-axis model")
+        on_axis[energy] = np.sum(rows["amp"].to_numpy() * response) / np.sum(response**2)
+
+    return on_axis.sort_index()
+
 def plot_amplitudes(table, detector):
     """Function to plot peak amplitudes by angle, with a fit line"""
 
-    #INCLUDE RIGHT HERE THE FITTING 
+    #off-axis model (angular_response.py) fitted to every line measured on axis, drawn at each line's energy
+    try:
+        model = angular_response.fit_models({detector: table})[detector]
+        on_axis = on_axis_amplitudes(table, model)
+    except ValueError as error:
+        print(f"{error}, plotting the data without fit lines")
+        on_axis = pd.Series(dtype=float)
+    fit_angles = np.linspace(0, table["angle"].max(), 200)
 
     plt.close("all")
     fig, ax = plt.subplots(figsize = (10, 8))
@@ -31,9 +61,12 @@ def plot_amplitudes(table, detector):
     ax.set_ylabel("Peak Amplitude (counts/sec)")
 
     ax.scatter(table["angle"], table["amp"], label = "data")
+    for energy, amp in on_axis.items():
+        ax.plot(fit_angles, amp * model(energy, fit_angles), label = f"fit {energy:.1f} keV")
 
     ax.legend()
-    plt.show()
+    with profiling.stage("plt.show"):
+        plt.show()
 
 def main(csv, detector):
     """Main function to run what the script does"""
@@ -47,6 +80,11 @@ if __name__ == '__main__':
     to characterize a detector based on given data files''')
     parser.add_argument('csv', type = str, help = "path to csv", default = None)
     parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.profile:
+        profiling.enable()
     main(args.csv, args.detector)
+    if args.profile:
+        profiling.finish(args.profile, args.profile_format)
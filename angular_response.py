@@ -0,0 +1,214 @@
+"""
+angular_response.py
+
+Off-axis response of the detectors: how the peak amplitude of a line changes with the angle of the source.
+
+The response relative to the source on axis (angle 0) is modelled as a short cosine series whose coefficients change
+with log energy:
+    r(E, angle) = 1 + sum_k (c_k + d_k ln(E / E_ref)) (cos(k angle) - 1),   k = 1..harmonics
+so r(E, 0) = 1. The model is linear in c and d, so the fits of every detector are done together: the normal equations
+of all the detectors are stacked into one (detectors x params x params) array and solved in one np.linalg.solve call
+(with a little ridge regularisation, so a detector measured at a single energy just gets d = 0).
+
+From a fitted model (and, optionally, the efficiency curve from efficiency_model.py) an energy x angle grid of the
+response is built and cached in angular_tables/, and any number of (E, angle) points is then an interpolation.
+
+How to use:
+    python angular_response.py BGO=BGOresults_angled.csv NaITi=NaITiresults_angled.csv --model BGO=BGO_efficiency.json
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator
+
+TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "angular_tables")
+TABLE_VERSION = 2
+HARMONICS = 2
+RIDGE = 1e-6
+
+
+def design_matrix(energies, angles_deg, reference_keV, harmonics=HARMONICS):
+    """
+    Function to make the model's design matrix
+    Inputs: energies (keV) and angles (deg) of the points, reference energy (keV), number of cosine terms
+    Output: (points x 2 * harmonics) array, columns c_1..c_k then d_1..d_k
+    """
+    energies = np.asarray(energies, dtype=float)
+    angles = np.deg2rad(np.asarray(angles_deg, dtype=float))
+    cosines = np.cos(np.multiply.outer(angles, np.arange(1, harmonics + 1))) - 1
+    log_energy = np.log(energies / reference_keV)[..., None]
+    return np.concatenate([cosines, cosines * log_energy], axis=-1)
+
+
+def relative_amplitudes(table):
+    """
+    Function to turn spectrum_reader.py results into amplitudes relative to the same line on axis
+    Input: results dataframe with energy, angle and amp
+    Output: dataframe with energy, angle, response (amp / amp at angle 0), for the lines that were measured at angle 0
+    """
+    table = table.dropna(subset=["amp"])
+    on_axis = table[table["angle"] == 0].groupby("energy")["amp"].mean()
+    table = table[table["energy"].isin(on_axis.index)]
+    return pd.DataFrame({"energy": table["energy"].to_numpy(), "angle": table["angle"].to_numpy(),
+                         "response": (table["amp"] / table["energy"].map(on_axis)).to_numpy()})
+
+
+class AngularModel:
+    """
+    Fitted off-axis response of one detector
+        detector: detector name
+        coefficients: c_1..c_k, d_1..d_k
+        reference_keV: E_ref of the log energy term
+        energy_range: lowest and highest energy the model was fitted to
+    """
+
+    def __init__(self, detector, coefficients, reference_keV, energy_range):
+        self.detector = detector
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.reference_keV = float(reference_keV)
+        self.energy_range = tuple(float(energy) for energy in energy_range)
+
+    @property
+    def harmonics(self):
+        return len(self.coefficients) // 2
+
+    def __call__(self, energies, angles_deg):
+        """relative response at the energies (keV) and angles (deg), which broadcast against each other"""
+        energies, angles_deg = np.broadcast_arrays(np.asarray(energies, dtype=float), np.asarray(angles_deg, dtype=float))
+        return 1 + design_matrix(energies, angles_deg, self.reference_keV, self.harmonics) @ self.coefficients
+
+    def to_dict(self):
+        """the model as a json friendly dictionary"""
+        return {"detector": self.detector, "coefficients": self.coefficients.tolist(),
+                "reference_keV": self.reference_keV, "energy_range": list(self.energy_range)}
+
+
+def fit_models(tables, harmonics=HARMONICS, ridge=RIDGE):
+    """
+    Function to fit the off-axis model of every detector in one batched solve
+    Inputs: dictionary of detector -> results dataframe (energy, angle, amp), number of cosine terms, ridge strength
+    Output: dictionary of detector -> AngularModel
+    """
+    detectors = list(tables)
+    n_params = 2 * harmonics
+    normal = np.zeros((len(detectors), n_params, n_params))
+    target = np.zeros((len(detectors), n_params))
+    references, ranges = [], []
+
+    for i, detector in enumerate(detectors):
+        points = relative_amplitudes(tables[detector])
+        if len(points) == 0:
+            raise ValueError(f"no lines measured on axis (angle 0) for {detector}")
+        reference = float(np.exp(np.log(points["energy"]).mean()))
+        design = design_matrix(points["energy"], points["angle"], reference, harmonics)
+        normal[i] = design.T @ design
+        target[i] = design.T @ (points["response"].to_numpy() - 1)
+        references.append(reference)
+        ranges.append((points["energy"].min(), points["energy"].max()))
+
+    #ridge scaled to each detector's normal equations, so unconstrained directions go to 0
+    scale = np.maximum(np.trace(normal, axis1=1, axis2=2) / n_params, 1e-12)
+    normal += ridge * scale[:, None, None] * np.eye(n_params)
+    solutions = np.linalg.solve(normal, target[..., None])[..., 0]
+
+    return {detector: AngularModel(detector, solution, reference, energy_range)
+            for detector, solution, reference, energy_range in zip(detectors, solutions, references, ranges)}
+
+
+class AngularGrid:
+    """
+    Energy x angle grid of a detector's response
+        energies: grid energies (keV), angles_deg: grid angles (deg)
+        values: response on the grid (relative, or efficiency if the grid was built with an efficiency curve)
+    """
+
+    def __init__(self, energies, angles_deg, values):
+        self.energies = np.asarray(energies, dtype=float)
+        self.angles_deg = np.asarray(angles_deg, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self._interpolator = RegularGridInterpolator((np.log(self.energies), self.angles_deg), self.values,
+                                                     bounds_error=False, fill_value=None)
+
+    @classmethod
+    def build(cls, model, efficiency=None, energies=None, angles_deg=None):
+        """
+        Function to evaluate a model on an energy x angle grid
+        Inputs: AngularModel, callable eps(E) to scale by (None for the relative response), grid energies (default 200
+                log spaced over the fitted range) and angles (default every degree 0-180)
+        Output: AngularGrid (NaN at energies the efficiency curve gives NaN for, outside its fitted range)
+        """
+        if energies is None:
+            energies = np.geomspace(*model.energy_range, 200) if model.energy_range[0] < model.energy_range[1] \
+                else np.array([model.energy_range[0] * 0.9, model.energy_range[1] * 1.1])
+        angles_deg = np.arange(0.0, 181.0) if angles_deg is None else np.asarray(angles_deg, dtype=float)
+        values = model(np.asarray(energies)[:, None], angles_deg[None, :])
+        if efficiency is not None:
+            values = values * np.asarray(efficiency(energies))[:, None]
+        return cls(energies, angles_deg, values)
+
+    def save(self, path):
+        """writes the grid to an .npz file"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, energies=self.energies, angles_deg=self.angles_deg, values=self.values)
+
+    @classmethod
+    def load(cls, path):
+        """reads a grid written by save"""
+        with np.load(path) as data:
+            return cls(data["energies"], data["angles_deg"], data["values"])
+
+    def __call__(self, energies, angles_deg):
+        """
+        Function to look up the response at any number of points
+        Inputs: energies (keV) and angles (deg), which broadcast against each other (angles are folded into 0-180)
+        Output: response in the broadcast shape (linear extrapolation outside the grid's energies)
+        """
+        energies, angles_deg = np.broadcast_arrays(np.asarray(energies, dtype=float), np.asarray(angles_deg, dtype=float))
+        folded = np.abs((angles_deg + 180) % 360 - 180)
+        points = np.stack([np.log(energies), folded], axis=-1)
+        return np.reshape(self._interpolator(points), energies.shape)
+
+
+def load_grid(model, efficiency=None, table_dir=TABLE_DIR):
+    """
+    Function to get a detector's response grid from the cache folder, building (and saving) it if it isn't there
+    Inputs: AngularModel, optional EfficiencyModel, folder to cache grids in
+    Output: AngularGrid
+    """
+    key = [TABLE_VERSION, model.to_dict(), efficiency.to_dict() if efficiency is not None else None]
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(table_dir, f"{model.detector}_{digest}.npz")
+    if os.path.exists(path):
+        return AngularGrid.load(path)
+
+    grid = AngularGrid.build(model, efficiency)
+    grid.save(path)
+    return grid
+
+
+def _pairs(values):
+    """turns ["BGO=file.csv", ...] into {"BGO": "file.csv", ...}"""
+    return dict(value.split("=", 1) for value in values or [])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will fit the off-axis response of detectors from their angled results''')
+    parser.add_argument('results', type = str, nargs = "+", help = "detector=csv of angled results from spectrum_reader.py")
+    parser.add_argument('--model', type = str, nargs = "+", help = "detector=efficiency curve json from efficiencies.py", default = None)
+    parser.add_argument('--harmonics', type = int, help = "number of cosine terms in the model", default = HARMONICS)
+    args = parser.parse_args()
+
+    import efficiency_model
+
+    efficiency_paths = _pairs(args.model)
+    models = fit_models({detector: pd.read_csv(csv) for detector, csv in _pairs(args.results).items()}, args.harmonics)
+    for detector, angular_model in models.items():
+        efficiency_curve = efficiency_model.EfficiencyModel.load(efficiency_paths[detector]) if detector in efficiency_paths else None
+        grid = load_grid(angular_model, efficiency_curve)
+        print(f"\n{detector}: coefficients {np.round(angular_model.coefficients, 4).tolist()}")
+        angles = np.arange(0, 181, 15)
+        print(pd.DataFrame({"angle": angles, "response": grid(angular_model.energy_range[0], angles)}).to_string(index=False))
@@ -0,0 +1,300 @@
+"""
+api.py
+
+Library API of the pipeline, for calling it from other code (a service, a notebook, a thread pool) instead of
+running the scripts.
+
+Every function here takes its inputs as arguments and hands its results back as values: nothing is printed, nothing
+is written unless a sink is passed in, and no pyplot state is touched (figures are matplotlib.figure.Figure objects
+made directly, the caller decides whether to save them). Errors are raised instead of printed. The functions don't
+share anything that changes between calls (the compiled profiles, the nuclide library and the geometry tables are
+read only once loaded), so detectors can be run at the same time on a thread pool, numpy and scipy let go of the GIL
+in the heavy parts. The geometry lookup tables (geometry.py) are built in memory unless a table_dir is passed to keep
+them in; detectors with different crystals build theirs side by side. Keep profiling.py switched off when running from threads, its trace isn't thread safe.
+
+Steps (each one works on the output of the last):
+    parse(path)                                       -> (header, counts)
+    subtract(data, background)                        -> table of bins and counts/sec
+    fit(data_path, bg_path, detector)                 -> results dataframe (one row per peak, like spectrum_reader.py)
+    calibrate(results)                                -> Calibration, results with FWHM (keV)
+    resolution(results)                               -> Resolution
+    efficiency(results, detector)                     -> Efficiency (with an EfficiencyModel)
+    angular({detector: angled results})               -> {detector: AngularModel}
+    run_detector(data_path, bg_path, detector)        -> DetectorRun with all of the above
+    run_detectors([(data_path, bg_path, detector)])   -> list of DetectorRun, on a thread pool
+
+Example:
+    import api
+    runs = api.run_detectors([("BGO_detector/unangled/", "BGO_detector/unangled/bgBGO.Spe", "BGO"),
+                              ("NaITi_detector/unangled/", "NaITi_detector/unangled/Bg_NaITi.Spe", "NaITi")])
+    runs[0].results.to_csv(some_file)
+    api.calibration_figure(runs[0]).savefig("BGO_calibration.png")
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from matplotlib.figure import Figure
+
+import angular_response
+import efficiencies
+import efficiency_model
+import profiles
+import resolution as resolution_module
+import spectrum_reader
+
+
+class Calibration:
+    """channel to energy line E = slope * channel + intercept, with the errors of both"""
+
+    def __init__(self, slope, intercept, slope_error, intercept_error):
+        self.slope = float(slope)
+        self.intercept = float(intercept)
+        self.slope_error = float(slope_error)
+        self.intercept_error = float(intercept_error)
+
+    def __call__(self, channels):
+        return spectrum_reader.line(np.asarray(channels, dtype=float), self.slope, self.intercept)
+
+
+class Resolution:
+    """resolution law R^2 = a/E^2 + b/E + c (resolution.py), with the errors of a, b and c"""
+
+    def __init__(self, coefficients, errors):
+        self.coefficients = tuple(float(value) for value in coefficients)
+        self.errors = tuple(float(value) for value in errors)
+
+    def __call__(self, energies):
+        """R^2 at the energies (keV)"""
+        return resolution_module.resolution_eq(np.asarray(energies, dtype=float)**2, *self.coefficients)
+
+
+class Efficiency:
+    """
+    Efficiencies of each line and the fitted curve
+        table: dataframe with energy, count rate, branching ratio, absolute and intrinsic efficiency of each line
+        model: EfficiencyModel (efficiency_model.py)
+        geometric_factors: geometric factor (solid angle / 4 pi) at each of the angles asked for
+    """
+
+    def __init__(self, table, model, geometric_factors):
+        self.table = table
+        self.model = model
+        self.geometric_factors = geometric_factors
+
+
+class DetectorRun:
+    """
+    Everything run_detector works out for one detector
+        detector, results (per peak dataframe with FWHM (keV)), angled, calibration, resolution,
+        efficiency (None for angled runs or if it couldn't be worked out), warnings (list of messages)
+    """
+
+    def __init__(self, detector, results, angled, calibration, resolution, efficiency, warnings):
+        self.detector = detector
+        self.results = results
+        self.angled = angled
+        self.calibration = calibration
+        self.resolution = resolution
+        self.efficiency = efficiency
+        self.warnings = warnings
+
+
+def parse(path):
+    """
+    Function to read one spectrum file (.Spe or .mca, plain, gzipped or in an archive)
+    Input: path
+    Output: header dictionary, counts array
+    """
+    if spectrum_reader.file_type_checker(path) == "error":
+        raise ValueError(f"not a .Spe or .mca spectrum: {path}")
+    header, spectrum = spectrum_reader.file_parser(path)
+    return header, np.asarray(spectrum["counts"])
+
+
+def subtract(data, background):
+    """
+    Function to convert a spectrum to counts/sec and take off the background
+    Inputs: (header, counts) of the spectrum and of the background, from parse
+    Output: dataframe of bins and counts/sec
+    """
+    (data_header, data_counts), (background_header, background_counts) = data, background
+    return spectrum_reader.subtract_counts(data_counts, data_header["MEAS_TIME"], background_counts, background_header["MEAS_TIME"])
+
+
+def fit(data_path, bg_path, detector, budget=None, policy=None, high_rate=None, drift_tolerance=None, log=None):
+    """
+    Function to fit every peak of a detector's spectra (make_results_dict without the printing)
+    Inputs: folder of spectra (or hdf5 store), background file, detector name, optional FitBudget, fit scheduler policy,
+            HighRate settings, gain drift tolerance, function for messages (e.g. a list's append, None to drop them)
+    Output: results dataframe, whether the measurements are angled
+    """
+    if detector not in profiles.available_profiles():
+        raise ValueError(f"no profile for detector {detector!r}, there are: {', '.join(profiles.available_profiles())}")
+    if not os.path.exists(bg_path):
+        raise FileNotFoundError(bg_path)
+
+    return spectrum_reader.make_results_dict(data_path, bg_path, detector, budget=budget, drift_tolerance=drift_tolerance,
+                                             high_rate=high_rate, policy=policy, log=log or (lambda message: None))
+
+
+def calibrate(results):
+    """
+    Function to fit the channel to energy line through the fitted peaks
+    Input: results dataframe from fit
+    Output: Calibration, copy of the results with FWHM (keV) added (worked out the same way as spectrum_reader.py)
+    """
+    if results["peak loc"].notna().sum() < 2:
+        raise ValueError("need at least 2 fitted peaks to calibrate")
+    popt, perr = spectrum_reader.calibrate(results)
+    calibration = Calibration(popt[0], popt[1], perr[0], perr[1])
+    results = results.copy()
+    results["FWHM (keV)"] = calibration(results["FWHM"])
+    return calibration, results
+
+
+def resolution(results):
+    """
+    Function to fit the resolution law to the peaks of calibrated results
+    Input: results dataframe with FWHM (keV), from calibrate
+    Output: Resolution
+    """
+    fitted = results.dropna(subset=["FWHM (keV)"])
+    if len(fitted) < 3:
+        raise ValueError("need at least 3 fitted peaks to fit the resolution law")
+    R2 = (fitted["FWHM (keV)"] / fitted["energy"])**2
+    popt, pcov, x_data, perr = resolution_module.res_curve_fit(fitted["energy"], R2)
+    return Resolution(popt, perr)
+
+
+def efficiency(results, detector, angles_deg=(0.0,), table_dir=None):
+    """
+    Function to work out the absolute and intrinsic efficiency of each line and fit the efficiency curve
+    Inputs: results dataframe from fit, detector name (for the geometry in its profile), angles for the geometric factors,
+            folder to read/save the geometry lookup table in (None to build it in memory only)
+    Output: Efficiency
+    """
+    table = results.dropna(subset=["amp"])
+    if len(table) < 3:
+        raise ValueError("need at least 3 fitted peaks to fit the efficiency curve")
+    computed = efficiencies.compute_efficiencies(table["energy"], table["amp"], efficiencies.line_source_info(table),
+                                                 efficiencies.detector_geometry(detector), angles_deg=list(angles_deg), plot=False,
+                                                 table_dir=table_dir)
+    model = efficiency_model.EfficiencyModel.fit(detector, computed['energies_keV'], computed['intrinsic_efficiency'],
+                                                 table["angle"] if "angle" in table else None)
+    lines = table[["energy"]].assign(**{"count rate": computed['areas_counts_per_s'], "branching": computed['branching'],
+                                        "absolute efficiency": computed['absolute_efficiency'],
+                                        "intrinsic efficiency": computed['intrinsic_efficiency']})
+    return Efficiency(lines.reset_index(drop=True), model, np.asarray(computed['G_angles']))
+
+
+def angular(angled_results, harmonics=angular_response.HARMONICS):
+    """
+    Function to fit the off-axis response of detectors (angular_response.py)
+    Input: dictionary of detector -> angled results dataframe
+    Output: dictionary of detector -> AngularModel
+    """
+    return angular_response.fit_models(angled_results, harmonics)
+
+
+def run_detector(data_path, bg_path, detector, budget=None, policy=None, high_rate=None, results_sink=None, table_dir=None):
+    """
+    Function to run the whole pipeline for one detector: fit, calibrate, resolution and (for unangled runs) efficiency
+    Inputs: folder of spectra, background file, detector name, optional FitBudget, fit scheduler policy, HighRate
+            settings, where to write the results csv (a path or an open file, None to not write it), folder for the
+            geometry lookup tables (None to keep them in memory only)
+    Output: DetectorRun
+    """
+    warnings = []
+    results, angled = fit(data_path, bg_path, detector, budget, policy, high_rate, log=warnings.append)
+    failed = results[results["status"].isin(["failed", "rejected"])]
+    warnings += [f"{row.energy} keV, angle {row.angle}: {row.error}" for row in failed.itertuples()]
+
+    calibration, results = calibrate(results)
+    fit_resolution = resolution(results)
+    fit_efficiency = None
+    if not angled:
+        try:
+            fit_efficiency = efficiency(results, detector, table_dir=table_dir)
+        except (ValueError, np.linalg.LinAlgError) as error:
+            warnings.append(f"efficiency: {error}")
+
+    if results_sink is not None:
+        results.to_csv(results_sink, index=False)
+    return DetectorRun(detector, results, angled, calibration, fit_resolution, fit_efficiency, warnings)
+
+
+def run_detectors(jobs, max_workers=4, **options):
+    """
+    Function to run several detectors at once on a thread pool
+    Inputs: list of (data_path, bg_path, detector), number of threads, anything else is passed to run_detector
+    Output: list of DetectorRun in the order of the jobs (an exception in one job is raised when its result is read)
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_detector, *job, **options) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def calibration_figure(run):
+    """Figure of the fitted peak channels against energy with the calibration line, for a DetectorRun"""
+    figure = Figure(figsize=(8, 8))
+    ax = figure.subplots()
+    fitted = run.results.dropna(subset=["peak loc"])
+    ax.set_title(f"Calibrating {run.detector}: Peak Energy by Channel Number")
+    ax.set_xlabel("Channel Number")
+    ax.set_ylabel("Energy (keV)")
+    ax.scatter(fitted["peak loc"], fitted["energy"], label="data")
+    channels = np.linspace(fitted["peak loc"].min(), fitted["peak loc"].max(), 100)
+    ax.plot(channels, run.calibration(channels), color="red", label="fit line")
+    ax.legend()
+    return figure
+
+
+def resolution_figure(run):
+    """Figure of R^2 against energy with the fitted resolution law, for a DetectorRun"""
+    figure = Figure(figsize=(10, 8))
+    ax = figure.subplots()
+    fitted = run.results.dropna(subset=["FWHM (keV)"])
+    energies = np.linspace(fitted["energy"].min(), fitted["energy"].max(), 300)
+    ax.set_title(f"Plotting resolution by energy for the {run.detector} detector")
+    ax.set_xlabel("E (keV)")
+    ax.set_ylabel("R^2")
+    ax.scatter(fitted["energy"], (fitted["FWHM (keV)"] / fitted["energy"])**2, label="data")
+    ax.plot(energies, run.resolution(energies), color="red", label="fit")
+    ax.legend()
+    return figure
+
+
+def efficiency_figure(run):
+    """Figure of the intrinsic efficiency of each line with the fitted curve and its band, for a DetectorRun"""
+    figure = Figure(figsize=(7, 5))
+    ax = figure.subplots()
+    lines = run.efficiency.table
+    energies = np.geomspace(lines["energy"].min(), lines["energy"].max(), 200)
+    value, low, high = run.efficiency.model.band(energies)
+    ax.scatter(lines["energy"], lines["intrinsic efficiency"], label="data")
+    ax.plot(energies, value, color="red", label="fit")
+    ax.fill_between(energies, low, high, color="red", alpha=0.2)
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel("Energy (keV)")
+    ax.set_ylabel("Intrinsic efficiency")
+    ax.set_title(f"Intrinsic efficiency vs Energy ({run.detector})")
+    ax.legend()
+    return figure
+
+
+def angular_figure(results, model):
+    """Figure of peak amplitudes against angle with the fitted off-axis response, for angled results and an AngularModel"""
+    figure = Figure(figsize=(10, 8))
+    ax = figure.subplots()
+    on_axis = results[results["angle"] == 0].groupby("energy")["amp"].mean()
+    angles = np.linspace(0, results["angle"].max(), 200)
+    ax.set_title(f"Characterizing {model.detector} Detector Off-Axis Response")
+    ax.set_xlabel("Angle (deg)")
+    ax.set_ylabel("Peak Amplitude (counts/sec)")
+    ax.scatter(results["angle"], results["amp"], label="data")
+    for energy, amp in on_axis.items():
+        ax.plot(angles, amp * model(energy, angles), label=f"fit {energy:.1f} keV")
+    ax.legend()
+    return figure
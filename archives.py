@@ -0,0 +1,178 @@
+"""
+archives.py
+
+Reads spectrum files straight out of compressed files and archives, without extracting anything to disk:
+    1. gzip compressed single files: Am_BGO_45.Spe.gz
+    2. members of zip files: session.zip::BGO_detector/Am_angled/Am_BGO_45.Spe
+    3. members of tar files (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz): session.tar.gz::Am_BGO_45.Spe
+
+A member of an archive is named by the archive path and the member name joined with "::". Anything that isn't one
+of the above is read as a plain file, so every reader in the pipeline can just call read_text on whatever it's given.
+
+Tar archives can only be read front to back, so the first read of a member reads every file of the archive in one pass
+and keeps them in memory (for the last TAR_CACHE_SIZE archives, until the archive changes on disk). Cataloguing,
+fingerprinting and fitting the members one by one then costs one pass of the archive, not one per member.
+"""
+import gzip
+import os
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MEMBER_SEPARATOR = "::"
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+ARCHIVE_EXTENSIONS = (".zip",) + TAR_EXTENSIONS
+
+#tar archives whose files are kept in memory
+TAR_CACHE_SIZE = 4
+
+#zip handles are not safe to share between threads, so every thread keeps its own
+_local = threading.local()
+#(archive, size, mtime) -> {member name: bytes}, most recently used last, and a lock per archive so one archive is only
+#read once at a time while other archives can be read in parallel
+_tar_contents = OrderedDict()
+_tar_locks = {}
+_tar_lock = threading.Lock()
+
+
+def split_member(path):
+    """
+    Function to split "archive::member" into its parts
+    Output: archive path, member name (None if path is not an archive member)
+    """
+    if MEMBER_SEPARATOR in path:
+        archive, member = path.split(MEMBER_SEPARATOR, 1)
+        return archive, member
+    return path, None
+
+
+def spectrum_name(path):
+    """returns the name used to tell the file type of a spectrum, i.e. without the archive part and without .gz"""
+    name = split_member(path)[1] or path
+    if name.endswith(".gz") and not name.endswith(".tar.gz"):
+        name = name[:-3]
+    return name
+
+
+def is_archive(path):
+    """checks if a path is a zip or tar archive (by its name)"""
+    return path.endswith(ARCHIVE_EXTENSIONS)
+
+
+def _zip_handle(archive):
+    """opens (once per thread) a zip archive"""
+    handles = getattr(_local, "zips", None)
+    if handles is None:
+        handles = _local.zips = {}
+    if archive not in handles:
+        handles[archive] = zipfile.ZipFile(archive)
+    return handles[archive]
+
+
+def tar_contents(archive):
+    """
+    Function to get every file of a tar archive, read in one pass the first time and then from memory
+    Input: path to the tar archive
+    Output: dictionary of member name -> bytes (as stored, so gzipped members are still gzipped)
+    """
+    stat = os.stat(archive)
+    key = (os.path.abspath(archive), stat.st_size, stat.st_mtime_ns)
+    with _tar_lock:
+        lock = _tar_locks.setdefault(key[0], threading.Lock())
+
+    with lock:
+        with _tar_lock:
+            if key in _tar_contents:
+                _tar_contents.move_to_end(key)
+                return _tar_contents[key]
+
+        contents = {}
+        with tarfile.open(archive, "r|*") as tar:
+            for info in tar:
+                if info.isfile():
+                    contents[info.name] = tar.extractfile(info).read()
+
+        with _tar_lock:
+            _tar_contents[key] = contents
+            while len(_tar_contents) > TAR_CACHE_SIZE:
+                _tar_contents.popitem(last=False)
+    return contents
+
+
+def read_bytes(path):
+    """
+    Function to get the raw (decompressed) bytes of a spectrum, wherever it lives
+    Input: path to a file, a .gz file or an "archive::member"
+    Output: bytes
+    """
+    archive, member = split_member(path)
+
+    if member is None:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as file:
+            return file.read()
+
+    if archive.endswith(".zip"):
+        return _member_bytes(_zip_handle(archive).read(member), member)
+    return _tar_member(tar_contents(archive), archive, member)
+
+
+def _member_bytes(data, member):
+    """decompresses a gzipped spectrum inside an archive"""
+    return gzip.decompress(data) if member.endswith(".gz") else data
+
+
+def _tar_member(contents, archive, member):
+    """bytes of a member out of tar_contents"""
+    if member not in contents:
+        raise KeyError(f"there is no file {member!r} in {archive}")
+    return _member_bytes(contents[member], member)
+
+
+def read_text(path):
+    """same as read_bytes, but decoded to a string"""
+    return read_bytes(path).decode("utf-8", errors="replace")
+
+
+def list_members(archive, extensions=None):
+    """
+    Function to list the files inside a zip or tar archive
+    Inputs: path to the archive, optional tuple of file extensions to keep (.gz versions are kept too)
+    Output: list of "archive::member" paths
+    """
+    if archive.endswith(".zip"):
+        names = [info.filename for info in _zip_handle(archive).infolist() if not info.is_dir()]
+    else:
+        names = list(tar_contents(archive))
+
+    if extensions is not None:
+        names = [name for name in names if spectrum_name(name).endswith(extensions)]
+    return [archive + MEMBER_SEPARATOR + name for name in sorted(names)]
+
+
+def read_many(paths, workers=4):
+    """
+    Function to read a lot of spectra at once using a pool of threads (decompression releases the GIL)
+    Tar archives can't be read at random, so each tar file is read in one pass first (see tar_contents).
+    Inputs: list of paths (files, .gz files or archive members), number of threads
+    Output: dictionary of path -> text
+    """
+    texts = {}
+    tars = {}
+    others = []
+    for path in paths:
+        archive, member = split_member(path)
+        if member is not None and archive.endswith(TAR_EXTENSIONS):
+            if archive not in tars:
+                tars[archive] = tar_contents(archive)
+            texts[path] = _tar_member(tars[archive], archive, member).decode("utf-8", errors="replace")
+        else:
+            others.append(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, text in zip(others, pool.map(read_text, others)):
+            texts[path] = text
+
+    return texts
@@ -0,0 +1,183 @@
+"""
+background_library.py
+
+Every background acquisition of a detector in one place, ready to subtract.
+
+A BackgroundLibrary is built once from all the background files ("bg" in the catalog, see catalog.py) of a detector.
+Each background's counts are turned into a rate vector (counts/sec) and its variance (counts/sec^2, Poisson) when the
+library is built, and all of them are pooled into one live time weighted average:
+    pooled rate = sum(counts) / sum(t)        variance = sum(counts) / sum(t)^2
+(t is MEAS_TIME, the time spectrum_reader.py normalises by). Spectra then get either the background measured nearest
+in time to their DATE_MEAS or the pooled one (better statistics), picked with a binary search over the sorted
+background dates, and the subtraction is one vector subtraction against the stored rate.
+
+Libraries can be saved to an .npz file so the background files aren't read again.
+
+How to use:
+    python background_library.py BGO_detector/ BGO --output BGO_backgrounds.npz
+    python spectrum_reader.py BGO_detector/unangled/ BGO_detector/unangled/bgBGO.Spe BGO --backgrounds BGO_backgrounds.npz --background-mode nearest
+"""
+import argparse
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import catalog
+import spectrum_reader
+
+MODES = ("nearest", "pooled")
+TIME_KEYS = ("MEAS_TIME", "LIVE_TIME", "REAL_TIME")
+
+
+class Background:
+    """
+    One background ready to subtract (a single acquisition or the pool of all of them)
+        header: times like file_parser's header (summed over the pool), for the quality checks
+        counts: counts (summed over the pool)
+        rate, variance: counts/sec and its variance in every channel
+        paths: files it was made from
+        key: content hash, for the fit cache
+    """
+
+    def __init__(self, times, counts, paths):
+        self.header = {key: [float(value)] for key, value in zip(TIME_KEYS, times)}
+        self.counts = counts
+        self.rate = counts / times[0]
+        self.variance = counts / times[0]**2
+        self.paths = list(paths)
+        self.key = hashlib.sha256(counts.tobytes() + np.asarray(times, dtype=float).tobytes()).hexdigest()
+
+
+class BackgroundLibrary:
+    """
+    Background acquisitions of one detector
+        detector: detector name
+        paths, dates, times (backgrounds x MEAS_TIME, LIVE_TIME, REAL_TIME), counts (backgrounds x channels)
+        mode: "nearest" (background nearest in time to each spectrum) or "pooled" (all of them averaged)
+        max_gap_hours: in nearest mode, spectra further than this from every background get the pooled one (None for no limit)
+    Backgrounds are kept sorted by date. Undated ones only go into the pool.
+    """
+
+    def __init__(self, detector, paths, dates, times, counts, mode="nearest", max_gap_hours=None):
+        if mode not in MODES:
+            raise ValueError(f"background mode has to be one of {', '.join(MODES)}, not {mode!r}")
+        if len(paths) == 0:
+            raise ValueError(f"no background files for {detector}")
+
+        dates = pd.to_datetime(pd.Series(dates, dtype=object), errors="coerce", format="mixed").to_numpy(dtype="datetime64[ns]")
+        order = np.argsort(dates, kind="stable")
+        self.detector = detector
+        self.paths = [paths[i] for i in order]
+        self.dates = dates[order]
+        self.times = np.asarray(times, dtype=float)[order]
+        self.counts = np.asarray(counts, dtype=float)[order]
+        self.mode = mode
+        self.max_gap_hours = max_gap_hours
+
+        self.backgrounds = [Background(times, counts, [path]) for path, times, counts in zip(self.paths, self.times, self.counts)]
+        self.pooled = Background(np.nansum(self.times, axis=0), self.counts.sum(axis=0), self.paths)
+        #NaT sorts last, so the dated backgrounds are the first n_dated
+        self._n_dated = int(np.count_nonzero(~np.isnat(self.dates)))
+        self._stamps = self.dates[:self._n_dated].astype(np.int64)
+
+    @classmethod
+    def from_files(cls, detector, paths, workers=4, **options):
+        """
+        Function to read background files into a library
+        Inputs: detector name, background file paths, threads to parse them with, options for BackgroundLibrary
+        Output: BackgroundLibrary
+        """
+        parsed = spectrum_reader.parse_many(list(paths), workers)
+        lengths = {len(parsed[path][1]["counts"]) for path in paths}
+        if len(lengths) > 1:
+            raise ValueError(f"background files of {detector} don't all have the same number of channels: {sorted(lengths)}")
+
+        times = [[parsed[path][0][key][0] if parsed[path][0].get(key) else np.nan for key in TIME_KEYS] for path in paths]
+        dates = [catalog.read_header(path)["date_meas"] or None for path in paths]
+        return cls(detector, list(paths), dates, times, [parsed[path][1]["counts"] for path in paths], **options)
+
+    @classmethod
+    def build(cls, root, detector, catalog_path=None, **options):
+        """
+        Function to make the library out of every background file of a detector in a folder tree
+        Inputs: folder, detector name, optional csv to keep the catalog in (see catalog.py), options for BackgroundLibrary
+        Output: BackgroundLibrary
+        """
+        rows = catalog.select(catalog.build_catalog(root, catalog_path), source="bg")
+        #files in folders that don't say which detector they're from count for any detector
+        rows = rows[rows.index.get_level_values("detector").isin([detector, ""])]
+        return cls.from_files(detector, list(rows["path"]), **options)
+
+    def save(self, path):
+        """writes the library to an .npz file"""
+        np.savez(path, detector=self.detector, paths=np.array(self.paths), dates=self.dates, times=self.times, counts=self.counts)
+
+    @classmethod
+    def load(cls, path, **options):
+        """reads a library written by save"""
+        with np.load(path) as data:
+            return cls(str(data["detector"]), data["paths"].tolist(), data["dates"], data["times"], data["counts"], **options)
+
+    def lookup(self, dates):
+        """
+        Function to pick the background for any number of spectra
+        Input: DATE_MEAS of the spectra (anything pd.to_datetime reads, missing dates are fine)
+        Output: index into self.backgrounds for each spectrum, -1 where it gets the pooled background
+        """
+        dates = pd.to_datetime(pd.Series(dates, dtype=object), errors="coerce", format="mixed").to_numpy(dtype="datetime64[ns]")
+        choice = np.full(len(dates), -1)
+        if self.mode == "pooled" or self._n_dated == 0:
+            return choice
+
+        dated = ~np.isnat(dates)
+        stamps = dates[dated].astype(np.int64)
+        right = np.clip(np.searchsorted(self._stamps, stamps), 1, self._n_dated - 1) if self._n_dated > 1 else np.zeros(len(stamps), dtype=int)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(stamps - self._stamps[left]) <= np.abs(self._stamps[right] - stamps), left, right)
+        if self.max_gap_hours is not None:
+            gap = np.abs(stamps - self._stamps[nearest]) / 3.6e12
+            nearest = np.where(gap <= self.max_gap_hours, nearest, -1)
+
+        choice[dated] = nearest
+        return choice
+
+    def background(self, index):
+        """Background at an index from lookup (-1 for the pooled one)"""
+        return self.pooled if index < 0 else self.backgrounds[index]
+
+    def select(self, date):
+        """Background for one spectrum's DATE_MEAS"""
+        return self.background(self.lookup([date])[0])
+
+    def summary(self):
+        """table of the backgrounds in the library with their times and total rates, and the pool"""
+        table = pd.DataFrame({"path": self.paths, "date": self.dates, "meas time": self.times[:, 0],
+                              "rate": [background.rate.sum() for background in self.backgrounds]})
+        pooled = pd.DataFrame({"path": ["(pooled)"], "date": [pd.NaT], "meas time": [self.pooled.header["MEAS_TIME"][0]],
+                               "rate": [self.pooled.rate.sum()]})
+        return pd.concat([table, pooled], ignore_index=True)
+
+
+def load_library(path, detector=None, catalog_path=None, **options):
+    """
+    Function to get a library from a saved .npz file or by building it from a folder of backgrounds
+    Inputs: .npz file or folder, detector name (needed for a folder), optional catalog csv, options for BackgroundLibrary
+    Output: BackgroundLibrary
+    """
+    if path.endswith(".npz"):
+        return BackgroundLibrary.load(path, **options)
+    return BackgroundLibrary.build(path, detector, catalog_path, **options)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will make a library of a detector's background measurements''')
+    parser.add_argument('root', type = str, help = "folder tree with the background files", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--catalog', type = str, help = "csv to keep the catalog of the folder in between runs", default = None)
+    parser.add_argument('--output', type = str, help = "npz file to save the library to (default <detector>_backgrounds.npz)", default = None)
+    args = parser.parse_args()
+
+    library = BackgroundLibrary.build(args.root, args.detector, args.catalog)
+    library.save(args.output or args.detector + "_backgrounds.npz")
+    print(library.summary().to_string(index=False))
@@ -0,0 +1,287 @@
+"""
+run_benchmarks.py
+
+Times the main steps of the pipeline on synthetic spectra (see synthetic.py) so we can tell if a change to
+file_parser, gauss_fitter, make_results_dict etc. makes things faster or slower.
+
+Benchmarks (each run at every scale, where scale = number of spectra):
+    1. parse: file_parser on every spectrum file
+    2. subtract: background subtraction of every spectrum
+    3. fit: gauss_fitter on one ROI of every spectrum
+    3b. coarse: coarse_to_fine_fitter on the same ROIs. Both fit benchmarks also record the model evaluations per fit,
+        the failures and the median centroid error, from the usual guess and from a poor one
+    4. detector: make_results_dict for one detector (BGO) over a folder of spectra
+    4b. pool: the same fits with 4 worker processes reading the spectra from shared memory (shared_pool.py)
+    4c. backgrounds: the same run with the background rate taken from a BackgroundLibrary (background_library.py)
+        instead of parsing the background file for every fit
+    5. campaign: make_results_dict for every detector profile, spectra split between them
+    6. kernels: every kernel of kernels.py (parsing, baseline, model and jacobian, ROI sums) with each backend that's
+        installed ("kernels numpy", "kernels numba"), with the largest difference from the numpy backend's answers
+        and the speedup over it
+
+How to use:
+    python benchmarks/run_benchmarks.py --scales 10 1000 --output bench.json
+    python benchmarks/run_benchmarks.py --scales 10 1000 --compare bench.json       (prints new/old time ratios)
+
+Results are written as json (median and all repeat times, per benchmark and scale, plus the git commit) so runs on
+different commits can be compared. The 100k scale takes a long time for the fitting benchmarks (roughly hours),
+run it with --benchmarks parse subtract for the quick ones.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import background_library
+import kernels
+import profiles
+import shared_pool
+import spectrum_reader
+import synthetic
+
+BENCHMARKS = ["parse", "subtract", "fit", "coarse", "detector", "pool", "backgrounds", "campaign", "kernels"]
+GAIN, OFFSET = 2.2, 0.0
+
+
+def make_detector_folder(folder, profile, n_spectra, seed=0):
+    """
+    Function to write synthetic spectra for every source of a detector profile (plus a background) to a folder
+    Inputs: folder, DetectorProfile, total number of spectra, random seed
+    Output: list of spectrum paths, path of the background file
+    """
+    rng = np.random.default_rng(seed)
+    n_channels = int(max(1024, profile.roi_stops.max()))
+    per_source = np.diff(np.linspace(0, n_spectra, len(profile.sources) + 1).astype(int))
+
+    paths = []
+    for source, n in zip(profile.sources, per_source):
+        if n == 0:
+            continue
+        lines = synthetic.profile_lines(profile, source, GAIN, OFFSET)
+        expected = synthetic.expected_spectrum(lines, n_channels, GAIN, OFFSET)
+        spectra = synthetic.poisson_spectra(expected, n, rng)
+        paths += synthetic.write_spectra(folder, f"{source}_{profile.name}", spectra, profile.format)
+
+    background = synthetic.poisson_spectra(synthetic.expected_spectrum([], n_channels, GAIN, OFFSET), 1, rng)
+    background_path = synthetic.write_spectra(folder, f"bg_{profile.name}", background, profile.format)[0]
+
+    return paths, background_path
+
+
+def time_it(function, repeats):
+    """runs a function a few times and returns every run's wall time (sec)"""
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def counted(model):
+    """wraps a model so the number of times it gets evaluated can be read off .calls"""
+    def counting_model(x, *params):
+        counting_model.calls += 1
+        return model(x, *params)
+
+    counting_model.calls = 0
+    counting_model.__name__ = model.__name__
+    counting_model.jacobian = getattr(model, "jacobian", None)
+    return counting_model
+
+
+def poor_guess(roi):
+    """a deliberately bad starting point for compound_model: off centre, far too wide and far too small"""
+    return [roi[0] + 0.15 * (roi[-1] - roi[0]), (roi[-1] - roi[0]) / 2, 1e-3, 0.0, 0.0, 0.0]
+
+
+def fit_all(fitter, tables, rois):
+    """fits every ROI, a fit that doesn't converge is skipped (it's counted in fit_stats) instead of stopping the run"""
+    for table, roi in zip(tables, rois):
+        try:
+            fitter(table, roi)
+        except (RuntimeError, ValueError, TypeError, np.linalg.LinAlgError):
+            pass
+
+
+def fit_stats(fitter, tables, rois, truths, poor=False):
+    """
+    Function to count what a fitter does over a set of ROIs
+    Inputs: fitter (gauss_fitter or coarse_to_fine_fitter), background subtracted tables, ROI channels, true centroids,
+            whether to start every fit from poor_guess
+    Output: dictionary with model evaluations per fit, failures and the median centroid error (channels)
+    """
+    model = counted(spectrum_reader.compound_model)
+    errors, failures = [], 0
+    for table, roi, truth in zip(tables, rois, truths):
+        try:
+            mu, sig, amp = fitter(table, roi, poor_guess(roi) if poor else None, model)
+        except (RuntimeError, ValueError, TypeError, np.linalg.LinAlgError):
+            failures += 1
+            continue
+        errors.append(abs(mu - truth))
+    prefix = "poor guess " if poor else ""
+    return {prefix + "nfev": model.calls / max(len(rois), 1), prefix + "failures": failures,
+            prefix + "centroid error": float(np.median(errors)) if errors else None}
+
+
+def kernel_workload(paths, tables, rois, profile):
+    """
+    Function to run every kernel once over a set of spectra
+    Inputs: spectrum paths, background subtracted tables, ROI channels of each table, DetectorProfile
+    Output: list of every kernel's output (to compare between backends)
+    """
+    spectra = [spectrum_reader.file_parser(path)[1]["counts"] for path in paths]
+    outputs = list(spectra)
+    for table, roi in zip(tables, rois):
+        x, y = np.asarray(table["bins"])[roi], np.asarray(table["counts/sec"])[roi]
+        params = (x.mean(), len(x) / 6, y.sum(), 0.0, 0.0, y.min())
+        outputs += [kernels.baseline(y), kernels.compound_model(x, *params), kernels.compound_jacobian(x, *params)]
+    for counts in spectra:
+        outputs.append(kernels.window_sums(counts, np.minimum(profile.roi_starts, len(counts)), np.minimum(profile.roi_stops, len(counts))))
+    return outputs
+
+
+def run_scale(scale, benchmarks, repeats, workdir):
+    """
+    Function to run the chosen benchmarks at one scale
+    Inputs: number of spectra, list of benchmark names, repeats per benchmark, folder for the synthetic files
+    Output: dictionary of benchmark name -> list of run times, dictionary of benchmark name -> fit statistics
+    """
+    timings, stats = {}, {}
+    bgo = profiles.load_profile("BGO")
+    folder = os.path.join(workdir, f"BGO_{scale}") + os.sep
+    paths, background = make_detector_folder(folder, bgo, scale)
+
+    if "parse" in benchmarks:
+        timings["parse"] = time_it(lambda: [spectrum_reader.file_parser(path) for path in paths], repeats)
+
+    parsed = [spectrum_reader.file_parser(path) for path in paths]
+    bg_header, bg_spectrum = spectrum_reader.file_parser(background)
+
+    def subtract_all():
+        return [spectrum_reader.subtract_counts(spectrum["counts"], header["MEAS_TIME"],
+                                                bg_spectrum["counts"], bg_header["MEAS_TIME"])
+                for header, spectrum in parsed]
+
+    if "subtract" in benchmarks:
+        timings["subtract"] = time_it(subtract_all, repeats)
+
+    if "fit" in benchmarks or "coarse" in benchmarks or "kernels" in benchmarks:
+        tables = subtract_all()
+        #first ROI of the source each spectrum is from, the synthetic lines sit in the middle of their ROIs
+        first_rois = [bgo.source_rois[bgo.sources.index(os.path.basename(path).split("_")[0])][0] for path in paths]
+        rois = [bgo.roi_index[roi] for roi in first_rois]
+        truths = [(bgo.roi_starts[roi] + bgo.roi_stops[roi]) / 2 for roi in first_rois]
+
+        for name, fitter in (("fit", spectrum_reader.gauss_fitter), ("coarse", spectrum_reader.coarse_to_fine_fitter)):
+            if name in benchmarks:
+                timings[name] = time_it(lambda: fit_all(fitter, tables, rois), repeats)
+                stats[name] = {**fit_stats(fitter, tables, rois, truths), **fit_stats(fitter, tables, rois, truths, poor=True)}
+
+    if "detector" in benchmarks:
+        timings["detector"] = time_it(lambda: spectrum_reader.make_results_dict(folder, background, "BGO"), repeats)
+
+    if "pool" in benchmarks:
+        timings["pool"] = time_it(lambda: shared_pool.results_dict(folder, background, "BGO", workers=4), repeats)
+
+    if "backgrounds" in benchmarks:
+        library = background_library.BackgroundLibrary.from_files("BGO", [background])
+        timings["backgrounds"] = time_it(lambda: spectrum_reader.make_results_dict(folder, None, "BGO", backgrounds=library), repeats)
+
+    if "campaign" in benchmarks:
+        detectors = profiles.available_profiles()
+        campaign = []
+        for i, (name, n) in enumerate(zip(detectors, np.diff(np.linspace(0, scale, len(detectors) + 1).astype(int)))):
+            det_folder = os.path.join(workdir, f"campaign_{scale}", name) + os.sep
+            campaign.append((det_folder, make_detector_folder(det_folder, profiles.load_profile(name), n, seed=i)[1], name))
+        timings["campaign"] = time_it(lambda: [spectrum_reader.make_results_dict(*run) for run in campaign], repeats)
+
+    if "kernels" in benchmarks:
+        in_use, reference = kernels.BACKEND, None
+        for backend in kernels.available_backends():
+            kernels.use(backend)
+            #the first run also compiles the numba kernels, so it isn't timed
+            outputs = kernel_workload(paths, tables, rois, bgo)
+            reference = reference or outputs
+            name = "kernels " + backend
+            timings[name] = time_it(lambda: kernel_workload(paths, tables, rois, bgo), repeats)
+            stats[name] = {"max difference": max(float(np.max(np.abs(np.asarray(new, dtype=float) - old), initial=0))
+                                                 for new, old in zip(outputs, reference)),
+                           "speedup": float(np.median(timings["kernels numpy"]) / np.median(timings[name]))}
+        kernels.use(in_use)
+
+    return timings, stats
+
+
+def git_commit():
+    """returns the current git commit (or "unknown")"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline_path):
+    """prints the ratio of new to old median times for every benchmark/scale in both runs"""
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+
+    print(f"\n{'benchmark':<12} {'scale':>8} {'old (s)':>12} {'new (s)':>12} {'new/old':>8}")
+    print("-" * 56)
+    for name, scales in results["results"].items():
+        for scale, new in scales.items():
+            old = baseline["results"].get(name, {}).get(scale)
+            if old is not None:
+                print(f"{name:<12} {scale:>8} {old['median']:>12.4f} {new['median']:>12.4f} {new['median'] / old['median']:>8.2f}")
+
+
+def main(scales, benchmarks, repeats, output, baseline):
+    """Main function to run what the script does"""
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": {}
+    }
+
+    with tempfile.TemporaryDirectory() as workdir, warnings.catch_warnings():
+        #the fitting warnings aren't what's being measured
+        warnings.simplefilter("ignore")
+        for scale in scales:
+            timings, stats = run_scale(scale, benchmarks, repeats, workdir)
+            for name, runs in timings.items():
+                results["results"].setdefault(name, {})[str(scale)] = {"median": float(np.median(runs)), "per_spectrum": float(np.median(runs)) / scale,
+                                                        "runs": runs, **stats.get(name, {})}
+                print(f"{name:<12} {scale:>8} spectra: {np.median(runs):.4f} s ({np.median(runs) / scale * 1e3:.3f} ms/spectrum)")
+                if name in stats:
+                    print("    " + ", ".join(f"{key} {value:.3g}" if isinstance(value, float) else f"{key} {value}" for key, value in stats[name].items()))
+
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will time the pipeline on synthetic spectra''')
+    parser.add_argument('--scales', type = int, nargs = "+", help = "numbers of spectra to run at (e.g. 10 1000 100000)", default = [10])
+    parser.add_argument('--benchmarks', type = str, nargs = "+", choices = BENCHMARKS, help = "which benchmarks to run", default = BENCHMARKS)
+    parser.add_argument('--repeats', type = int, help = "times to repeat each benchmark", default = 3)
+    parser.add_argument('--output', type = str, help = "json file to write the results to", default = None)
+    parser.add_argument('--compare', type = str, help = "json results from an earlier run to compare against", default = None)
+    args = parser.parse_args()
+
+    main(args.scales, args.benchmarks, args.repeats, args.output, args.compare)
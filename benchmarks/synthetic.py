@@ -0,0 +1,132 @@
+"""
+synthetic.py
+
+Makes fake (but realistic looking) gamma ray spectra for benchmarking and checking the pipeline.
+
+Spectra are made as 2d arrays (spectra x channels) all at once: the expected counts per channel are built from
+    1. photopeaks: gaussians with a width set by the resolution law R^2 = a/E^2 + b/E + c (same law as resolution.py)
+    2. a Compton continuum under each line, flat up to the Compton edge and smeared by the resolution
+    3. a falling background
+and then every channel of every spectrum gets a Poisson draw. Spectra can be written out as MAESTRO .Spe or
+PMCA .mca files that spectrum_reader.py reads just like the real ones.
+"""
+import os
+
+import numpy as np
+
+ELECTRON_MASS_KEV = 510.999
+
+
+def channel_energies(n_channels, gain, offset):
+    """energy (keV) at the centre of every channel for the calibration E = gain * channel + offset"""
+    return gain * np.arange(n_channels) + offset
+
+
+def fwhm_keV(energy, resolution_law):
+    """FWHM (keV) of a line at energy E from the resolution law (a, b, c) with R^2 = a/E^2 + b/E + c"""
+    a, b, c = resolution_law
+    energy = np.asarray(energy, dtype=float)
+    r2 = a / energy**2 + b / energy + c
+    return energy * np.sqrt(np.clip(r2, 1e-8, None))
+
+
+def compton_edge(energy):
+    """energy (keV) of the Compton edge of a line"""
+    return energy * (1 - 1 / (1 + 2 * energy / ELECTRON_MASS_KEV))
+
+
+def expected_spectrum(lines, n_channels=1024, gain=2.2, offset=0.0, resolution_law=(0.0, 9.0, 0.0),
+                      compton_fraction=1.5, background_rate=5.0, background_slope=150.0, live_time=200.0):
+    """
+    Function to make the expected (noise free) counts per channel of a spectrum
+    Inputs:
+        lines: list of (energy keV, counts per second in the photopeak)
+        n_channels, gain, offset: channel count and calibration E = gain * channel + offset
+        resolution_law: (a, b, c) of R^2 = a/E^2 + b/E + c, the default is about a BGO crystal (11.7% at 662 keV)
+        compton_fraction: counts in the Compton continuum per count in the photopeak
+        background_rate: background counts per second, spread as a falling exponential over background_slope keV
+        live_time: seconds
+    Output: 1d array of expected counts
+    """
+    energies = channel_energies(n_channels, gain, offset)
+    expected = np.zeros(n_channels)
+
+    for line_energy, rate in lines:
+        sigma = fwhm_keV(line_energy, resolution_law) / 2.355
+        peak = np.exp(-0.5 * ((energies - line_energy) / sigma)**2)
+        expected += rate * live_time * peak / peak.sum() if peak.sum() > 0 else 0
+
+        #continuum up to the compton edge, the edge smeared by the resolution at that energy
+        edge = compton_edge(line_energy)
+        edge_sigma = fwhm_keV(max(edge, 1.0), resolution_law) / 2.355
+        shelf = 0.5 * (1 - np.tanh((energies - edge) / (edge_sigma * np.sqrt(2)))) * (energies > 0)
+        if shelf.sum() > 0:
+            expected += compton_fraction * rate * live_time * shelf / shelf.sum()
+
+    background = np.exp(-np.clip(energies, 0, None) / background_slope)
+    expected += background_rate * live_time * background / background.sum()
+
+    return expected
+
+
+def poisson_spectra(expected, n_spectra, rng=None):
+    """
+    Function to draw Poisson spectra around an expected spectrum, all at once
+    Inputs: expected counts per channel, number of spectra, numpy random generator (or seed)
+    Output: (n_spectra, n_channels) array of counts
+    """
+    rng = np.random.default_rng(rng)
+    return rng.poisson(np.broadcast_to(expected, (n_spectra, len(expected))))
+
+
+def write_spe(path, counts, live_time, real_time, date="10/28/2025 11:03:46"):
+    """writes a spectrum as a MAESTRO .Spe file"""
+    counts = np.asarray(counts, dtype=np.int64)
+    header = ["$SPEC_ID:", "Synthetic spectrum", "$SPEC_REM:", "DET# 0", "DETDESC# SYNTHETIC SN 00000000",
+              "AP# synthetic.py", "$DATE_MEA:", date, "$MEAS_TIM:", f"{live_time:.0f} {real_time:.0f}",
+              "$DATA:", f"0 {len(counts) - 1}"]
+    data = "\n".join(f"{count:8d}" for count in counts)
+    with open(path, "w") as file:
+        file.write("\n".join(header) + "\n" + data + "\n$ROI:\n0\n")
+
+
+def write_mca(path, counts, live_time, real_time, date="10/28/2025 11:03:46"):
+    """writes a spectrum as an Amptek PMCA .mca file"""
+    counts = np.asarray(counts, dtype=np.int64)
+    header = ["<<PMCA SPECTRUM>>", "TAG - live_data", "DESCRIPTION - synthetic", "GAIN - 3", "THRESHOLD - 0",
+              "LIVE_MODE - 0", "PRESET_TIME - 0", f"LIVE_TIME - {live_time:.6f}", f"REAL_TIME - {real_time:.6f}",
+              f"START_TIME - {date}", "SERIAL_NUMBER - 0", "<<DATA>>"]
+    data = "\n".join(str(count) for count in counts)
+    with open(path, "w") as file:
+        file.write("\n".join(header) + "\n" + data + "\n<<END>>\n")
+
+
+def write_spectra(folder, name, spectra, fmt="Spe", live_time=200.0, real_time=None):
+    """
+    Function to write a stack of spectra to a folder as name-000000.Spe, name-000001.Spe, ...
+    (a dash, so catalog.py doesn't read the number as an angle)
+    Inputs: folder, file name stem, 2d array of counts, "Spe" or "mca", live and real time (sec)
+    Output: list of paths written
+    """
+    writer = write_spe if fmt == "Spe" else write_mca
+    real_time = live_time if real_time is None else real_time
+    os.makedirs(folder, exist_ok=True)
+
+    paths = []
+    for i, counts in enumerate(np.atleast_2d(spectra)):
+        path = os.path.join(folder, f"{name}-{i:06d}.{fmt}" if len(spectra) > 1 else f"{name}.{fmt}")
+        writer(path, counts, live_time, real_time)
+        paths.append(path)
+    return paths
+
+
+def profile_lines(profile, source, gain, offset, rate=50.0):
+    """
+    Function to make the lines of one source of a detector profile, placed in the middle of their ROIs, so that
+    synthetic spectra go through make_results_dict the same way the real ones do
+    Inputs: DetectorProfile (see profiles.py), source name, calibration used for the spectra, counts/sec per line
+    Output: list of (energy keV, counts per second)
+    """
+    rois = profile.source_rois[profile.sources.index(source)]
+    centres = (profile.roi_starts[rois] + profile.roi_stops[rois]) / 2
+    return [(gain * centre + offset, rate) for centre in centres]
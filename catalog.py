@@ -0,0 +1,251 @@
+"""
+catalog.py
+
+Builds an indexed table (catalog) of every spectrum in a folder tree like BGO_detector/, CdTe_detector/, NaITi_detector/
+by parsing the file names and the file headers once (zip/tar archives and .gz files in the tree are read in place). Pipeline steps then pick their input files with a query
+(detector, source, angle) instead of globbing and checking substrings in the file names every run.
+
+Each row of the catalog has:
+    path, detector, source ("bg" for background files, "" if unknown), angle (deg, 0 if not angled), format,
+    date_meas, live_time, real_time (sec), serial (device serial number), size, mtime_ns
+
+The table is sorted on a (detector, source, angle) index, so lookups are binary searches. If a cache file is given,
+the catalog is saved there and only new or modified files are reparsed the next time it is built.
+
+How to use:
+    python catalog.py path/to/tree --cache catalog.csv --detector BGO --source Am --angle 45 165
+"""
+import argparse
+import io
+import os
+import re
+from datetime import datetime
+
+import pandas as pd
+
+import archives
+
+SPECTRUM_EXTENSIONS = (".Spe", ".mca")
+INDEX = ["detector", "source", "angle"]
+COLUMNS = INDEX + ["path", "format", "date_meas", "live_time", "real_time", "serial", "size", "mtime_ns"]
+
+#angle token anywhere in the file name: Am_BGO_135, Ba_135_BGO, Co_90_BGO, Cs_CdTe_145deg, Sample_1_Hg_90degree
+ANGLE_PATTERN = re.compile(r"(?:^|[_ ])(\d+)\s*(deg|degree|degrees)?(?=[_ ]|$)", re.IGNORECASE)
+#a number straight after one of these is an index, not an angle (the 1 of Sample_1)
+INDEX_WORDS = ("sample", "run")
+#detector from the folder the files live in: BGO_detector/...
+DETECTOR_PATTERN = re.compile(r"^(\w+?)_detector$")
+#source is the first 1-2 letter token of the name: Am, Cs, Co, Ba, Hg (AM is read as Am)
+SOURCE_PATTERN = re.compile(r"^[A-Za-z]{1,2}$")
+DATE_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+
+def parse_angle(stem):
+    """
+    Function to get the angle out of a file name (without its extension)
+    Input: file name, e.g. Ba_135_BGO, Am_CdTe_90deg, Sample_1_Hg_90degree
+    Output: angle in degrees (0 if there isn't one). A number marked deg/degree wins, otherwise the last number that
+            isn't an index (Sample_1)
+    """
+    angles = []
+    for found in ANGLE_PATTERN.finditer(stem):
+        if found.group(2):
+            return int(found.group(1))
+        before = re.split(r"[_ ]+", stem[:found.start()].strip("_ "))[-1].lower()
+        if before not in INDEX_WORDS:
+            angles.append(int(found.group(1)))
+
+    return angles[-1] if angles else 0
+
+
+def parse_filename(path):
+    """
+    Function to get the detector, source and angle out of a spectrum's path
+    Input: path to a spectrum file, e.g. BGO_detector/Am_angled/Am_BGO_135.Spe, BGO_detector/Ba_135_BGO.Spe,
+           BGO_detector/Co_90_BGO.Spe, CdTe_detector/unangled/Cs_CdTe_145deg.mca
+    Output: detector ("" if unknown), source ("bg" for backgrounds, "" if unknown), angle in degrees (0 if not angled)
+    """
+    #folders inside an archive count the same as folders on disk
+    path = archives.spectrum_name(path.replace(archives.MEMBER_SEPARATOR, "/"))
+    detector = ""
+    for part in reversed(os.path.normpath(os.path.dirname(path)).replace("\\", "/").split("/")):
+        found = DETECTOR_PATTERN.match(part)
+        if found:
+            detector = found.group(1)
+            break
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+
+    angle = parse_angle(stem)
+
+    source = ""
+    if stem.lower().startswith("bg"):
+        source = "bg"
+    else:
+        for token in re.split(r"[_ ]+", stem):
+            if SOURCE_PATTERN.match(token):
+                source = token.capitalize()
+                break
+
+    return detector, source, angle
+
+
+def _parse_date(text):
+    """turns a header date into an iso string (or "" if it can't be read)"""
+    try:
+        return datetime.strptime(text.strip(), DATE_FORMAT).isoformat()
+    except ValueError:
+        return ""
+
+
+def read_header(path):
+    """
+    Function to read just the header of a .Spe or .mca file (stops at the data block)
+    Input: path to a spectrum file (can be gzipped or in an archive, see archives.py)
+    Output: dictionary with date_meas, live_time, real_time and serial
+    """
+    header = {"date_meas": "", "live_time": float("nan"), "real_time": float("nan"), "serial": ""}
+
+    if archives.split_member(path)[1] is None and not path.endswith(".gz"):
+        file = open(path, "r")
+    else:
+        file = io.StringIO(archives.read_text(path))
+
+    with file:
+        if archives.spectrum_name(path).endswith(".Spe"):
+            for line in file:
+                line = line.strip()
+                if line == "$DATA:":
+                    break
+                elif line.startswith("$DATE_MEA:"):
+                    header["date_meas"] = _parse_date(next(file))
+                elif line.startswith("$MEAS_TIM:"):
+                    times = next(file).split()
+                    header["live_time"] = float(times[0])
+                    header["real_time"] = float(times[-1])
+                elif line.startswith("DETDESC#") and " SN " in line:
+                    header["serial"] = line.rsplit(" SN ", 1)[1].strip()
+        else:
+            for line in file:
+                line = line.strip()
+                if line.startswith("<<DATA>>"):
+                    break
+                key, _, value = line.partition(" - ")
+                if key == "START_TIME":
+                    header["date_meas"] = _parse_date(value)
+                elif key == "LIVE_TIME":
+                    header["live_time"] = float(value)
+                elif key == "REAL_TIME":
+                    header["real_time"] = float(value)
+                elif key == "SERIAL_NUMBER":
+                    header["serial"] = value.strip()
+
+    return header
+
+
+def catalog_row(path, stat):
+    """makes the catalog row for one spectrum file"""
+    detector, source, angle = parse_filename(path)
+    row = {"detector": detector, "source": source, "angle": angle, "path": path,
+           "format": os.path.splitext(archives.spectrum_name(path))[1][1:], "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    row.update(read_header(path))
+    return row
+
+
+def _scan(root, recursive):
+    """yields (path, stat) for every spectrum file under root, going into zip/tar archives (members get the archive's stat)"""
+    if os.path.isfile(root) and archives.is_archive(root):
+        stat = os.stat(root)
+        for member in archives.list_members(root, SPECTRUM_EXTENSIONS):
+            yield member, stat
+        return
+
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if entry.is_dir() and recursive:
+            yield from _scan(entry.path, recursive)
+        elif entry.is_file() and archives.is_archive(entry.name):
+            yield from _scan(entry.path, recursive)
+        elif entry.is_file() and archives.spectrum_name(entry.name).endswith(SPECTRUM_EXTENSIONS):
+            yield entry.path, entry.stat()
+
+
+def index_catalog(table):
+    """sorts a flat catalog on its (detector, source, angle) index so queries are binary searches"""
+    table = table.astype({"detector": str, "source": str, "angle": int, "serial": str})
+    table["date_meas"] = pd.to_datetime(table["date_meas"])
+    return table.set_index(INDEX).sort_index()
+
+
+def build_catalog(root, cache_path=None, recursive=True):
+    """
+    Function to build (or refresh) the catalog of a folder tree
+    Inputs: root folder, optional csv to cache the catalog in, whether to go into subfolders
+    Output: catalog dataframe indexed by (detector, source, angle)
+    """
+    known = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = pd.read_csv(cache_path, dtype={"serial": str})
+        text_columns = ["detector", "source", "serial", "date_meas"]
+        cached[text_columns] = cached[text_columns].fillna("")
+        known = {row["path"]: row for row in cached.to_dict("records")}
+
+    rows = []
+    for path, stat in _scan(root, recursive):
+        row = known.get(path)
+        #only reparse files that are new or have changed since the cache was written
+        if row is None or int(row["size"]) != stat.st_size or int(row["mtime_ns"]) != stat.st_mtime_ns:
+            row = catalog_row(path, stat)
+        else:
+            #names are cheap to parse, so cached rows always get the current reading of them
+            row = dict(row, **dict(zip(INDEX, parse_filename(path))))
+        rows.append(row)
+
+    table = pd.DataFrame(rows, columns=COLUMNS)
+    if cache_path is not None:
+        table.to_csv(cache_path, index=False)
+
+    return index_catalog(table)
+
+
+def select(catalog, detector=None, source=None, angle=None, fmt=None):
+    """
+    Function to query the catalog
+    Inputs: catalog from build_catalog, then any of
+        detector: detector name
+        source: source name ("bg" for backgrounds)
+        angle: one angle, or a (low, high) tuple for an inclusive range
+        fmt: file format ("Spe" or "mca")
+    Output: matching rows of the catalog
+    """
+    if angle is None:
+        angle_key = slice(None)
+    elif isinstance(angle, (tuple, list)):
+        angle_key = slice(angle[0], angle[1])
+    else:
+        angle_key = slice(angle, angle)
+
+    key = (slice(None) if detector is None else slice(detector, detector),
+           slice(None) if source is None else slice(source, source),
+           angle_key)
+    rows = catalog.loc[key, :]
+
+    if fmt is not None:
+        rows = rows[rows["format"] == fmt]
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will build a catalog of spectrum files and print the ones matching a query''')
+    parser.add_argument('root', type = str, help = "folder to catalog", default = None)
+    parser.add_argument('--cache', type = str, help = "csv file to keep the catalog in between runs", default = None)
+    parser.add_argument('--detector', type = str, help = "detector to select", default = None)
+    parser.add_argument('--source', type = str, help = "source to select (bg for backgrounds)", default = None)
+    parser.add_argument('--angle', type = int, nargs = "+", help = "angle, or low and high angle, to select", default = None)
+    args = parser.parse_args()
+
+    angle = None
+    if args.angle is not None:
+        angle = args.angle[0] if len(args.angle) == 1 else tuple(args.angle[:2])
+
+    table = select(build_catalog(args.root, args.cache), args.detector, args.source, angle)
+    print(table[["path", "date_meas", "live_time", "real_time"]].to_string())
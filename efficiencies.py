@@ -14,9 +14,20 @@ Outputs: plots and absolute and intrinsic effficiancy for the detector
 import numpy as np
 import matplotlib.pyplot as plt
 import argparse
+import sys
+import warnings
 import pandas as pd
 
-def compute_efficiencies(energies, count_rates, source_info, detector_geom, angles_deg=[0.0], plot=True):
+import efficiency_model
+import fit_cache
+import geometry
+import nuclides
+import profiles
+import profiling
+
+@profiling.timed("compute_efficiencies")
+def compute_efficiencies(energies, count_rates, source_info, detector_geom, angles_deg=[0.0], plot=True,
+                         table_dir=geometry.TABLE_DIR):
 
     # Compute absolute and intrinsic efficiencies.
     activity = source_info.get('activity_Bq', None)
@@ -24,29 +35,43 @@ def compute_efficiencies(energies, count_rates, source_info, detector_geom, angl
     
     A = detector_geom.get('area_m2', None)
     d = detector_geom.get('distance_m', None)
+    if 'radius_m' in detector_geom:
+        crystal = geometry.Geometry.from_config(detector_geom)
+        A = crystal.area_m2
     
     energies = np.array(energies, dtype=float)
     areas_counts_per_s = np.array(count_rates, dtype=float)
+    #one activity for every line, or one per line (e.g. decay corrected from nuclides.py)
+    activity = np.broadcast_to(np.array(activity, dtype=float), energies.shape)
     
     if branching is None:
         branching = np.ones_like(energies)
     else:
         branching = np.array(branching, dtype=float)
     
-    # Compute geometric factor for angles
-    angles = np.deg2rad(np.array(angles_deg, dtype=float))
-    G_angles = []
-    A_proj = A
-    for theta in angles:
-        A_theta = A_proj * np.cos(theta)
-        G = A_theta / (4.0 * np.pi * (d**2))
-        G_angles.append(G)
-    G_angles = np.array(G_angles)
+    # Compute geometric factor for angles: exact solid angle from the geometry lookup table if the crystal's shape
+    # is known (see geometry.py, kept in table_dir, None for memory only), otherwise the point approximation
+    # A cos(theta) / (4 pi d^2)
+    if 'radius_m' in detector_geom:
+        G_angles = geometry.geometric_factor(crystal, d, angles_deg, detector_geom.get('offset_m', 0.0), table_dir)
+    else:
+        G_angles = geometry.point_solid_angle(A, d, angles_deg) / (4.0 * np.pi)
     
     # Compute efficiencies for theta=0
     eps_abs = areas_counts_per_s / (activity * branching)
     G0 = G_angles[0]
     eps_intrinsic = areas_counts_per_s / (activity * branching * G0)
+
+    # Intrinsic efficiency vs Energy log-log fit (ln eps = c ln(E)^2 + b ln(E) + a), lines with no usable efficiency
+    # (zero/negative count rates, unknown activities) are left out instead of breaking the fit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lnE = np.log(energies)
+        ln_eps = np.log(eps_intrinsic)
+    usable = np.isfinite(lnE) & np.isfinite(ln_eps)
+    if not np.all(usable):
+        warnings.warn(f"leaving {np.sum(~usable)} lines with no usable efficiency out of the fit: {energies[~usable]} keV")
+    lnE, ln_eps = lnE[usable], ln_eps[usable]
+    p = np.polyfit(lnE, ln_eps, 2) if len(lnE) >= 3 else np.full(3, np.nan)
     
     if plot:
         # Absolute efficiency vs Energy
@@ -58,16 +83,14 @@ def compute_efficiencies(energies, count_rates, source_info, detector_geom, angl
         plt.ylabel('Absolute efficiency (ε_abs)')
         plt.title('Absolute efficiency vs Energy')
         plt.grid(alpha=0.3, which='both')
-        plt.show()
+        with profiling.stage("plt.show"):
+            plt.show()
         
         # Intrinsic efficiency vs Energy (log-log fit)
-        lnE = np.log(energies)
-        ln_eps = np.log(eps_intrinsic)
-        p = np.polyfit(lnE, ln_eps, 2)
         lnE_fit = np.linspace(lnE.min()*0.9, lnE.max()*1.1, 200)
         
         plt.figure(figsize=(7, 5))
-        plt.scatter(energies, eps_intrinsic, label='Data')
+        plt.scatter(energies[usable], eps_intrinsic[usable], label='Data')
         Efit = np.exp(lnE_fit)
         eps_fit = np.exp(np.polyval(p, lnE_fit))
         plt.plot(Efit, eps_fit, '-r', label=f'lnε fit: a={p[2]:.3f}, b={p[1]:.3f}, c={p[0]:.3f}')
@@ -78,19 +101,21 @@ def compute_efficiencies(energies, count_rates, source_info, detector_geom, angl
         plt.legend()
         plt.grid(alpha=0.3, which='both')
         plt.title('Intrinsic efficiency vs Energy (log-log)')
-        plt.show()
+        with profiling.stage("plt.show"):
+            plt.show()
         
         # Efficiency vs angle 
         if len(areas_counts_per_s) > 0 and len(angles_deg) > 1:
             idx = np.argmax(areas_counts_per_s)
-            eps_intrinsic_angles = areas_counts_per_s[idx] / (activity * branching[idx] * G_angles)
+            eps_intrinsic_angles = areas_counts_per_s[idx] / (activity[idx] * branching[idx] * G_angles)
             plt.figure(figsize=(7, 4))
             plt.plot(angles_deg, eps_intrinsic_angles, 'o-')
             plt.xlabel('Angle (deg)')
             plt.ylabel('Intrinsic efficiency (ε_intr)')
             plt.title('Intrinsic efficiency vs Angle (example peak)')
             plt.grid(alpha=0.3)
-            plt.show()
+            with profiling.stage("plt.show"):
+                plt.show()
     
     out = {
         'energies_keV': energies,
@@ -99,22 +124,45 @@ def compute_efficiencies(energies, count_rates, source_info, detector_geom, angl
         'absolute_efficiency': eps_abs,
         'intrinsic_efficiency': eps_intrinsic,
         'G_angles': G_angles,
-        'angles_deg': angles_deg
+        'angles_deg': angles_deg,
+        'fit_coefficients': p
     }
     return out
 
-def main(data, detector):
+def line_source_info(table):
+    """
+    Function to get the branching ratio and (decay corrected) source activity of each line of a results table from the
+    nuclide library (nuclides.json), lines the library doesn't know keep the old 1 uCi and branching ratio of 1
+    Input: results dataframe (energy, and date if it has one)
+    Output: source_info dictionary for compute_efficiencies
+    """
+    library = nuclides.load_library()
+    dates = table["date"] if "date" in table else None
+    branching = library.branching_ratios(table["energy"])
+    activities = library.activities(table["energy"], dates)
+    return {'activity_Bq': np.where(np.isfinite(activities), activities, 37000),
+            'branching_ratios': np.where(np.isfinite(branching), branching, 1.0)}
+
+def detector_geometry(detector):
+    """crystal shape and source distance from the detector's profile (detector_profiles/), the old numbers if it has none"""
+    try:
+        return profiles.load_profile(detector).geometry or {'area_m2': 0.00196, 'distance_m': 0.10}
+    except FileNotFoundError:
+        return {'area_m2': 0.00196, 'distance_m': 0.10}
+
+def main(data, detector, cache_path=None, model_path=None):
 
-    table = pd.read_csv(data)
+    #fits that failed in spectrum_reader.py are left out
+    table = pd.read_csv(data).dropna(subset=["amp"])
       
     # Your measured data
     energies = table["energy"]
     count_rates = table["amp"]
     
-    source_info = {'activity_Bq': 37000,'branching_ratios': None}  #branching_ratios =  np.array([0.359, 0.856, 0.620])
-    detector_geom = {'area_m2': 0.00196, 'distance_m': 0.10}
+    source_info = line_source_info(table)
+    detector_geom = detector_geometry(detector)
     
-    results = compute_efficiencies(
+    run = lambda: compute_efficiencies(
         energies=energies,
         count_rates=count_rates,
         source_info=source_info,
@@ -122,7 +170,23 @@ def main(data, detector):
         angles_deg=[0, 15, 30, 45, 60],
         plot=True
     )
+
+    if cache_path:
+        #efficiency node: keyed on the csv, the source/geometry numbers and the efficiency code, skipped if none of them changed
+        cache = fit_cache.FitCache(cache_path)
+        key = fit_cache.make_key("efficiency", detector, fit_cache.file_fingerprint(data), source_info, detector_geom,
+                                 fit_cache.code_fingerprint(sys.modules[__name__], geometry, nuclides, efficiency_model))
+        results = cache.cached("efficiency", key, run)
+        cache.save()
+    else:
+        results = run()
     
+    #saving the fitted curve for other scripts (see efficiency_model.py) when asked, with an offset per measured angle
+    if model_path:
+        model = efficiency_model.EfficiencyModel.fit(detector, results['energies_keV'], results['intrinsic_efficiency'],
+                                                     table["angle"] if "angle" in table else None)
+        model.save(model_path)
+
     print("\n" + "="*60)
     print(f"EFFICIENCY RESULTS FOR {detector} DETECTOR")
     print("="*60)
@@ -136,8 +200,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''This script will find intrinsic and absolute efficiencies by energy using provided detector results''')
     parser.add_argument('data', type = str, help = "csv of data from spectrum_reader", default = None)
     parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--cache', type = str, help = "cache file for incremental runs", default = None)
+    parser.add_argument('--model', type = str, help = "json file to save the efficiency curve to (e.g. <detector>_efficiency.json), not saved without it", default = None)
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
-    main(args.data, args.detector)
+    if args.profile:
+        profiling.enable()
+    main(args.data, args.detector, args.cache, args.model)
+    if args.profile:
+        profiling.finish(args.profile, args.profile_format)
 
 
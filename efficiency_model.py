@@ -0,0 +1,157 @@
+"""
+efficiency_model.py
+
+Fitted efficiency curve of a detector, saved to a json file so other scripts can evaluate it without refitting.
+
+The model is the same curve efficiencies.py plots, a polynomial in log energy:
+    ln eps(E) = c0 ln(E)^2 + c1 ln(E) + c2          (highest power first, like np.polyfit)
+fitted to the angle 0 efficiencies, with the covariance of the coefficients kept for an uncertainty band. For
+angled measurements each angle gets an offset in ln eps (the mean residual of its points from the curve), and
+angles in between are interpolated, so eps(E, angle) = eps(E) * exp(offset(angle)). The polynomial goes wild outside
+the energies it was fitted to, so energies outside energy_range come back NaN unless extrapolate=True is asked for.
+
+Evaluating is a few numpy operations on the whole energy array, so millions of energies take one call:
+    model = efficiency_model.EfficiencyModel.load("BGO_efficiency.json")
+    eps, low, high = model.band(np.linspace(50, 1500, 10**6), angles=45)
+"""
+import json
+
+import numpy as np
+
+
+class EfficiencyModel:
+    """
+    Efficiency curve of one detector
+        detector: detector name
+        coefficients: polynomial coefficients of ln eps in ln E (highest power first)
+        covariance: covariance matrix of the coefficients (NaN if there were too few points to estimate it)
+        angles_deg, angle_offsets, angle_errors: ln eps offset (and its error) at each measured angle, 0 at angle 0
+        energy_range: lowest and highest energy (keV) the curve was fitted to
+    """
+
+    def __init__(self, detector, coefficients, covariance, angles_deg=(0.0,), angle_offsets=(0.0,),
+                 angle_errors=(0.0,), energy_range=(np.nan, np.nan)):
+        self.detector = detector
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.covariance = np.asarray(covariance, dtype=float)
+        self.angles_deg = np.asarray(angles_deg, dtype=float)
+        self.angle_offsets = np.asarray(angle_offsets, dtype=float)
+        self.angle_errors = np.asarray(angle_errors, dtype=float)
+        self.energy_range = tuple(float(energy) for energy in energy_range)
+
+    @property
+    def degree(self):
+        return len(self.coefficients) - 1
+
+    @classmethod
+    def fit(cls, detector, energies, efficiencies, angles_deg=None, degree=2):
+        """
+        Function to fit the model
+        Inputs: detector name, energies (keV), efficiencies, angle (deg) of each point (default all 0), polynomial degree
+        Output: EfficiencyModel
+        """
+        energies = np.asarray(energies, dtype=float)
+        efficiencies = np.asarray(efficiencies, dtype=float)
+        angles_deg = np.zeros_like(energies) if angles_deg is None else np.asarray(angles_deg, dtype=float)
+
+        good = (energies > 0) & (efficiencies > 0) & np.isfinite(efficiencies)
+        energies, efficiencies, angles_deg = energies[good], efficiencies[good], angles_deg[good]
+        #the curve comes from the angle 0 points (or every point if there aren't any)
+        base = angles_deg == 0 if np.any(angles_deg == 0) else np.ones(len(energies), dtype=bool)
+        x, y = np.log(energies[base]), np.log(efficiencies[base])
+        degree = min(degree, len(x) - 1)
+        if degree < 0:
+            raise ValueError(f"no usable efficiencies to fit for {detector}")
+
+        vander = np.vander(x, degree + 1)
+        coefficients, _, _, _ = np.linalg.lstsq(vander, y, rcond=None)
+        dof = len(x) - degree - 1
+        if dof > 0:
+            residual_variance = np.sum((y - vander @ coefficients)**2) / dof
+            covariance = np.linalg.pinv(vander.T @ vander) * residual_variance
+        else:
+            covariance = np.full((degree + 1, degree + 1), np.nan)
+
+        model = cls(detector, coefficients, covariance, energy_range=(energies.min(), energies.max()))
+
+        #angle offsets: mean residual of each angle's points from the angle 0 curve
+        residuals = np.log(efficiencies) - model.log_efficiency(energies)[0]
+        angles = np.unique(np.concatenate([[0.0], angles_deg]))
+        offsets, errors = [], []
+        for angle in angles:
+            points = residuals[angles_deg == angle]
+            if angle == 0 or len(points) == 0:
+                offsets.append(0.0)
+                errors.append(0.0)
+            else:
+                offsets.append(float(points.mean()))
+                errors.append(float(points.std(ddof=1) / np.sqrt(len(points))) if len(points) > 1 else 0.0)
+        model.angles_deg, model.angle_offsets, model.angle_errors = angles, np.array(offsets), np.array(errors)
+
+        return model
+
+    def log_efficiency(self, energies, angles_deg=0.0, extrapolate=False):
+        """
+        Function to evaluate ln eps and its standard error
+        Inputs: energies (keV), angles (deg), any shapes that broadcast together, whether to evaluate the curve outside
+                energy_range
+        Output: ln eps, sigma of ln eps (both in the broadcast shape, NaN outside energy_range unless extrapolating)
+        """
+        energies, angles_deg = np.broadcast_arrays(np.asarray(energies, dtype=float), np.asarray(angles_deg, dtype=float))
+        x = np.log(energies)
+
+        #Horner's rule, one pass over the coefficients for the whole array
+        value = np.full(x.shape, self.coefficients[0])
+        for coefficient in self.coefficients[1:]:
+            value = value * x + coefficient
+
+        powers = x[..., None] ** np.arange(self.degree, -1, -1)
+        variance = np.einsum("...i,ij,...j->...", powers, self.covariance, powers)
+
+        if len(self.angles_deg) > 1:
+            value = value + np.interp(angles_deg, self.angles_deg, self.angle_offsets)
+            variance = variance + np.interp(angles_deg, self.angles_deg, self.angle_errors)**2
+
+        sigma = np.sqrt(np.clip(variance, 0, None))
+        if not extrapolate:
+            #a NaN range (a model saved without one) doesn't mask anything
+            low, high = self.energy_range
+            outside = (energies < low) | (energies > high)
+            value, sigma = np.where(outside, np.nan, value), np.where(outside, np.nan, sigma)
+
+        return value, sigma
+
+    def __call__(self, energies, angles_deg=0.0, extrapolate=False):
+        """efficiency at the energies (keV) and angles (deg), NaN outside energy_range unless extrapolating"""
+        return np.exp(self.log_efficiency(energies, angles_deg, extrapolate)[0])
+
+    def band(self, energies, angles_deg=0.0, n_sigma=1.0, extrapolate=False):
+        """
+        Function to evaluate the efficiency with an uncertainty band
+        Inputs: energies (keV), angles (deg), width of the band in standard errors, whether to evaluate the curve
+                outside energy_range
+        Output: efficiency, lower edge, upper edge of the band (NaN outside energy_range unless extrapolating)
+        """
+        value, sigma = self.log_efficiency(energies, angles_deg, extrapolate)
+        return np.exp(value), np.exp(value - n_sigma * sigma), np.exp(value + n_sigma * sigma)
+
+    def to_dict(self):
+        """the model as a json friendly dictionary"""
+        return {"detector": self.detector, "coefficients": self.coefficients.tolist(),
+                "covariance": np.where(np.isfinite(self.covariance), self.covariance, None).tolist(),
+                "angles_deg": self.angles_deg.tolist(), "angle_offsets": self.angle_offsets.tolist(),
+                "angle_errors": self.angle_errors.tolist(), "energy_range": list(self.energy_range)}
+
+    def save(self, path):
+        """writes the model to a json file"""
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """reads a model written by save"""
+        with open(path, "r") as file:
+            config = json.load(file)
+        covariance = np.array([[np.nan if value is None else value for value in row] for row in config["covariance"]])
+        return cls(config["detector"], config["coefficients"], covariance, config["angles_deg"],
+                   config["angle_offsets"], config["angle_errors"], config["energy_range"])
@@ -0,0 +1,159 @@
+"""
+fit_cache.py
+
+Content-hash cache for the incremental mode of spectrum_reader.py (and the resolution/efficiency scripts downstream).
+
+Every fit is stored under a key built from:
+    1. sha256 of the data spectrum file
+    2. sha256 of the background file
+    3. the ROI (peak range) the fit was done in
+    4. a fingerprint of the code that does the fitting
+
+So if you edit one entry in `ranges` or drop a new angled file into a folder, only the fits whose key changed get
+redone, everything else is read back from the cache file. Downstream steps (calibration, resolution, efficiency)
+are cached as "nodes" keyed on the hash of their inputs, so they only rerun if something upstream actually changed.
+
+How to use: pass --cache path/to/cache.json to spectrum_reader.py, resolution.py or efficiencies.py
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import archives
+
+#bump this if the layout of the cache file changes so old caches get thrown out
+CACHE_VERSION = 1
+
+#(path, archive member, size, mtime) -> sha256, so a file is only hashed once per process
+_file_hashes = {}
+
+
+def file_fingerprint(path):
+    """
+    Function to hash the contents of a file
+    Input: path to a file (or a member of an archive, "archive::member")
+    Output: sha256 hex digest of the file bytes
+    """
+    container, member = archives.split_member(path)
+    stat = os.stat(container)
+    stamp = (os.path.abspath(container), member, stat.st_size, stat.st_mtime_ns)
+    if stamp not in _file_hashes:
+        digest = hashlib.sha256()
+        if member is None:
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+        else:
+            digest.update(archives.read_bytes(path))
+        _file_hashes[stamp] = digest.hexdigest()
+
+    return _file_hashes[stamp]
+
+
+def code_fingerprint(*modules):
+    """
+    Function to fingerprint the source of the modules that do the fitting, so editing the fit code invalidates the cache
+    Input: module objects
+    Output: sha256 hex digest
+    """
+    digest = hashlib.sha256(str(CACHE_VERSION).encode())
+    for module in modules:
+        digest.update(file_fingerprint(module.__file__).encode())
+
+    return digest.hexdigest()
+
+
+def _jsonable(value):
+    """converts numpy/pandas things into plain python so they can be hashed and saved"""
+    if isinstance(value, range):
+        return [value.start, value.stop, value.step]
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def make_key(*parts):
+    """
+    Function to make a cache key out of anything json-able (strings, numbers, ranges, arrays, dicts)
+    Output: sha256 hex digest of the parts
+    """
+    text = json.dumps(_jsonable(list(parts)), sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class FitCache:
+    """
+    Small json-backed key value store for fit results.
+    Entries are grouped by node ("fit", "calibration", "resolution", "efficiency").
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as file:
+                stored = json.load(file)
+            if stored.get("version") == CACHE_VERSION:
+                self.entries = stored.get("entries", {})
+
+    def get(self, node, key):
+        """returns the stored value for a key or None if it isn't there"""
+        entry = self.entries.get(node, {}).get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, node, key, value):
+        """stores a value under a key"""
+        self.entries.setdefault(node, {})[key] = _jsonable(value)
+
+    def cached(self, node, key, compute):
+        """
+        Function to get a value out of the cache or compute and store it if it isn't there
+        Inputs: node name, key, function with no arguments that computes the value
+        Output: the (possibly cached) value
+        """
+        value = self.get(node, key)
+        if value is None:
+            value = compute()
+            self.put(node, key, value)
+            value = self.entries[node][key]
+        return value
+
+    def save(self):
+        """writes the cache to disk, through a temp file so a crash can't leave half a cache behind"""
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, file)
+        os.replace(tmp_path, self.path)
+
+
+def write_if_changed(table, csv_name):
+    """
+    Function to only rewrite a csv when its contents changed, so anything keyed on the csv downstream stays valid
+    Inputs: pandas dataframe, name of the csv
+    Output: True if the file was (re)written
+    """
+    text = table.to_csv(index=False)
+    if os.path.exists(csv_name):
+        with open(csv_name, "r") as file:
+            if file.read() == text:
+                return False
+    with open(csv_name, "w") as file:
+        file.write(text)
+    return True
@@ -0,0 +1,165 @@
+"""
+fit_scheduler.py
+
+Runs the peak fits for make_results_dict so that one bad spectrum can't kill a whole run.
+
+Every fit gets a budget (max number of function evaluations and max wall clock seconds). If a fit fails or runs
+out of budget it is retried with the next strategy of the escalation policy:
+    1. default: gauss_fitter as normal
+    2. alternate guess: start the fit from the highest point in the window instead of the weighted mean
+    3. narrow window: half the window, centred on the highest point
+    4. wide window: the window made 50% bigger on each side
+    5. simple model: a gaussian on a straight line instead of a quadratic
+COARSE_TO_FINE_POLICY puts a coarse to fine fit (spectrum_reader.coarse_to_fine_fitter) in front of these.
+A strategy only counts as working if its peak is plausible: centroid inside the ROI, width above 0 and no wider than
+the ROI, amplitude above 0. Anything else goes on to the next strategy. The model only depends on sigma squared, so
+sigma is kept as its magnitude.
+If every strategy fails, the fit comes back as a "failed" record (NaN results plus the error) instead of raising,
+and the rest of the batch carries on.
+"""
+import time
+
+import numpy as np
+
+import profiling
+import spectrum_reader
+
+DEFAULT_POLICY = ("default", "alternate guess", "narrow window", "wide window", "simple model")
+COARSE_TO_FINE_POLICY = ("coarse to fine",) + DEFAULT_POLICY
+
+
+class FitTimeout(RuntimeError):
+    """raised inside curve_fit when a fit goes over its wall clock budget"""
+
+
+class FitBudget:
+    """
+    Budget for a single fit attempt
+        maxfev: max number of model evaluations curve_fit may use
+        seconds: max wall clock time of one attempt
+    """
+
+    def __init__(self, maxfev=2000, seconds=5.0):
+        self.maxfev = maxfev
+        self.seconds = seconds
+
+
+def simple_model(x, mu, sig, amp, b, c):
+    """A Gaussian on a straight line, the fallback when the quadratic baseline won't converge"""
+    return spectrum_reader.gaussian(x, mu, sig, amp) + b * x + c
+
+
+def _with_deadline(model, seconds):
+    """wraps a model so curve_fit gets stopped (by FitTimeout) once the wall clock budget is used up"""
+    deadline = time.perf_counter() + seconds
+
+    def timed_model(x, *params):
+        if time.perf_counter() > deadline:
+            raise FitTimeout(f"fit went over its {seconds} s budget")
+        return model(x, *params)
+
+    timed_model.__name__ = model.__name__
+    timed_model.jacobian = getattr(model, "jacobian", None)
+    return timed_model
+
+
+def _peak_guess(x, y, model):
+    """initial guess for a model, starting from the highest point of the window"""
+    top = int(np.argmax(y))
+    sigma = max((x[-1] - x[0]) / 20, 1.0)
+    amp = (y[top] - np.min(y)) * np.sqrt(2 * np.pi) * sigma
+    if model is simple_model:
+        return [x[top], sigma, amp, 0.0, float(np.min(y))]
+    return [x[top], sigma, amp, 0.0, 0.0, float(np.min(y))]
+
+
+def _window(peak_range, table, strategy):
+    """window of channels to fit for a strategy"""
+    peak_range = np.asarray(peak_range)
+    if strategy == "narrow window":
+        top = peak_range[np.argmax(np.asarray(table["counts/sec"])[peak_range])]
+        half = max(len(peak_range) // 4, 3)
+        return np.arange(max(top - half, 0), min(top + half + 1, len(table)))
+    if strategy == "wide window":
+        extra = max(len(peak_range) // 2, 1)
+        return np.arange(max(peak_range[0] - extra, 0), min(peak_range[-1] + extra + 1, len(table)))
+    return peak_range
+
+
+def attempt(table, peak_range, strategy, budget):
+    """
+    Function to do one fit attempt with a strategy
+    Inputs: background subtracted table, channel window, strategy name, FitBudget
+    Output: mu, sigma, amp
+    """
+    window = _window(peak_range, table, strategy)
+    model = simple_model if strategy == "simple model" else spectrum_reader.compound_model
+
+    if strategy == "coarse to fine":
+        return spectrum_reader.coarse_to_fine_fitter(table, window, None, _with_deadline(model, budget.seconds), maxfev=budget.maxfev)
+
+    p0 = None
+    if strategy in ("alternate guess", "simple model"):
+        p0 = _peak_guess(np.asarray(table["bins"])[window], np.asarray(table["counts/sec"])[window], model)
+
+    return spectrum_reader.gauss_fitter(table, window, p0, _with_deadline(model, budget.seconds), maxfev=budget.maxfev)
+
+
+def implausible(table, peak_range, mu, sig, amp):
+    """
+    Function to check a fitted peak makes sense for its ROI
+    Inputs: background subtracted table, channel window (the ROI, not the strategy's window), fitted mu, sigma, amp
+    Output: why the peak can't be right, or None if it's fine
+    """
+    if not np.all(np.isfinite([mu, sig, amp])):
+        return "fit returned non-finite parameters"
+    x = np.asarray(table["bins"], dtype=float)[np.asarray(peak_range)]
+    low, high = np.min(x), np.max(x)
+    if not low <= mu <= high:
+        return f"centroid {mu:.6g} outside the ROI {low:g}-{high:g}"
+    if sig <= 0:
+        return f"sigma {sig:.6g} not above 0"
+    if sig > high - low:
+        return f"sigma {sig:.6g} wider than the ROI ({high - low:g} channels)"
+    if amp <= 0:
+        return f"amplitude {amp:.6g} not above 0"
+    return None
+
+
+def failed_record(error, attempts=0, status="failed"):
+    """record for a fit that couldn't be done (status "rejected" for spectra stopped by the quality checks)"""
+    return {"mu": np.nan, "sig": np.nan, "amp": np.nan, "status": status, "attempts": attempts,
+            "error": f"{type(error).__name__}: {error}", "quality": ""}
+
+
+def schedule_fit(table, peak_range, budget=None, policy=DEFAULT_POLICY):
+    """
+    Function to fit a peak, retrying with the escalation policy until a strategy works
+    Inputs: background subtracted table, channel window, FitBudget, list of strategies to try in order
+    Output: dictionary with mu, sig, amp, status ("ok", "retried: <strategy>" or "failed"), attempts, error,
+            quality (left empty here, filled in with quality.py flags by the caller)
+    """
+    budget = budget or FitBudget()
+    error = None
+    for n, strategy in enumerate(policy, start=1):
+        try:
+            mu, sig, amp = attempt(table, peak_range, strategy, budget)
+        except (RuntimeError, ValueError, TypeError, np.linalg.LinAlgError) as exc:
+            #RuntimeError covers "optimal parameters not found" and FitTimeout
+            error = exc
+            profiling.count("fit retries")
+            continue
+
+        sig = np.abs(sig)
+        reason = implausible(table, peak_range, mu, sig, amp)
+        if reason is not None:
+            error = ValueError(reason)
+            profiling.count("fit retries")
+            continue
+
+        status = "ok" if n == 1 else f"retried: {strategy}"
+        return {"mu": float(mu), "sig": float(sig), "amp": float(amp), "status": status, "attempts": n, "error": "",
+                "quality": ""}
+
+    profiling.count("fit failures")
+    return failed_record(error, len(policy))
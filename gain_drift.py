@@ -0,0 +1,230 @@
+"""
+gain_drift.py
+
+Tracks drift of a detector's channel-energy relation between acquisitions, without fitting any peaks.
+
+Each spectrum of a source is compared to a reference spectrum of the same source (by default the earliest one, going by
+the DATE_MEAS/START_TIME in the headers) to estimate the gain and offset that map its channels onto the reference's:
+    reference channel = gain * channel + offset
+How:
+    1. both spectra are turned into peak-only signals: sqrt of the counts minus a running mean (to take out the
+       continuum), divided by a running rms so every peak has about the same height (otherwise the strongest line, often
+       a low energy one that says little about the gain, decides everything)
+    2. gain and offset are searched together: the spectrum is rescaled by every gain on a grid (steps of about a
+       channel at the top of the spectrum) and one FFT cross-correlation per gain scores every offset at once. Only the
+       channels both spectra actually have are compared (masked, normalised correlation), so the threshold edge and
+       the channels moved off the end don't count against the right answer
+    3. the best gain and offset are refined to a fraction of a step with parabolas through the neighbouring scores
+A spectrum with a single line can't pin down a gain and an offset, and a different source can line up by chance, so an
+estimate is only trusted if its correlation is at least MIN_CORRELATION and no gain more than GAIN_SEPARATION away
+scores within MAX_AMBIGUITY of it. A spectrum is flagged for recalibration when a trusted drift moves any ROI centre
+of the detector profile by more than the tolerance (channels); flagged spectra get their ROIs moved by shifted_rois
+before fitting (spectrum_reader.py --drift-tolerance 3). Untrusted estimates leave the ROIs where they are.
+
+How to use:
+    python gain_drift.py BGO_detector/Am_angled BGO --source Am --tolerance 3
+"""
+import argparse
+
+import numpy as np
+from scipy import fft
+from scipy.ndimage import uniform_filter1d
+
+import catalog
+import profiles
+import spectrum_reader
+
+MIN_CHANNEL = 8
+SMOOTHING = 151
+#running rms window (channels) every peak is scaled by
+PEAK_NORMALISATION = 101
+MAX_GAIN_CHANGE = 0.3
+MAX_OFFSET = 64
+#trust checks: lowest correlation, and highest score (relative to the best) of a gain more than GAIN_SEPARATION away
+MIN_CORRELATION = 0.4
+GAIN_SEPARATION = 0.03
+MAX_AMBIGUITY = 0.85
+#how much of the reference has to be compared for a score to count, and gains scored per batch of FFTs
+MIN_OVERLAP = 0.5
+GAIN_BATCH = 128
+
+
+def peak_signal(counts, min_channel=MIN_CHANNEL, smoothing=SMOOTHING, normalisation=PEAK_NORMALISATION):
+    """
+    Function to turn a spectrum into a signal that's (roughly) just its peaks, each about the same height
+    Inputs: counts per channel, channels to zero at the start (noise/threshold edge), running mean width (channels),
+            running rms width (channels)
+    Output: 1d float array, same length as counts
+    """
+    signal = np.sqrt(np.clip(np.asarray(counts, dtype=float), 0, None))
+    signal = signal - uniform_filter1d(signal, smoothing, mode="nearest")
+    signal[:min_channel] = 0
+    signal = np.clip(signal, 0, None)
+    rms = np.sqrt(np.clip(uniform_filter1d(signal**2, normalisation, mode="nearest"), 0, None))
+    return signal / np.maximum(rms, 1e-6 * np.max(rms, initial=0) + 1e-30)
+
+
+def _vertex(left, centre, right):
+    """fractional position (-0.5 to 0.5) of the top of the parabola through three equally spaced points"""
+    denominator = left - 2 * centre + right
+    return float(np.clip(0.5 * (left - right) / denominator, -0.5, 0.5)) if denominator < 0 else 0.0
+
+
+def correlation_surface(reference, signal, gains, max_offset=MAX_OFFSET, min_channel=MIN_CHANNEL):
+    """
+    Function to score every gain and offset of a spectrum against a reference
+    Inputs: peak_signal of the reference and of the spectrum (same length), gains to try, largest offset (channels),
+            first channel of the signals that counts
+    Output: offsets (channels), (gains x offsets) normalised correlation of the channels both signals have (0 where
+            less than MIN_OVERLAP of the reference is compared)
+    """
+    n = len(signal)
+    channels = np.arange(n, dtype=float)
+    size = fft.next_fast_len(n + max_offset + 1, real=True)
+    offsets = np.concatenate([np.arange(0, max_offset + 1), np.arange(-max_offset, 0)])
+
+    reference_mask = (channels >= min_channel).astype(float)
+    reference = np.asarray(reference, dtype=float) * reference_mask
+    reference_fft = fft.rfft(reference, size)
+    reference_energy_fft = fft.rfft(reference**2, size)
+    mask_fft = fft.rfft(reference_mask, size)
+    enough = MIN_OVERLAP * np.sum(reference**2)
+
+    def correlate(first_fft, second):
+        #sum over r of first(r) second(r - offset), for every row of second
+        return fft.irfft(first_fft[None, :] * np.conj(fft.rfft(second, size, axis=1)), size, axis=1)[:, offsets]
+
+    scores = []
+    for start in range(0, len(gains), GAIN_BATCH):
+        #value at reference channel r of the spectrum rescaled by each gain is the spectrum at r / gain
+        positions = channels[None, :] / np.asarray(gains[start:start + GAIN_BATCH])[:, None]
+        low = np.clip(np.floor(positions).astype(int), 0, n - 2)
+        fraction = positions - low
+        valid = (positions >= min_channel) & (positions <= n - 1)
+        rows = np.where(valid, signal[low] * (1 - fraction) + signal[low + 1] * fraction, 0.0)
+
+        products = correlate(reference_fft, rows)
+        reference_energy = correlate(reference_energy_fft, valid.astype(float))
+        row_energy = correlate(mask_fft, rows**2)
+        score = products / np.sqrt(np.maximum(reference_energy * row_energy, 1e-300))
+        scores.append(np.where(reference_energy >= enough, score, 0.0))
+
+    return offsets, np.concatenate(scores)
+
+
+def align_counts(counts, gain, offset):
+    """
+    Function to rebin a spectrum onto the reference's channels, keeping the total number of counts
+    Inputs: counts per channel, gain and offset from estimate_drift
+    Output: float counts per reference channel (counts moved past either end are dropped)
+    """
+    counts = np.asarray(counts, dtype=float)
+    edges = np.arange(len(counts) + 1) - 0.5
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)])
+    #cumulative counts at the reference's channel edges, read off the spectrum's edges mapped onto the reference
+    return np.diff(np.interp(edges, gain * edges + offset, cumulative))
+
+
+def estimate_drift(reference_signal, signal):
+    """
+    Function to estimate the gain and offset between two spectra
+    Inputs: peak_signal of the reference and of the spectrum (same number of channels)
+    Output: gain, offset with reference channel = gain * channel + offset, correlation there, and whether the estimate
+            can be trusted (see the trust checks at the top); untrusted estimates come back as gain 1, offset 0
+    """
+    signal = np.asarray(signal, dtype=float)
+    #log spaced gains, a step moves the last channel by about one channel
+    step = 1.0 / len(signal)
+    limit = np.log(1 + MAX_GAIN_CHANGE)
+    log_gains = np.arange(-limit, limit + step / 2, step)
+    offsets, scores = correlation_surface(reference_signal, signal, np.exp(log_gains))
+
+    row, column = np.unravel_index(int(np.argmax(scores)), scores.shape)
+    correlation = float(scores[row, column])
+    best_per_gain = scores.max(axis=1)
+    others = best_per_gain[np.abs(log_gains - log_gains[row]) > GAIN_SEPARATION]
+    ambiguity = float(others.max()) / correlation if len(others) and correlation > 0 else 0.0
+    if correlation < MIN_CORRELATION or ambiguity > MAX_AMBIGUITY:
+        return 1.0, 0.0, correlation, False
+
+    log_gain, offset = log_gains[row], float(offsets[column])
+    if 0 < row < len(log_gains) - 1:
+        log_gain += step * _vertex(*scores[row - 1:row + 2, column])
+    if abs(offsets[column]) < MAX_OFFSET:
+        #offsets go 0, 1, ... MAX_OFFSET, -MAX_OFFSET, ... -1, so the neighbours wrap around
+        line = scores[row]
+        offset += _vertex(line[column - 1], line[column], line[(column + 1) % len(line)])
+    return float(np.exp(log_gain)), offset, correlation, True
+
+
+def roi_shifts(profile, gain, offset, rois=None):
+    """how far (channels) each ROI centre of a profile (or just the ROIs listed) moves in a spectrum with this drift"""
+    rois = slice(None) if rois is None else list(rois)
+    centres = (profile.roi_starts[rois] + profile.roi_stops[rois]) / 2
+    return (centres - offset) / gain - centres
+
+
+def shifted_rois(profile, gain, offset, n_channels):
+    """
+    Function to move a profile's ROIs onto a drifted spectrum
+    Inputs: DetectorProfile, gain and offset from estimate_drift, channels in the spectrum
+    Output: tuple of channel index arrays, one per ROI (same order as profile.roi_index)
+    """
+    starts = np.clip(np.round((profile.roi_starts - offset) / gain), 0, n_channels - 1).astype(int)
+    stops = np.clip(np.round((profile.roi_stops - offset) / gain), 1, n_channels).astype(int)
+    return tuple(np.arange(start, max(stop, start + 1)) for start, stop in zip(starts, stops))
+
+
+def track_drift(rows, profile, reference=None, tolerance=3.0):
+    """
+    Function to estimate the drift of every spectrum of a source against a reference, one spectrum in memory at a time
+    Inputs:
+        rows: catalog rows (catalog.select) of the spectra of one source
+        profile: DetectorProfile, the tolerance is checked on the ROIs of the source
+        reference: path of the reference spectrum (default: the earliest spectrum)
+        tolerance: largest ROI shift (channels) before a spectrum is flagged for recalibration
+    Output: dataframe in time order with path, date_meas, channels, gain, offset, correlation, trusted, max_shift
+            (channels), recalibrate (only trusted estimates are recalibrated)
+    """
+    rows = rows.reset_index().sort_values(["date_meas", "path"], kind="stable")
+    reference = rows["path"].iloc[0] if reference is None else reference
+    rois = profile.source_rois[profile.sources.index(rows["source"].iloc[0])]
+    reference_signal = peak_signal(spectrum_reader.file_parser(reference)[1]["counts"])
+
+    drifts = {"channels": [], "gain": [], "offset": [], "correlation": [], "trusted": [], "max_shift": []}
+    for path in rows["path"]:
+        counts = spectrum_reader.file_parser(path)[1]["counts"]
+        signal = peak_signal(counts)
+        if len(signal) != len(reference_signal):
+            raise ValueError(f"{path} has {len(signal)} channels, the reference has {len(reference_signal)}")
+
+        gain, offset, correlation, trusted = estimate_drift(reference_signal, signal)
+        drifts["channels"].append(len(signal))
+        drifts["gain"].append(gain)
+        drifts["offset"].append(offset)
+        drifts["correlation"].append(correlation)
+        drifts["trusted"].append(trusted)
+        drifts["max_shift"].append(float(np.max(np.abs(roi_shifts(profile, gain, offset, rois)))))
+
+    table = rows[["path", "date_meas"]].assign(**drifts)
+    table["recalibrate"] = table["trusted"] & (table["max_shift"] > tolerance)
+    return table.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will estimate the gain drift of a detector's spectra over time''')
+    parser.add_argument('data_path', type = str, help = "path to the folder with data files", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--source', type = str, nargs = "+", help = "sources to check (default: every source of the profile)", default = None)
+    parser.add_argument('--reference', type = str, help = "spectrum to measure drift against (default: the earliest)", default = None)
+    parser.add_argument('--tolerance', type = float, help = "ROI shift (channels) that needs a recalibration", default = 3.0)
+    args = parser.parse_args()
+
+    detector_profile = profiles.load_profile(args.detector)
+    files = catalog.build_catalog(args.data_path, recursive=False)
+    for source in args.source or detector_profile.sources:
+        source_rows = catalog.select(files, source=source, fmt=detector_profile.format)
+        if len(source_rows) == 0:
+            continue
+        print(f"\n{source}:")
+        print(track_drift(source_rows, detector_profile, args.reference, args.tolerance).to_string(index=False))
@@ -0,0 +1,256 @@
+"""
+geometry.py
+
+Solid angle of a detector crystal seen from a point source, for the geometric factor in efficiencies.py.
+
+Instead of the point approximation A * cos(angle) / (4 pi d^2), the solid angle is integrated over the surface of the
+crystal facing the source:
+    disk: a flat crystal face of radius r
+    cylinder: a crystal of radius r and length L (front face, back face and curved side, whichever face the source)
+The source sits a distance d from the centre of the front face, moved sideways by an offset, with the crystal's axis
+tilted by an angle (the "angle" of the angled measurements). The integral uses a fixed Gauss-Legendre quadrature, so
+it's plain numpy broadcasting over any grid of distances, angles and offsets at once.
+
+Because the integral still costs a few thousand points per geometry, the results are memoised: GeometryTable computes
+the solid angle once on a (distance, angle, offset) grid for a detector geometry, saves it as an .npz file named after
+the geometry, and afterwards any number of geometry points is an interpolation in that table. Next to the crystal
+(closer than NEAR_FIELD_SIZES crystal sizes) the solid angle changes too quickly with the angle and offset for the grid,
+so those points are integrated directly instead.
+
+Geometries come from the "geometry" block of a detector profile:
+    "geometry": {"shape": "disk", "radius_m": 0.025, "length_m": 0.0, "distance_m": 0.10}
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geometry_tables")
+TABLE_VERSION = 1
+
+#default grid of the lookup tables
+DISTANCES_M = np.geomspace(0.01, 1.0, 41)
+ANGLES_DEG = np.linspace(0.0, 180.0, 73)
+OFFSETS_M = np.linspace(-0.1, 0.1, 21)
+#geometry points x quadrature points worked on at once by solid_angle
+CHUNK_ELEMENTS = 2**22
+#sources closer than this many crystal sizes (Geometry.size_m) are integrated directly instead of looked up, with this
+#many radial, azimuthal and length quadrature points
+NEAR_FIELD_SIZES = 2.0
+NEAR_FIELD_QUADRATURE = (48, 128, 48)
+
+
+class Geometry:
+    """
+    Shape of a detector crystal
+        shape: "disk" or "cylinder"
+        radius_m: crystal radius (m)
+        length_m: crystal length along its axis (m), only used for cylinders
+    """
+
+    def __init__(self, shape="disk", radius_m=0.025, length_m=0.0):
+        if shape not in ("disk", "cylinder"):
+            raise ValueError(f"unknown crystal shape {shape!r}, use disk or cylinder")
+        self.shape = shape
+        self.radius_m = float(radius_m)
+        self.length_m = float(length_m) if shape == "cylinder" else 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """makes a Geometry from a profile's geometry block (extra keys such as distance_m are ignored)"""
+        return cls(config.get("shape", "disk"), config["radius_m"], config.get("length_m", 0.0))
+
+    @property
+    def area_m2(self):
+        """area of the front face"""
+        return np.pi * self.radius_m**2
+
+    @property
+    def size_m(self):
+        """largest dimension of the crystal (its diameter or its length)"""
+        return max(2 * self.radius_m, self.length_m)
+
+    def key(self):
+        """short hash of the geometry, used to name its lookup table"""
+        text = json.dumps([TABLE_VERSION, self.shape, self.radius_m, self.length_m])
+        return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def _gauss_legendre(n, low, high):
+    """Gauss-Legendre nodes and weights on [low, high]"""
+    nodes, weights = np.polynomial.legendre.leggauss(n)
+    return low + (nodes + 1) * (high - low) / 2, weights * (high - low) / 2
+
+
+def _surface_points(geometry, n_radial, n_azimuthal, n_length):
+    """
+    Function to make quadrature points on the surface of a crystal in its own frame (axis along z, front face at z=0)
+    Output: points (N x 3), outward normals (N x 3), area weights (N)
+    """
+    phi = 2 * np.pi * np.arange(n_azimuthal) / n_azimuthal
+    dphi = 2 * np.pi / n_azimuthal
+    rho, w_rho = _gauss_legendre(n_radial, 0.0, geometry.radius_m)
+
+    #flat faces: dA = rho drho dphi
+    rr, pp = np.meshgrid(rho, phi, indexing="ij")
+    face = np.stack([rr * np.cos(pp), rr * np.sin(pp), np.zeros_like(rr)], axis=-1).reshape(-1, 3)
+    face_weights = np.repeat(w_rho * rho * dphi, n_azimuthal)
+
+    #front and back faces (the same disk for a flat crystal, so it's seen from either side)
+    points = [face, face + [0.0, 0.0, geometry.length_m]]
+    normals = [np.tile([0.0, 0.0, -1.0], (len(face), 1)), np.tile([0.0, 0.0, 1.0], (len(face), 1))]
+    weights = [face_weights, face_weights]
+
+    if geometry.shape == "cylinder":
+        #curved side: dA = r dphi dz
+        z, w_z = _gauss_legendre(n_length, 0.0, geometry.length_m)
+        zz, pp = np.meshgrid(z, phi, indexing="ij")
+        radial = np.stack([np.cos(pp), np.sin(pp), np.zeros_like(pp)], axis=-1).reshape(-1, 3)
+        points.append(radial * geometry.radius_m + np.stack([np.zeros(zz.size), np.zeros(zz.size), zz.ravel()], axis=-1))
+        normals.append(radial)
+        weights.append(np.repeat(w_z * geometry.radius_m * dphi, n_azimuthal))
+
+    return np.concatenate(points), np.concatenate(normals), np.concatenate(weights)
+
+
+def solid_angle(geometry, distance_m, angle_deg=0.0, offset_m=0.0, n_radial=24, n_azimuthal=64, n_length=24):
+    """
+    Function to integrate the solid angle (sr) a crystal covers as seen from a point source
+    Inputs:
+        geometry: Geometry of the crystal
+        distance_m: source to front face centre distance along the beam line (m)
+        angle_deg: tilt of the crystal axis away from the beam line (deg)
+        offset_m: sideways offset of the crystal from the beam line (m), in the plane of the tilt
+        n_radial, n_azimuthal, n_length: quadrature points
+    The three geometry inputs broadcast against each other, e.g. distances[:, None] and angles[None, :] for a grid.
+    Output: solid angle (sr), in the broadcast shape of the inputs (seen from behind past 90 deg)
+    """
+    distance_m, angle, offset_m = np.broadcast_arrays(np.asarray(distance_m, dtype=float),
+                                                      np.deg2rad(np.asarray(angle_deg, dtype=float)),
+                                                      np.asarray(offset_m, dtype=float))
+    points, normals, weights = _surface_points(geometry, n_radial, n_azimuthal, n_length)
+
+    #geometry points x quadrature points, done in chunks so a big grid doesn't need gigabytes at once
+    flat = [distance_m.ravel(), angle.ravel(), offset_m.ravel()]
+    result = np.empty(distance_m.size)
+    chunk = max(1, CHUNK_ELEMENTS // len(weights))
+    for start in range(0, distance_m.size, chunk):
+        d, a, o = (values[start:start + chunk, None] for values in flat)
+
+        #crystal frame -> lab frame (source at the origin, beam line along z): tilt about y, then move the face centre
+        cos, sin = np.cos(a), np.sin(a)
+        x = points[:, 0] * cos + points[:, 2] * sin - o
+        z = -points[:, 0] * sin + points[:, 2] * cos + d
+        nx = normals[:, 0] * cos + normals[:, 2] * sin
+        nz = -normals[:, 0] * sin + normals[:, 2] * cos
+
+        #only the surface facing the source counts (for a convex crystal those parts don't hide each other)
+        facing = -(nx * x + normals[:, 1] * points[:, 1] + nz * z)
+        r3 = (x**2 + points[:, 1]**2 + z**2)**1.5
+        result[start:start + chunk] = np.sum(np.clip(facing, 0, None) / r3 * weights, axis=-1)
+
+    return result.reshape(distance_m.shape)
+
+
+def point_solid_angle(area_m2, distance_m, angle_deg=0.0):
+    """the old point approximation A * cos(angle) / d^2 (sr), vectorised"""
+    return area_m2 * np.cos(np.deg2rad(np.asarray(angle_deg, dtype=float))) / np.asarray(distance_m, dtype=float)**2
+
+
+class GeometryTable:
+    """
+    Lookup table of the solid angle of one geometry on a (distance, angle, offset) grid
+        geometry: the Geometry
+        distances_m, angles_deg, offsets_m: grid axes
+        values: solid angle (sr) on the grid
+    """
+
+    def __init__(self, geometry, distances_m, angles_deg, offsets_m, values):
+        self.geometry = geometry
+        self.distances_m = np.asarray(distances_m, dtype=float)
+        self.angles_deg = np.asarray(angles_deg, dtype=float)
+        self.offsets_m = np.asarray(offsets_m, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        #solid angle * d^2 on a log distance scale is close to flat, so it interpolates well
+        scaled = self.values * self.distances_m[:, None, None]**2
+        self._interpolator = RegularGridInterpolator((np.log(self.distances_m), self.angles_deg, self.offsets_m),
+                                                     scaled, bounds_error=True)
+
+    @classmethod
+    def build(cls, geometry, distances_m=DISTANCES_M, angles_deg=ANGLES_DEG, offsets_m=OFFSETS_M):
+        """integrates the solid angle on every grid point (all at once)"""
+        values = solid_angle(geometry, np.asarray(distances_m)[:, None, None], np.asarray(angles_deg)[None, :, None],
+                             np.asarray(offsets_m)[None, None, :])
+        return cls(geometry, distances_m, angles_deg, offsets_m, values)
+
+    def save(self, path):
+        """writes the table to an .npz file"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, key=self.geometry.key(), shape=self.geometry.shape, radius_m=self.geometry.radius_m,
+                 length_m=self.geometry.length_m, distances_m=self.distances_m, angles_deg=self.angles_deg,
+                 offsets_m=self.offsets_m, values=self.values)
+
+    @classmethod
+    def load(cls, path):
+        """reads a table written by save"""
+        with np.load(path) as data:
+            geometry = Geometry(str(data["shape"]), float(data["radius_m"]), float(data["length_m"]))
+            return cls(geometry, data["distances_m"], data["angles_deg"], data["offsets_m"], data["values"])
+
+    def __call__(self, distance_m, angle_deg=0.0, offset_m=0.0):
+        """
+        Function to look up the solid angle (sr) for any number of geometry points
+        Inputs: distance (m), angle (deg), offset (m), broadcast against each other, inside the table's grid (points
+                closer than NEAR_FIELD_SIZES crystal sizes are integrated with solid_angle instead, anywhere)
+        Output: solid angle in the broadcast shape of the inputs
+        """
+        distance_m, angle_deg, offset_m = np.broadcast_arrays(np.asarray(distance_m, dtype=float),
+                                                              np.asarray(angle_deg, dtype=float),
+                                                              np.asarray(offset_m, dtype=float))
+        values = np.empty(distance_m.shape)
+        near = distance_m < NEAR_FIELD_SIZES * self.geometry.size_m
+        far = ~near
+        if far.any():
+            points = np.stack([np.log(distance_m[far]), angle_deg[far], offset_m[far]], axis=-1)
+            values[far] = self._interpolator(points) / distance_m[far]**2
+        if near.any():
+            values[near] = solid_angle(self.geometry, distance_m[near], angle_deg[near], offset_m[near],
+                                       *NEAR_FIELD_QUADRATURE)
+        return values
+
+
+_tables = {}
+#building a table takes a while, so threads asking for the same one wait for it instead of all building it, with one
+#lock per table so different geometries are built side by side
+_table_locks = {}
+_table_locks_lock = threading.Lock()
+
+
+def load_table(geometry, table_dir=TABLE_DIR):
+    """
+    Function to get the lookup table of a geometry: from memory, else from table_dir, else built and saved there
+    Inputs: Geometry, folder the tables are kept in (None to build it in memory only, nothing is read or written)
+    Output: GeometryTable
+    """
+    key = geometry.key()
+    with _table_locks_lock:
+        lock = _table_locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _tables:
+            path = None if table_dir is None else os.path.join(table_dir, f"{geometry.shape}_{key}.npz")
+            if path is not None and os.path.exists(path):
+                _tables[key] = GeometryTable.load(path)
+            else:
+                _tables[key] = GeometryTable.build(geometry)
+                if path is not None:
+                    _tables[key].save(path)
+        return _tables[key]
+
+
+def geometric_factor(geometry, distance_m, angle_deg=0.0, offset_m=0.0, table_dir=TABLE_DIR):
+    """fraction of the source's emissions that head into the crystal (solid angle / 4 pi), from the lookup table (kept in
+    table_dir, None for memory only)"""
+    return load_table(geometry, table_dir)(distance_m, angle_deg, offset_m) / (4 * np.pi)
@@ -0,0 +1,390 @@
+"""
+global_fit.py
+
+Global fit of a detector: every ROI of every spectrum of one detector fitted at once, instead of one curve_fit per
+peak followed by separate calibration and resolution fits.
+
+Each ROI is a gaussian on a quadratic baseline, like compound_model in spectrum_reader.py, but its centroid and width
+aren't free. They come from laws shared by the whole detector:
+    centroid (channel)  mu = (E - intercept) / slope                      (E = slope * channel + intercept)
+    width (channel)     sigma = E sqrt(a/E^2 + b/E + c) / 2.355 / slope   (R^2 = a/E^2 + b/E + c, resolution.py)
+so each ROI only has its own amplitude and 3 baseline terms, plus 5 shared parameters for the detector. Residuals are
+weighted by the poisson errors of the background subtracted rates.
+
+Each ROI's residuals only depend on its own 4 parameters and the 5 shared ones, so the Jacobian is a sparse block
+matrix. It is worked out analytically and handed to scipy's least_squares as a scipy.sparse matrix, and the trust
+region steps are solved with LSMR. One optimizer run does the whole detector, whatever the number of spectra.
+
+The starting point comes from each ROI fitted on its own (fit_compound_model, kept if fit_scheduler.implausible passes
+it): a straight line through those centroids for the calibration and a linear least squares fit of the resolution law
+to their widths. ROIs whose own fit doesn't work start from the weighted centroid and spread above their edges. Starting
+from the centroids of the excess alone let the strong low energy lines (Am 59.5 keV on BGO) pull the calibration off
+the high energy ROIs. The slope, the three resolution terms and the peak amplitudes are kept positive.
+
+The optimizer can succeed with some ROIs still wrong: the laws put a centroid outside its ROI, or an amplitude ends up
+on its 0 bound (no peak there). Those ROIs come back failed, with the reason in error, and the rest are kept.
+
+Spectra are assumed to share one calibration, so if the gain drifted between runs use spectrum_reader.py's
+--drift-tolerance (per spectrum fits) instead.
+
+How to use:
+    python global_fit.py BGO_detector/unangled/ BGO_detector/unangled/bgBGO.Spe BGO --output BGOresults_global.csv
+    (or spectrum_reader.py's --global-fit, which writes the usual results csv)
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import least_squares
+
+import catalog
+import fit_scheduler
+import profiles
+import profiling
+import quality
+import spectrum_reader
+
+N_SHARED = 5
+N_LOCAL = 4
+#smallest R^2 the resolution law is allowed to give, keeps the widths real while the optimizer explores
+MIN_R2 = 1e-8
+#amplitudes below this fraction of the largest one are taken to be on their 0 bound
+AMP_BOUND_TOLERANCE = 1e-6
+
+
+class GlobalProblem:
+    """
+    Every ROI of a detector packed into flat arrays, so the model and Jacobian are single numpy expressions
+        x, y, error: channel, background subtracted rate and its error of every fitted point
+        roi: which ROI each point belongs to
+        energies, centres, half_widths: line energy, window centre and half width (channels) of each ROI
+        rows: (source, angle, date, quality flags) of each ROI, for the results table
+    """
+
+    def __init__(self):
+        self.x, self.y, self.error, self.roi = [], [], [], []
+        self.energies, self.centres, self.half_widths, self.rows = [], [], [], []
+
+    def add(self, table, error, peak_range, energy, row):
+        """adds the points of one ROI of one spectrum"""
+        peak_range = np.asarray(peak_range)
+        self.x.append(np.asarray(table["bins"], dtype=float)[peak_range])
+        self.y.append(np.asarray(table["counts/sec"], dtype=float)[peak_range])
+        self.error.append(error[peak_range])
+        self.roi.append(np.full(len(peak_range), len(self.energies)))
+        self.energies.append(float(energy))
+        self.centres.append(0.5 * (peak_range[0] + peak_range[-1]))
+        self.half_widths.append(max(0.5 * (peak_range[-1] - peak_range[0]), 1.0))
+        self.rows.append(row)
+
+    def pack(self):
+        """turns the lists into arrays, once everything has been added"""
+        self.x, self.y, self.error, self.roi = (np.concatenate(values) for values in (self.x, self.y, self.error, self.roi))
+        self.energies, self.centres, self.half_widths = (np.array(values) for values in (self.energies, self.centres, self.half_widths))
+        #baseline in a local coordinate (-1 to 1 over each window), so the baseline terms have similar scales
+        self.u = (self.x - self.centres[self.roi]) / self.half_widths[self.roi]
+        return self
+
+    def __len__(self):
+        return len(self.energies)
+
+    def n_params(self):
+        return N_SHARED + N_LOCAL * len(self)
+
+    def laws(self, params):
+        """centroid and sigma (channels) of every ROI from the shared parameters"""
+        slope, intercept, a, b, c = params[:N_SHARED]
+        energies = self.energies
+        r2 = np.maximum(a / energies**2 + b / energies + c, MIN_R2)
+        mu = (energies - intercept) / slope
+        sigma = energies * np.sqrt(r2) / 2.355 / slope
+        return mu, sigma, r2
+
+    def model(self, params):
+        """model rate at every point"""
+        local = params[N_SHARED:].reshape(-1, N_LOCAL)
+        mu, sigma, _ = self.laws(params)
+        roi, u = self.roi, self.u
+        z = (self.x - mu[roi]) / sigma[roi]
+        peak = local[roi, 0] * np.exp(-0.5 * z**2) / (np.sqrt(2 * np.pi) * sigma[roi])
+        return peak + local[roi, 1] + local[roi, 2] * u + local[roi, 3] * u**2
+
+    def residuals(self, params):
+        return (self.model(params) - self.y) / self.error
+
+    def jacobian(self, params):
+        """
+        Function to work out the sparse Jacobian of the residuals
+        Input: parameters
+        Output: (points x parameters) CSR matrix, each point has entries for the 5 shared and its ROI's 4 parameters
+        """
+        slope, intercept, a, b, c = params[:N_SHARED]
+        local = params[N_SHARED:].reshape(-1, N_LOCAL)
+        mu, sigma, r2 = self.laws(params)
+        roi, u = self.roi, self.u
+        energy = self.energies[roi]
+
+        z = (self.x - mu[roi]) / sigma[roi]
+        shape = np.exp(-0.5 * z**2) / (np.sqrt(2 * np.pi) * sigma[roi])
+        peak = local[roi, 0] * shape
+        d_mu = peak * z / sigma[roi]
+        d_sigma = peak * (z**2 - 1) / sigma[roi]
+
+        #chain rule through the laws: mu and sigma both go as 1/slope, sigma goes as sqrt(R^2)
+        clipped = (a / energy**2 + b / energy + c) <= MIN_R2
+        d_sigma_d_r2 = np.where(clipped, 0.0, sigma[roi] / (2 * r2[roi]))
+        shared = np.column_stack([-(d_mu * mu[roi] + d_sigma * sigma[roi]) / slope,
+                                  -d_mu / slope,
+                                  d_sigma * d_sigma_d_r2 / energy**2,
+                                  d_sigma * d_sigma_d_r2 / energy,
+                                  d_sigma * d_sigma_d_r2])
+        own = np.column_stack([shape, np.ones_like(u), u, u**2])
+
+        values = np.column_stack([shared, own]) / self.error[:, None]
+        rows = np.repeat(np.arange(len(self.x)), N_SHARED + N_LOCAL)
+        columns = np.column_stack([np.broadcast_to(np.arange(N_SHARED), (len(self.x), N_SHARED)),
+                                   N_SHARED + N_LOCAL * roi[:, None] + np.arange(N_LOCAL)])
+        return sparse.csr_matrix((values.ravel(), (rows, columns.ravel())), shape=(len(self.x), self.n_params()))
+
+    def roi_fit(self, i):
+        """
+        Function to fit one ROI on its own, for the starting point
+        Input: ROI number
+        Output: mu, FWHM (channels) and the ROI's 4 parameters (amplitude and baseline in the local coordinate), or None
+                if the fit didn't work or its peak doesn't make sense for the ROI
+        """
+        x, y = self.x[self.roi == i], self.y[self.roi == i]
+        try:
+            (mu, sig, amp, a, b, c), pcov = spectrum_reader.fit_compound_model(x, y)
+        except (RuntimeError, ValueError, TypeError, np.linalg.LinAlgError):
+            return None
+        if fit_scheduler.implausible({"bins": x}, np.arange(len(x)), mu, abs(sig), amp) is not None:
+            return None
+
+        #a x^2 + b x + c with x = centre + half width * u
+        centre, half = self.centres[i], self.half_widths[i]
+        baseline = [a * centre**2 + b * centre + c, (2 * a * centre + b) * half, a * half**2]
+        return mu, 2.355 * abs(sig), [amp, *baseline]
+
+    def initial_guess(self):
+        """
+        Function to get starting parameters from the ROIs fitted on their own (centroid and spread of the data for
+        ROIs whose fit didn't work)
+        Output: parameter vector (shared then per ROI)
+        """
+        tops, fwhms, amps, levels = [], [], [], []
+        for i in range(len(self)):
+            x, y = self.x[self.roi == i], self.y[self.roi == i]
+            #centroid and spread of what sticks out above the level of the window's edges, like the weighted mean
+            #guess of fit_compound_model (the highest point is too noisy on the weaker lines)
+            edge = max(len(y) // 10, 2)
+            level = float(np.median(np.concatenate([y[:edge], y[-edge:]])))
+            excess = np.clip(y - level, 0, None)
+            if excess.sum() > 0:
+                centre = float(np.sum(x * excess) / excess.sum())
+                spread = float(np.sqrt(np.sum((x - centre)**2 * excess) / excess.sum()))
+            else:
+                centre, spread = float(np.mean(x)), float(np.ptp(x)) / 10
+            fwhm = float(np.clip(2.355 * spread, 2.0, np.ptp(x)))
+            tops.append(centre)
+            fwhms.append(fwhm)
+            amps.append(excess.sum())
+            levels.append(level)
+
+        tops, fwhms = np.array(tops), np.array(fwhms)
+        local = np.column_stack([amps, levels, np.zeros(len(self)), np.zeros(len(self))])
+        fitted = np.zeros(len(self), dtype=bool)
+        for i in range(len(self)):
+            own = self.roi_fit(i)
+            if own is not None:
+                tops[i], fwhms[i], local[i] = own
+                fitted[i] = True
+        #the laws go through the ROIs fitted on their own, as long as there are two energies of them
+        use = fitted if len(np.unique(self.energies[fitted])) > 1 else np.ones(len(self), dtype=bool)
+        energies = self.energies[use]
+
+        if len(np.unique(energies)) > 1:
+            slope, intercept = np.polyfit(tops[use], energies, 1)
+        else:
+            slope, intercept = float(np.mean(energies / tops[use])), 0.0
+
+        r2 = (slope * fwhms[use] / energies)**2
+        columns = [energies**-2, energies**-1, np.ones_like(energies)][3 - min(len(np.unique(energies)), 3):]
+        solved = np.linalg.lstsq(np.column_stack(columns), r2, rcond=None)[0]
+        law = np.concatenate([np.zeros(3 - len(solved)), solved])
+
+        return np.concatenate([[slope, intercept], law, local.ravel()])
+
+
+class GlobalFit:
+    """
+    Result of a global fit
+        calibration, calibration_error: (slope, intercept) of E = slope * channel + intercept and their errors
+        resolution_law, resolution_error: (a, b, c) of R^2 = a/E^2 + b/E + c and their errors
+        table: one row per ROI in the spectrum_reader.py results format
+        chi2_dof, nfev, success, message: how the optimizer run went
+    """
+
+    def __init__(self, problem, result):
+        params = result.x
+        dof = max(len(problem.x) - problem.n_params(), 1)
+        self.chi2_dof = float(2 * result.cost / dof)
+        errors = np.sqrt(np.clip(block_variances(sparse.csr_matrix(result.jac), len(problem)) * self.chi2_dof, 0, None))
+
+        self.calibration, self.calibration_error = tuple(params[:2]), tuple(errors[:2])
+        self.resolution_law, self.resolution_error = tuple(params[2:N_SHARED]), tuple(errors[2:N_SHARED])
+        self.nfev, self.success, self.message = result.nfev, bool(result.success), result.message
+
+        mu, sigma, _ = problem.laws(params)
+        local = params[N_SHARED:].reshape(-1, N_LOCAL)
+        self.records = [{"mu": float(mu[i]), "sig": float(sigma[i]), "amp": float(local[i, 0]), "status": "ok",
+                         "attempts": 1, "error": "", "quality": problem.rows[i][3]} for i in range(len(problem))]
+        if not self.success:
+            self.records = [dict(fit_scheduler.failed_record(RuntimeError(f"global fit: {result.message}")), quality=record["quality"])
+                            for record in self.records]
+            return
+
+        low, high = problem.centres - problem.half_widths, problem.centres + problem.half_widths
+        floor = AMP_BOUND_TOLERANCE * max(np.max(local[:, 0]), 0)
+        for i, record in enumerate(self.records):
+            if not low[i] <= mu[i] <= high[i]:
+                reason = f"global fit: centroid {mu[i]:.6g} from the calibration is outside the ROI {low[i]:g}-{high[i]:g}"
+            elif local[i, 0] <= floor:
+                reason = f"global fit: amplitude {local[i, 0]:.3g} is on its 0 bound (no peak in the ROI)"
+            else:
+                continue
+            self.records[i] = dict(fit_scheduler.failed_record(ValueError(reason)), quality=record["quality"])
+
+
+def block_variances(jacobian, n_rois):
+    """
+    Function to get the diagonal of (J^T J)^-1 without inverting the whole thing, using its block structure
+    (a small shared block, and one 4x4 block per ROI that only couples to the shared one) and the Schur complement
+    Inputs: sparse Jacobian, number of ROIs
+    Output: variance of every parameter (before scaling by chi2/dof)
+    """
+    shared, local = jacobian[:, :N_SHARED], jacobian[:, N_SHARED:]
+    a = (shared.T @ shared).toarray()
+    b = (shared.T @ local).toarray().reshape(N_SHARED, n_rois, N_LOCAL).transpose(1, 0, 2)
+    d_sparse = (local.T @ local).tocoo()
+    d = np.zeros((n_rois, N_LOCAL, N_LOCAL))
+    np.add.at(d, (d_sparse.row // N_LOCAL, d_sparse.row % N_LOCAL, d_sparse.col % N_LOCAL), d_sparse.data)
+
+    d_inv = np.linalg.pinv(d)
+    coupling = b @ d_inv
+    shared_covariance = np.linalg.pinv(a - np.einsum("nij,nkj->ik", coupling, b))
+    local_variances = (np.einsum("nii->ni", d_inv) +
+                       np.einsum("nji,jk,nki->ni", coupling, shared_covariance, coupling))
+    return np.concatenate([np.diag(shared_covariance), local_variances.ravel()])
+
+
+def collect(filepath, background, detector, catalog_path=None, limits=None):
+    """
+    Function to read every spectrum of a detector and pack the ROIs of its sources into one problem
+    Inputs: folder of spectra, background file, detector name, optional catalog csv (catalog.py), QualityLimits
+    Output: GlobalProblem, list of (source, energy, angle, date, record) for spectra rejected by the quality checks
+    """
+    profile = profiles.load_profile(detector)
+    files = catalog.build_catalog(filepath, catalog_path, recursive=False)
+    background_header, background_spectrum = spectrum_reader.file_parser(background)
+    background_counts = np.asarray(background_spectrum["counts"], dtype=float)
+    background_time = float(background_header["MEAS_TIME"][0])
+
+    problem, rejected = GlobalProblem(), []
+    for source, source_rois in zip(profile.sources, profile.source_rois):
+        rows = catalog.select(files, source=source, fmt=profile.format)
+        for (det, src, angle), file, date in zip(rows.index, rows["path"], rows["date_meas"]):
+            profiling.count("files")
+            header, spectrum = spectrum_reader.file_parser(file)
+            counts = np.asarray(spectrum["counts"], dtype=float)
+            time = float(header["MEAS_TIME"][0])
+            table = spectrum_reader.subtract_counts(counts, time, background_counts, background_time)
+            #poisson error of the rate, floored so empty channels don't get infinite weight
+            error = np.sqrt(counts / time**2 + background_counts / background_time**2)
+            error = np.maximum(error, np.sqrt(1 / time**2 + 1 / background_time**2))
+
+            #whole spectrum checks once, the ROI checks for every ROI of the source at once
+            spectrum_verdict = quality.check_spectrum(header, counts, background_header, background_counts, limits)
+            roi_verdicts = quality.check_rois(header, counts, background_header, background_counts,
+                                              profile.roi_masks(len(counts))[source_rois], limits)
+            for roi, roi_verdict in zip(source_rois, roi_verdicts):
+                verdict = quality.combine(spectrum_verdict, roi_verdict)
+                if verdict["rejected"]:
+                    record = fit_scheduler.failed_record(ValueError("failed quality checks: " + ", ".join(verdict["rejected"])), status="rejected")
+                    rejected.append((profile.energies[roi], angle, date, record))
+                    continue
+                problem.add(table, error, profile.roi_index[roi], profile.energies[roi], (source, angle, date, ", ".join(verdict["flags"])))
+
+    return problem.pack(), rejected
+
+
+@profiling.timed("global fit")
+def fit_problem(problem, max_nfev=200):
+    """
+    Function to run the optimizer on a packed problem
+    Inputs: GlobalProblem, max number of function evaluations
+    Output: GlobalFit
+    """
+    start = problem.initial_guess()
+    #positive slope, resolution terms (noise, statistics, constant) and peak amplitudes, baselines are free
+    lower = np.full(problem.n_params(), -np.inf)
+    lower[:N_SHARED] = [1e-6, -np.inf, 0, 0, 0]
+    lower[N_SHARED::N_LOCAL] = 0
+    start = np.clip(start, lower, None)
+    result = least_squares(problem.residuals, start, jac=problem.jacobian, bounds=(lower, np.inf), method="trf",
+                           tr_solver="lsmr", x_scale="jac", max_nfev=max_nfev)
+    return GlobalFit(problem, result)
+
+
+def results_dict(filepath, background, detector, catalog_path=None, limits=None, max_nfev=200):
+    """
+    Function to do the global fit of a detector and give the results like make_results_dict in spectrum_reader.py
+    Inputs: folder of spectra, background file, detector name, optional catalog csv, QualityLimits, max evaluations
+    Output: results dataframe, whether the measurements are angled, GlobalFit (None if there was nothing to fit)
+    """
+    results = {'energy': [], 'peak loc': [], 'FWHM': [], 'amp': [], 'angle': [], 'status': [], 'attempts': [],
+               'error': [], 'quality': [], 'date': []}
+    problem, rejected = collect(filepath, background, detector, catalog_path, limits)
+
+    fit = fit_problem(problem, max_nfev) if len(problem) > 0 else None
+    records = fit.records if fit is not None else []
+    for energy, (source, angle, date, flags), record in zip(problem.energies, problem.rows, records):
+        spectrum_reader.append_fit(results, energy, record, angle, date)
+    for energy, angle, date, record in rejected:
+        spectrum_reader.append_fit(results, energy, record, angle, date)
+
+    angled = any(angle != 0 for angle in results['angle'])
+    return pd.DataFrame(results), angled, fit
+
+
+def summary(fit):
+    """text summary of the shared parameters of a GlobalFit"""
+    (slope, intercept), (slope_error, intercept_error) = fit.calibration, fit.calibration_error
+    law, law_error = fit.resolution_law, fit.resolution_error
+    return (f"calibration: E = ({slope:.5g} +/- {slope_error:.2g}) * channel + ({intercept:.5g} +/- {intercept_error:.2g})\n"
+            f"resolution: R^2 = ({law[0]:.4g} +/- {law_error[0]:.2g})/E^2 + ({law[1]:.4g} +/- {law_error[1]:.2g})/E + ({law[2]:.4g} +/- {law_error[2]:.2g})\n"
+            f"chi2/dof {fit.chi2_dof:.3g}, {fit.nfev} evaluations, {fit.message}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will fit every peak of a detector at once with shared calibration and resolution laws''')
+    parser.add_argument('data_path', type = str, help = "path to the folder with data files", default = None)
+    parser.add_argument('bg_path', type = str, help = "background spectrum file", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--catalog', type = str, help = "csv to keep the catalog of the data folder in between runs", default = None)
+    parser.add_argument('--max-nfev', type = int, help = "max function evaluations of the optimizer", default = 200)
+    parser.add_argument('--output', type = str, help = "csv to write the per peak results to", default = None)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+    table, angled, global_result = results_dict(args.data_path, args.bg_path, args.detector, args.catalog, max_nfev=args.max_nfev)
+    if global_result is not None:
+        print(summary(global_result))
+    print(table[['energy', 'peak loc', 'FWHM', 'amp', 'angle', 'status']].to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
+    if args.profile:
+        profiling.finish(args.profile, args.profile_format)
@@ -0,0 +1,88 @@
+"""
+high_rate.py
+
+Corrections for spectra taken at high count rates (hot sources, short acquisitions), where normalising the counts by
+MEAS_TIME biases the rates:
+    1. dead time: .mca files are normalised by the real time, so counts lost while the detector was busy are missing
+       from the rate. In high rate mode every spectrum is normalised by its live time instead. If a file has no live
+       time, it is worked out from the real time with the non-paralyzable model live = real * (1 - rate * dead_time).
+    2. pile-up: two pulses closer together than the pile-up (resolving) time are recorded as one count at the sum of
+       their energies. To first order the pile-up spectrum is the spectrum convolved with itself, scaled by the chance
+       p = 1 - exp(-2 * rate * pileup_time) of a pulse having a neighbour. That continuum is taken off and the counts
+       it took out of the photopeaks are put back (divide by 1 - p).
+Both are plain numpy on the whole count array (the convolution is an FFT), and work on a single spectrum or a stack of
+them (spectra x channels).
+
+How to use: spectrum_reader.py --high-rate (optionally --pileup-time 1e-6 --dead-time 5e-6)
+"""
+import numpy as np
+
+
+def _first(header, key):
+    """first value of a header entry, NaN if it's missing"""
+    values = header.get(key)
+    return float(values[0]) if values else float("nan")
+
+
+def live_time(counts, real_time, header_live_time=np.nan, dead_time=None):
+    """
+    Function to get the live time of spectra
+    Inputs: counts (spectra x channels), real time, live time from the header (NaN if the file has none), dead time per
+            count (sec) for the non-paralyzable model
+    Output: live time (sec) per spectrum
+    """
+    real_time = np.asarray(real_time, dtype=float)
+    header_live_time = np.broadcast_to(np.asarray(header_live_time, dtype=float), real_time.shape)
+    if dead_time is None:
+        estimate = real_time
+    else:
+        measured_rate = np.sum(counts, axis=-1) / real_time
+        estimate = real_time * np.clip(1 - measured_rate * dead_time, 1e-6, 1)
+    return np.where(np.isfinite(header_live_time) & (header_live_time > 0), header_live_time, estimate)
+
+
+def pileup_spectrum(counts, rate, pileup_time):
+    """
+    Function to estimate the pile-up continuum of spectra (first order, two pulse pile-up)
+    Inputs: counts (spectra x channels), input count rate (counts/sec per spectrum), pile-up resolving time (sec)
+    Output: pile-up counts per channel (same shape as counts), chance p of a pulse piling up
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    total = counts.sum(axis=-1, keepdims=True)
+    p = 1 - np.exp(-2 * np.reshape(rate, (-1, 1)) * pileup_time)
+
+    #channel i + j holds the pile-up of channels i and j: the self convolution of the normalised spectrum (by FFT)
+    n = counts.shape[-1]
+    shape = counts / np.where(total > 0, total, 1)
+    size = 2 * n
+    convolution = np.fft.irfft(np.fft.rfft(shape, size, axis=-1)**2, size, axis=-1)[:, :n]
+
+    #every piled up pair of pulses gives one count
+    return np.clip(convolution, 0, None) * total * p / 2, p
+
+
+class HighRate:
+    """
+    Settings of the high rate mode
+        pileup_time: pile-up resolving time (sec), about the shaping time of the amplifier
+        dead_time: dead time per count (sec) for files without a live time, None to use the real time for them
+    """
+
+    def __init__(self, pileup_time=1e-6, dead_time=None):
+        self.pileup_time = pileup_time
+        self.dead_time = dead_time
+
+    def correct(self, header, counts):
+        """
+        Function to correct one spectrum for dead time and pile-up
+        Inputs: header dictionary and counts (as from spectrum_reader.file_parser)
+        Output: corrected counts, live time (sec) to normalise them by
+        """
+        counts = np.asarray(counts, dtype=float)
+        real_time = _first(header, "REAL_TIME")
+        if not np.isfinite(real_time):
+            real_time = _first(header, "MEAS_TIME")
+        live = float(live_time(counts, real_time, _first(header, "LIVE_TIME"), self.dead_time))
+
+        pileup, p = pileup_spectrum(counts, counts.sum() / live, self.pileup_time)
+        return (counts - pileup[0]) / (1 - p[0, 0]), live
@@ -0,0 +1,235 @@
+"""
+kernels.py
+
+The innermost loops of the pipeline, with two interchangeable backends:
+    numpy: plain numpy, always there
+    numba: the same loops compiled with numba's njit, used when numba is installed (pip install numba)
+
+Kernels:
+    decode_counts: turns the lines of a spectrum file's data block into a counts array
+    baseline: the running mean baseline of ignore_peak (points above half a standard deviation are replaced by the
+              mean of the points kept so far)
+    compound_model, compound_jacobian: gaussian on a quadratic (spectrum_reader.compound_model) and its derivatives
+              with respect to (mu, sig, amp, a, b, c), so curve_fit doesn't need finite differences
+    window_sums: sums of counts over any number of [low, high) channel windows (ROI integration)
+
+The backend is picked with the DETECTOR_KERNELS environment variable ("numpy", "numba", or "auto" for numba if it's
+installed, the default), or switched at run time with use(). Both backends give the same answers (to rounding), which
+benchmarks/run_benchmarks.py --benchmarks kernels checks along with the speedup.
+"""
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  #numba is optional, the numpy kernels do the same thing
+    numba = None
+
+BACKENDS = ("numpy", "numba")
+ENVIRONMENT_VARIABLE = "DETECTOR_KERNELS"
+SQRT_2PI = np.sqrt(2 * np.pi)
+
+
+#numpy kernels:
+
+def _decode_counts_numpy(lines, dtype):
+    return np.array(lines, dtype=dtype)
+
+
+def _baseline_numpy(flux):
+    """
+    ignore_peak without the python loop. The running mean only changes where a point is kept (below half a standard
+    deviation): kept point j at position k moves it to (k m + v) / (k + 1). That's a linear recurrence
+    m_j = a_j m_(j-1) + c_j, solved with a cumulative product (which stays above 1 / len(flux), so it can't underflow).
+    """
+    flux = np.asarray(flux, dtype=float)
+    if len(flux) == 0:
+        return flux
+    kept = flux < 0.5 * np.std(flux)
+    positions = np.flatnonzero(kept)
+    values = flux[positions]
+
+    if kept[0]:
+        #the first point starts the mean off, the recurrence picks up from the second kept point
+        start, positions, values = values[0], positions[1:], values[1:]
+    else:
+        start = np.mean(flux)
+
+    factors = positions / (positions + 1.0)
+    products = np.cumprod(factors)
+    means = products * (start + np.cumsum(values / (positions + 1.0) / products))
+
+    #every point that isn't kept gets the mean as it was after the last kept point before it
+    last_kept = np.maximum.accumulate(np.where(kept, np.arange(len(flux)), -1))
+    mean_after = np.empty(len(flux))
+    mean_after[positions] = means
+    if kept[0]:
+        mean_after[0] = start
+    running = np.where(last_kept >= 0, mean_after[np.maximum(last_kept, 0)], start)
+    return np.where(kept, flux, running)
+
+
+def _compound_model_numpy(x, mu, sig, amp, a, b, c):
+    #same expression as spectrum_reader.quadratic + gaussian
+    return a * (x**2) + b * x + c + amp * np.exp(-0.5 * (x-mu)**2 / sig**2) / np.sqrt(2 * np.pi * sig**2)
+
+
+def _compound_jacobian_numpy(x, mu, sig, amp, a, b, c):
+    u = (x - mu) / sig
+    shape = np.exp(-0.5 * u**2) / (SQRT_2PI * abs(sig))
+    peak = amp * shape
+    return np.column_stack([peak * u / sig, peak * (u**2 - 1) / sig, shape, x**2, x, np.ones_like(x)])
+
+
+def _window_sums_numpy(counts, low, high):
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)])
+    return cumulative[high] - cumulative[low]
+
+
+#numba kernels (the same loops, compiled when numba is there):
+
+def _decode_ascii(buffer, n_lines):
+    """reads whitespace separated unsigned integers out of ascii bytes, ok is False if anything else turns up"""
+    values = np.empty(n_lines, dtype=np.float64)
+    count = 0
+    current = 0.0
+    in_number = False
+    for byte in buffer:
+        if 48 <= byte <= 57:
+            current = current * 10 + (byte - 48)
+            in_number = True
+        elif byte == 32 or byte == 9 or byte == 10 or byte == 13:
+            if in_number:
+                if count == n_lines:
+                    return values, False
+                values[count] = current
+                count += 1
+                current = 0.0
+                in_number = False
+        else:
+            return values, False
+    if in_number:
+        if count == n_lines:
+            return values, False
+        values[count] = current
+        count += 1
+    return values, count == n_lines
+
+
+def _baseline_loop(flux):
+    out = np.empty(len(flux))
+    threshold = 0.5 * np.std(flux)
+    total = 0.0
+    for k in range(len(flux)):
+        if flux[k] < threshold:
+            out[k] = flux[k]
+        elif k == 0:
+            out[k] = np.mean(flux)
+        else:
+            out[k] = total / k
+        total += out[k]
+    return out
+
+
+def _compound_model_loop(x, mu, sig, amp, a, b, c):
+    out = np.empty(len(x))
+    norm = amp / np.sqrt(2 * np.pi * sig**2)
+    for i in range(len(x)):
+        out[i] = a * x[i]**2 + b * x[i] + c + norm * np.exp(-0.5 * (x[i] - mu)**2 / sig**2)
+    return out
+
+
+def _compound_jacobian_loop(x, mu, sig, amp, a, b, c):
+    out = np.empty((len(x), 6))
+    norm = 1 / (np.sqrt(2 * np.pi) * abs(sig))
+    for i in range(len(x)):
+        u = (x[i] - mu) / sig
+        shape = norm * np.exp(-0.5 * u * u)
+        out[i, 0] = amp * shape * u / sig
+        out[i, 1] = amp * shape * (u * u - 1) / sig
+        out[i, 2] = shape
+        out[i, 3] = x[i]**2
+        out[i, 4] = x[i]
+        out[i, 5] = 1.0
+    return out
+
+
+def _window_sums_loop(counts, low, high):
+    cumulative = np.empty(len(counts) + 1)
+    cumulative[0] = 0.0
+    for i in range(len(counts)):
+        cumulative[i + 1] = cumulative[i] + counts[i]
+    out = np.empty(len(low))
+    for i in range(len(low)):
+        out[i] = cumulative[high[i]] - cumulative[low[i]]
+    return out
+
+
+_kernels = {"numpy": {"baseline": _baseline_numpy, "compound_model": _compound_model_numpy,
+                      "compound_jacobian": _compound_jacobian_numpy, "window_sums": _window_sums_numpy}}
+
+if numba is not None:
+    _jit = numba.njit(cache=True)
+    _decode_ascii_jit = _jit(_decode_ascii)
+    _kernels["numba"] = {"baseline": _jit(_baseline_loop), "compound_model": _jit(_compound_model_loop),
+                         "compound_jacobian": _jit(_compound_jacobian_loop), "window_sums": _jit(_window_sums_loop)}
+
+
+def available_backends():
+    """names of the backends that can be used here"""
+    return [name for name in BACKENDS if name in _kernels]
+
+
+def use(name):
+    """
+    Function to switch the backend
+    Input: "numpy", "numba" or "auto" (numba if it's installed)
+    Output: name of the backend now in use
+    """
+    global BACKEND
+    if name in (None, "", "auto"):
+        name = "numba" if "numba" in _kernels else "numpy"
+    if name not in BACKENDS:
+        raise ValueError(f"kernel backend has to be one of {', '.join(BACKENDS)} or auto, not {name!r}")
+    if name not in _kernels:
+        raise ImportError(f"the {name} kernel backend needs {name} installed")
+    BACKEND = name
+    return name
+
+
+BACKEND = use(os.environ.get(ENVIRONMENT_VARIABLE, "auto"))
+
+
+def decode_counts(lines, dtype=float):
+    """
+    Function to decode the lines of a data block
+    Inputs: list of lines (one count each), dtype of the counts
+    Output: counts array (anything the fast path can't read, like signs or decimals, goes through numpy)
+    """
+    if BACKEND == "numba" and len(lines) > 0:
+        values, ok = _decode_ascii_jit(np.frombuffer("\n".join(lines).encode("ascii", "replace"), dtype=np.uint8), len(lines))
+        if ok:
+            return values.astype(dtype)
+    return _decode_counts_numpy(lines, dtype)
+
+
+def baseline(flux):
+    """ignore_peak's baseline of a window's counts/sec (array the same length)"""
+    return _kernels[BACKEND]["baseline"](np.asarray(flux, dtype=float))
+
+
+def compound_model(x, mu, sig, amp, a, b, c):
+    """gaussian (area amp) on the quadratic a x^2 + b x + c"""
+    return _kernels[BACKEND]["compound_model"](np.asarray(x, dtype=float), mu, sig, amp, a, b, c)
+
+
+def compound_jacobian(x, mu, sig, amp, a, b, c):
+    """(points x 6) derivatives of compound_model with respect to mu, sig, amp, a, b, c"""
+    return _kernels[BACKEND]["compound_jacobian"](np.asarray(x, dtype=float), mu, sig, amp, a, b, c)
+
+
+def window_sums(counts, low, high):
+    """sums of counts[low:high] for arrays of window edges"""
+    return _kernels[BACKEND]["window_sums"](np.asarray(counts, dtype=float), np.asarray(low, dtype=np.int64),
+                                            np.asarray(high, dtype=np.int64))
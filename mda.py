@@ -0,0 +1,135 @@
+"""
+mda.py
+
+Minimum detectable activity (MDA) at every energy of a detector/background pair, without fitting anything.
+
+For every channel the background counts in a window around it come from the cumulative sum of the background spectrum
+(two lookups per channel). The window is width_factor * FWHM wide, with the FWHM at the channel's energy from the
+resolution law of resolution.py. Currie's limits are then (k = 1.645, 5% false positives and negatives):
+    critical level   L_C = k * sqrt(B * (1 + t_s / t_b))
+    detection limit  L_D = k^2 + 2 * L_C
+where B is the background in the window scaled to the sample counting time t_s (t_b is the background's). With equal
+times these are the usual 2.33 sqrt(B) and 2.71 + 4.65 sqrt(B). The MDA is L_D over everything between a decay and a
+count in the window:
+    MDA (Bq) = L_D / (t_s * intensity * eps(E) * geometric factor * fraction of the peak inside the window)
+with the efficiency curve from efficiency_model.py. All of it is numpy over the whole spectrum at once.
+
+How to use:
+    python mda.py NaITi_detector/unangled/Bg_NaITi.Spe NaITiresults.csv NaITi --model NaITi_efficiency.json --live-time 300
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.special import erf
+
+import kernels
+
+K_ALPHA = 1.645
+
+
+def window_fraction(width_factor):
+    """fraction of a gaussian peak inside a window width_factor * FWHM wide around its centre"""
+    return erf(width_factor * 2.355 / 2 / np.sqrt(2))
+
+
+def window_sums(counts, low, high):
+    """sums of counts[low:high] for arrays of window edges, from one cumulative sum (see kernels.py)"""
+    return kernels.window_sums(counts, low, high)
+
+
+def mda_curve(background_counts, background_time, calibration, resolution_law, efficiency=None, live_time=None,
+              intensity=1.0, geometric_factor=1.0, width_factor=1.2):
+    """
+    Function to work out Currie's critical level, detection limit and MDA at every channel
+    Inputs:
+        background_counts, background_time: background spectrum and its measurement time (sec)
+        calibration: (slope, intercept) of E = slope * channel + intercept
+        resolution_law: (a, b, c) of R^2 = a/E^2 + b/E + c
+        efficiency: callable eps(E) (e.g. an EfficiencyModel), None for 1
+        live_time: counting time of the sample (sec), default the background's
+        intensity: photons per decay of the line (1 for an MDA in photons/sec)
+        geometric_factor: fraction of emissions heading into the crystal (geometry.py), 1 if eps is absolute
+        width_factor: window width in FWHMs
+    Output: dataframe with channel, energy, FWHM (keV), window low/high channels, background counts, L_C, L_D (counts)
+            and MDA (Bq), NaN where the energy or window isn't usable or there's no efficiency (outside the range an
+            EfficiencyModel was fitted to)
+    """
+    counts = np.asarray(background_counts, dtype=float)
+    live_time = background_time if live_time is None else live_time
+    slope, intercept = calibration
+    a, b, c = resolution_law
+
+    channels = np.arange(len(counts))
+    energies = slope * channels + intercept
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fwhm = energies * np.sqrt(np.clip(a / energies**2 + b / energies + c, 0, None))
+    half_width = np.where(energies > 0, width_factor * fwhm / abs(slope) / 2, np.nan)
+
+    low = np.clip(np.floor(channels - np.nan_to_num(half_width)), 0, len(counts)).astype(int)
+    high = np.clip(np.ceil(channels + np.nan_to_num(half_width)) + 1, 0, len(counts)).astype(int)
+    background = window_sums(counts, low, high) * live_time / background_time
+
+    critical = K_ALPHA * np.sqrt(background * (1 + live_time / background_time))
+    detection = K_ALPHA**2 + 2 * critical
+
+    eps = np.ones_like(energies) if efficiency is None else np.asarray(efficiency(np.where(energies > 0, energies, np.nan)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        activity = detection / (live_time * intensity * eps * geometric_factor * window_fraction(width_factor))
+
+    usable = (energies > 0) & np.isfinite(half_width) & np.isfinite(eps)
+    return pd.DataFrame({"channel": channels, "energy": energies, "FWHM (keV)": np.where(usable, fwhm, np.nan),
+                         "window low": low, "window high": high, "background": background,
+                         "L_C": critical, "L_D": detection, "MDA (Bq)": np.where(usable, activity, np.nan)})
+
+
+def line_mdas(curve, library=None, tolerance_keV=None):
+    """
+    Function to read the MDA of every library line (nuclides.py) in range off an MDA curve made with intensity 1
+    Inputs: dataframe from mda_curve, LineLibrary (default the bundled one)
+    Output: dataframe with nuclide, line energy, intensity and MDA (Bq) of each line
+    """
+    import nuclides
+
+    library = library or nuclides.load_library()
+    valid = curve.dropna(subset=["MDA (Bq)"]).sort_values("energy")
+    inside = (library.energies >= valid["energy"].iloc[0]) & (library.energies <= valid["energy"].iloc[-1])
+    energies = library.energies[inside]
+    per_photon = np.interp(energies, valid["energy"], valid["MDA (Bq)"])
+
+    return pd.DataFrame({"nuclide": np.array(library.nuclides, dtype=object)[library.line_nuclide[inside]],
+                         "line energy": energies, "intensity": library.intensities[inside],
+                         "MDA (Bq)": per_photon / library.intensities[inside]})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will work out the minimum detectable activity at every energy for a detector and background''')
+    parser.add_argument('bg_path', type = str, help = "background spectrum file", default = None)
+    parser.add_argument('results', type = str, help = "csv of results from spectrum_reader.py (for the calibration and resolution)", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--model', type = str, help = "efficiency curve json from efficiencies.py", default = None)
+    parser.add_argument('--live-time', type = float, help = "counting time of the sample (sec), default the background's", default = None)
+    parser.add_argument('--width', type = float, help = "window width in FWHMs", default = 1.2)
+    parser.add_argument('--output', type = str, help = "csv to write the MDA curve to", default = None)
+    args = parser.parse_args()
+
+    import efficiency_model
+    import geometry
+    import profiles
+    import response_matrix
+    import spectrum_reader
+
+    background_header, background_spectrum = spectrum_reader.file_parser(args.bg_path)
+    detector_calibration, detector_resolution = response_matrix.read_calibration(args.results)
+    model = efficiency_model.EfficiencyModel.load(args.model) if args.model else None
+    #the efficiency curve is intrinsic, so the crystal's geometric factor is needed for activities
+    factor = 1.0
+    profile_geometry = profiles.load_profile(args.detector).geometry
+    if model is not None and profile_geometry:
+        factor = float(geometry.geometric_factor(geometry.Geometry.from_config(profile_geometry), profile_geometry["distance_m"]))
+
+    mda = mda_curve(background_spectrum["counts"], background_header["MEAS_TIME"][0], detector_calibration,
+                    detector_resolution, model, args.live_time, geometric_factor=factor, width_factor=args.width)
+    if args.output:
+        mda.to_csv(args.output, index=False)
+    print(line_mdas(mda).to_string(index=False))
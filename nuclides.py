@@ -0,0 +1,189 @@
+"""
+nuclides.py
+
+Library of gamma lines (nuclides.json): energies, intensities (branching ratios), half-lives and reference activities
+of the check sources, plus the background and sample nuclides we're likely to see.
+
+Every line of every nuclide is one entry in arrays sorted by energy, so finding the lines within a tolerance of a
+calibrated peak centroid is two binary searches (O(log n) per peak), done for all the peaks at once with
+np.searchsorted. The library also gives efficiencies.py the branching ratio of each line and the activity of its
+source on the measurement date.
+
+How to use:
+    python nuclides.py 59.6 279.0 661.0 --tolerance 3                    (candidate lines for calibrated centroids)
+    python nuclides.py --spectrum NaITi_detector/Sample_1_Hg_0degree.Spe --background NaITi_detector/unangled/Bg_NaITi.Spe
+                       --slope 2.9 --intercept 0                          (find the peaks of a spectrum and identify them)
+"""
+import argparse
+import functools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nuclides.json")
+
+
+class LineLibrary:
+    """
+    Compiled line library. Every line is one row in the arrays below, sorted by energy:
+        energies: line energy (keV)
+        intensities: photons per decay
+        line_nuclide: index into nuclides of the nuclide each line belongs to
+    and per nuclide (same order as nuclides):
+        sources: source name used in the file names ("" for nuclides that aren't one of our sources)
+        half_lives_days, reference_activities_Bq (NaN if unknown), reference_dates (None if unknown)
+    """
+
+    def __init__(self, config):
+        nuclides = config["nuclides"]
+        self.nuclides = tuple(nuclide["name"] for nuclide in nuclides)
+        self.sources = tuple(nuclide.get("source", "") for nuclide in nuclides)
+        self.half_lives_days = np.array([nuclide["half_life_days"] for nuclide in nuclides], dtype=float)
+        self.reference_activities_Bq = np.array([np.nan if nuclide.get("reference_activity_Bq") is None
+                                                 else nuclide["reference_activity_Bq"] for nuclide in nuclides])
+        self.reference_dates = tuple(nuclide.get("reference_date") for nuclide in nuclides)
+
+        energies, intensities, owners = [], [], []
+        for i, nuclide in enumerate(nuclides):
+            for line in nuclide["lines"]:
+                energies.append(float(line["energy_keV"]))
+                intensities.append(float(line["intensity"]))
+                owners.append(i)
+
+        order = np.argsort(energies, kind="stable")
+        self.energies = np.array(energies)[order]
+        self.intensities = np.array(intensities)[order]
+        self.line_nuclide = np.array(owners, dtype=int)[order]
+
+        for arr in (self.energies, self.intensities, self.line_nuclide):
+            arr.flags.writeable = False
+
+    def candidate_ranges(self, energies, tolerance_keV=2.0):
+        """
+        Function to find the lines within the tolerance of each energy
+        Inputs: peak energies (keV), tolerance (keV, one value or one per peak)
+        Output: start and stop index arrays, the lines of peak i are energies[start[i]:stop[i]]
+        """
+        energies = np.asarray(energies, dtype=float)
+        start = np.searchsorted(self.energies, energies - tolerance_keV, side="left")
+        stop = np.searchsorted(self.energies, energies + tolerance_keV, side="right")
+        return start, stop
+
+    def identify(self, energies, tolerance_keV=2.0, sources=None):
+        """
+        Function to list the candidate lines of every peak
+        Inputs: calibrated peak centroids (keV), tolerance (keV), optional list of source/nuclide names to restrict to
+        Output: dataframe with peak (index into energies), peak energy, nuclide, line energy, intensity, difference,
+                sorted by peak then by how close the line is
+        """
+        energies = np.asarray(energies, dtype=float)
+        start, stop = self.candidate_ranges(energies, tolerance_keV)
+        counts = stop - start
+        peaks = np.repeat(np.arange(len(energies)), counts)
+        lines = np.concatenate([np.arange(a, b) for a, b in zip(start, stop)]) if counts.sum() else np.array([], dtype=int)
+
+        table = pd.DataFrame({"peak": peaks, "peak energy": energies[peaks],
+                              "nuclide": np.array(self.nuclides, dtype=object)[self.line_nuclide[lines]],
+                              "line energy": self.energies[lines], "intensity": self.intensities[lines]})
+        table["difference"] = table["peak energy"] - table["line energy"]
+        if sources is not None:
+            keep = [self.sources[i] in sources or self.nuclides[i] in sources for i in self.line_nuclide[lines]]
+            table = table[np.array(keep, dtype=bool)]
+
+        return (table.assign(distance=table["difference"].abs()).sort_values(["peak", "distance"], kind="stable")
+                .drop(columns="distance").reset_index(drop=True))
+
+    def closest_lines(self, energies, tolerance_keV=0.5):
+        """
+        Function to match every energy to its closest line
+        Inputs: energies (keV), tolerance (keV)
+        Output: index of the closest line for each energy, -1 where there's no line within the tolerance
+        """
+        energies = np.asarray(energies, dtype=float)
+        right = np.clip(np.searchsorted(self.energies, energies), 1, len(self.energies) - 1)
+        left = right - 1
+        best = np.where(np.abs(self.energies[left] - energies) <= np.abs(self.energies[right] - energies), left, right)
+        return np.where(np.abs(self.energies[best] - energies) <= tolerance_keV, best, -1)
+
+    def branching_ratios(self, energies, tolerance_keV=0.5):
+        """intensity (photons per decay) of the line at each energy, NaN where the library has no such line"""
+        lines = self.closest_lines(energies, tolerance_keV)
+        return np.where(lines >= 0, self.intensities[lines], np.nan)
+
+    def activities(self, energies, dates=None, tolerance_keV=0.5):
+        """
+        Function to get the activity of the source of each line on the day it was measured
+        Inputs: line energies (keV), measurement dates (iso strings/datetimes, one per energy, or None), tolerance (keV)
+        Output: activity (Bq) per energy, decay corrected from the reference date when the library has one,
+                NaN where the line or its reference activity is unknown
+        """
+        lines = self.closest_lines(energies, tolerance_keV)
+        dates = [None] * len(lines) if dates is None else list(dates)
+        activities = np.full(len(lines), np.nan)
+        for i, (line, date) in enumerate(zip(lines, dates)):
+            if line >= 0:
+                activities[i] = self.activity(self.nuclides[self.line_nuclide[line]], date)
+        return activities
+
+    def activity(self, nuclide, date=None):
+        """
+        Function to decay correct a nuclide's reference activity
+        Inputs: nuclide name, date of the measurement (None, "" or NaT to skip the correction)
+        Output: activity (Bq), NaN if the library has no reference activity for it
+        """
+        i = self.nuclides.index(nuclide)
+        activity = self.reference_activities_Bq[i]
+        if self.reference_dates[i] is None or date is None or pd.isna(date) or date == "":
+            return activity
+
+        elapsed_days = (pd.Timestamp(date) - pd.Timestamp(self.reference_dates[i])) / pd.Timedelta(days=1)
+        return activity * np.exp(-np.log(2) * elapsed_days / self.half_lives_days[i])
+
+
+@functools.lru_cache(maxsize=None)
+def load_library(path=LIBRARY_PATH):
+    """Function to load and compile the line library, once per process"""
+    with open(path, "r") as file:
+        return LineLibrary(json.load(file))
+
+
+def find_peaks_keV(spectrum, background, slope, intercept, prominence=5.0):
+    """
+    Function to find the peaks of a background subtracted spectrum and calibrate their channels
+    Inputs: spectrum and background files, calibration (energy = slope * channel + intercept), how many standard
+            deviations a peak must stand out by
+    Output: peak energies (keV)
+    """
+    from scipy.signal import find_peaks
+
+    import spectrum_reader
+
+    data_header, data_spectrum = spectrum_reader.file_parser(spectrum)
+    background_header, background_spectrum = spectrum_reader.file_parser(background)
+    rate = spectrum_reader.subtract_counts(data_spectrum["counts"], data_header["MEAS_TIME"],
+                                           background_spectrum["counts"], background_header["MEAS_TIME"])["counts/sec"].to_numpy()
+    #poisson error of the rate, so the prominence is in standard deviations
+    error = np.sqrt(np.asarray(data_spectrum["counts"], dtype=float) / data_header["MEAS_TIME"][0]**2 +
+                    np.asarray(background_spectrum["counts"], dtype=float) / background_header["MEAS_TIME"][0]**2)
+    smoothed = np.convolve(rate, np.ones(5) / 5, mode="same")
+    channels, _ = find_peaks(smoothed, prominence=prominence * np.median(error[error > 0]) if np.any(error > 0) else None)
+    return slope * channels + intercept
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will identify the nuclides of calibrated peaks (or of the peaks of a spectrum)''')
+    parser.add_argument('energies', type = float, nargs = "*", help = "calibrated peak energies (keV)")
+    parser.add_argument('--tolerance', type = float, help = "largest difference (keV) between a peak and a line", default = 2.0)
+    parser.add_argument('--spectrum', type = str, help = "spectrum to find and identify the peaks of", default = None)
+    parser.add_argument('--background', type = str, help = "background for --spectrum", default = None)
+    parser.add_argument('--slope', type = float, help = "calibration slope (keV/channel) from spectrum_reader.py", default = None)
+    parser.add_argument('--intercept', type = float, help = "calibration intercept (keV) from spectrum_reader.py", default = 0.0)
+    args = parser.parse_args()
+
+    peak_energies = list(args.energies)
+    if args.spectrum:
+        peak_energies += list(find_peaks_keV(args.spectrum, args.background, args.slope, args.intercept))
+
+    print(load_library().identify(peak_energies, args.tolerance).to_string(index=False))
@@ -0,0 +1,122 @@
+"""
+profiles.py
+
+Loads the detector profiles in detector_profiles/ (one json or toml file per detector) and compiles them into the
+numpy arrays spectrum_reader.py uses when fitting, so adding a detector or a source is just adding/editing a file.
+
+A profile looks like:
+    {
+        "detector": "BGO",
+        "format": "Spe",                      <- file extension of the spectra
+        "geometry": {"shape": "disk", "radius_m": 0.025, "length_m": 0.0, "distance_m": 0.10},
+                                              <- optional, crystal and source distance for geometry.py
+        "sources": [                          <- source names match the ones catalog.py reads from file names
+            {"name": "Cs", "lines": [{"energy_keV": 661.657, "roi": [210, 350]}]},
+            ...
+        ]
+    }
+
+roi is [first channel, last channel + 1], the same as the range() the old hardcoded dicts used.
+Compiled profiles are cached, so every fit of a run shares the same index arrays and masks.
+"""
+import functools
+import json
+import os
+
+import numpy as np
+
+try:
+    import tomllib
+except ImportError:  #python < 3.11, json profiles still work
+    tomllib = None
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "detector_profiles")
+
+
+class DetectorProfile:
+    """
+    Compiled detector profile. Every ROI of every source is one row in the arrays below:
+        energies: line energy of each ROI (keV)
+        roi_starts, roi_stops: channel bounds of each ROI
+        roi_source: index into sources of the source each ROI belongs to
+        roi_index: tuple of channel index arrays, one per ROI (what gauss_fitter slices with)
+        source_rois: tuple of ROI row arrays, one per source
+    geometry is the profile's geometry block (dictionary), or None if it doesn't have one
+    """
+
+    def __init__(self, config):
+        self.name = config["detector"]
+        self.format = config["format"]
+        self.config = config
+        self.geometry = config.get("geometry")
+        self.sources = tuple(source["name"] for source in config["sources"])
+
+        energies, starts, stops, owners = [], [], [], []
+        for i, source in enumerate(config["sources"]):
+            for peak in source["lines"]:
+                energies.append(float(peak["energy_keV"]))
+                starts.append(int(peak["roi"][0]))
+                stops.append(int(peak["roi"][1]))
+                owners.append(i)
+
+        self.energies = np.array(energies, dtype=float)
+        self.roi_starts = np.array(starts, dtype=int)
+        self.roi_stops = np.array(stops, dtype=int)
+        self.roi_source = np.array(owners, dtype=int)
+        self.roi_index = tuple(np.arange(start, stop) for start, stop in zip(starts, stops))
+        self.source_rois = tuple(np.flatnonzero(self.roi_source == i) for i in range(len(self.sources)))
+
+        for arr in (self.energies, self.roi_starts, self.roi_stops, self.roi_source, *self.roi_index, *self.source_rois):
+            arr.flags.writeable = False
+
+    @property
+    def extension(self):
+        """file extension (with the dot) of this detector's spectra"""
+        return "." + self.format
+
+    @functools.lru_cache(maxsize=None)
+    def roi_masks(self, n_channels):
+        """
+        Function to get boolean masks of the ROIs for spectra with n_channels channels
+        Output: (number of ROIs, n_channels) read only boolean array
+        """
+        channels = np.arange(n_channels)
+        masks = (channels >= self.roi_starts[:, None]) & (channels < self.roi_stops[:, None])
+        masks.flags.writeable = False
+        return masks
+
+
+def available_profiles(profile_dir=PROFILE_DIR):
+    """returns the names of the detectors that have a profile"""
+    names = []
+    for filename in sorted(os.listdir(profile_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext in (".json", ".toml"):
+            names.append(name)
+    return names
+
+
+def read_profile(path):
+    """reads a json or toml profile file into a dictionary"""
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ImportError("toml profiles need python 3.11+ (tomllib), use a json profile instead")
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+@functools.lru_cache(maxsize=None)
+def load_profile(detector, profile_dir=PROFILE_DIR):
+    """
+    Function to load and compile the profile for a detector, compiled once per process
+    Inputs: name of detector (matches the file name in detector_profiles/), optional folder of profiles
+    Output: DetectorProfile
+    """
+    for ext in (".json", ".toml"):
+        path = os.path.join(profile_dir, detector + ext)
+        if os.path.exists(path):
+            return DetectorProfile(read_profile(path))
+
+    raise FileNotFoundError(f"no profile for detector {detector!r}, have: {', '.join(available_profiles(profile_dir))}")
@@ -0,0 +1,191 @@
+"""
+profiling.py
+
+Optional timing/tracing of the pipeline, to find out where a slow run spends its time (parsing, ignore_peak,
+baseline curve_fit, the compound fit, plotting...).
+
+When it's switched on (--profile on any of the scripts) every stage records:
+    wall time, cpu time, peak memory (tracemalloc) and, for curve_fit calls, the number of function evaluations
+    and whether the fit converged
+plus counters such as the number of files and fits. The trace is written either as plain json or as a Chrome trace
+(open it in chrome://tracing or https://ui.perfetto.dev).
+
+When it's off, stage() hands back the same do-nothing context manager and timed()/curve_fit() go straight to the
+wrapped function, so leaving the instrumentation in the code costs next to nothing.
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from scipy.optimize import curve_fit as scipy_curve_fit
+
+ENABLED = False
+
+_events = []
+_counters = {}
+_stack = []
+_start = 0.0
+_null_stage = contextlib.nullcontext()
+
+
+def enable():
+    """switches profiling on (and starts tracing memory)"""
+    global ENABLED, _start
+    _events.clear()
+    _counters.clear()
+    _start = time.perf_counter()
+    tracemalloc.start()
+    ENABLED = True
+
+
+def disable():
+    """switches profiling off"""
+    global ENABLED
+    ENABLED = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+class _Stage:
+    """context manager that records one stage"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.child_peak = 0
+
+    def __enter__(self):
+        #tracemalloc only has one peak, so it's reset for every stage and nested stages pass their peaks up
+        if _stack:
+            _stack[-1].child_peak = max(_stack[-1].child_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        _stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+        _stack.pop()
+        if _stack:
+            _stack[-1].child_peak = max(_stack[-1].child_peak, peak)
+        tracemalloc.reset_peak()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+
+        _events.append({"name": self.name, "start": self.wall - _start, "wall": wall, "cpu": cpu,
+                        "peak_memory": peak, "thread": threading.get_ident(), "args": self.args})
+        return False
+
+
+def stage(name, **args):
+    """
+    Function to time a block of code: with profiling.stage("parse", file=filename): ...
+    Inputs: name of the stage, anything else worth recording with it
+    """
+    if not ENABLED:
+        return _null_stage
+    return _Stage(name, args)
+
+
+def timed(name):
+    """decorator version of stage, for timing every call of a function"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _Stage(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """adds n to a counter (files parsed, fits done, ...)"""
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def curve_fit(f, xdata, ydata, stage="curve_fit", **kwargs):
+    """
+    Drop in for scipy's curve_fit that, when profiling, also records the number of function evaluations and
+    whether the fit converged
+    Output: popt, pcov (same as scipy)
+    """
+    if not ENABLED:
+        return scipy_curve_fit(f, xdata, ydata, **kwargs)
+
+    with _Stage(stage, {"model": f.__name__}) as record:
+        try:
+            popt, pcov, infodict, mesg, ier = scipy_curve_fit(f, xdata, ydata, full_output=True, **kwargs)
+        except RuntimeError as error:
+            record.args.update({"converged": False, "message": str(error)})
+            count(stage + " failures")
+            raise
+        record.args.update({"nfev": int(infodict.get("nfev", 0)), "converged": ier in (1, 2, 3, 4), "message": mesg})
+    count(stage + " nfev", record.args["nfev"])
+    return popt, pcov
+
+
+def summary():
+    """
+    Function to add up the trace per stage
+    Output: dictionary of stage name -> calls, total wall and cpu time, highest peak memory
+    """
+    totals = {}
+    for event in _events:
+        total = totals.setdefault(event["name"], {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak_memory": 0})
+        total["calls"] += 1
+        total["wall"] += event["wall"]
+        total["cpu"] += event["cpu"]
+        total["peak_memory"] = max(total["peak_memory"], event["peak_memory"])
+    return totals
+
+
+def write_trace(path, fmt="chrome"):
+    """
+    Function to write out everything recorded
+    Inputs: file to write, "chrome" for a Chrome trace or "json" for a plain list of stages with a summary
+    """
+    if fmt == "chrome":
+        pid = os.getpid()
+        trace = [{"name": event["name"], "ph": "X", "ts": event["start"] * 1e6, "dur": event["wall"] * 1e6,
+                  "pid": pid, "tid": event["thread"],
+                  "args": dict(event["args"], cpu=event["cpu"], peak_memory=event["peak_memory"])}
+                 for event in _events]
+        trace += [{"name": name, "ph": "C", "ts": 0, "pid": pid, "args": {name: value}} for name, value in _counters.items()]
+        output = {"traceEvents": trace, "displayTimeUnit": "ms"}
+    else:
+        output = {"events": _events, "counters": _counters, "summary": summary()}
+
+    with open(path, "w") as file:
+        json.dump(output, file, indent=1, default=str)
+
+
+def print_summary():
+    """prints the time spent in each stage, slowest first"""
+    print(f"\n{'stage':<24} {'calls':>7} {'wall (s)':>10} {'cpu (s)':>10} {'peak mem (MB)':>14}")
+    for name, total in sorted(summary().items(), key=lambda item: -item[1]["wall"]):
+        print(f"{name:<24} {total['calls']:>7} {total['wall']:>10.4f} {total['cpu']:>10.4f} {total['peak_memory'] / 1e6:>14.2f}")
+    for name, value in _counters.items():
+        print(f"{name}: {value}")
+
+
+def add_arguments(parser):
+    """adds the --profile and --profile-format arguments to a script's argument parser"""
+    parser.add_argument('--profile', type = str, help = "write a profile of the run to this file", default = None)
+    parser.add_argument('--profile-format', type = str, choices = ["chrome", "json"], help = "chrome trace or plain json", default = "chrome")
+
+
+def finish(path, fmt="chrome"):
+    """writes the trace, prints the summary and switches profiling off"""
+    write_trace(path, fmt)
+    print_summary()
+    disable()
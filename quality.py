@@ -0,0 +1,165 @@
+"""
+quality.py
+
+Cheap checks run on every spectrum before it gets fitted, so the optimiser isn't wasted on (or crashed by) bad data.
+
+Checks (all plain numpy, and they work on one spectrum or a whole stack of them at once):
+    1. channels: the spectrum has the same number of channels as the background                  -> reject
+    2. empty: total counts below a minimum                                                       -> reject
+    3. saturation: channels at the ADC's max value, or a pile of counts in the last (overflow) channel  -> reject
+    4. dead time: 1 - live/real above a limit (the rate normalisation gets shaky)                -> flag
+    5. ROI counts: too few raw counts in the fit window                                          -> reject
+       or nothing above the background in it                                                    -> flag
+
+Checks 1-4 only look at the whole spectrum, so they're run once per spectrum (check_spectrum); check 5 is run for
+every ROI of the spectrum at once with the profile's ROI masks (check_rois).
+Rejected spectra aren't fitted, flagged ones are fitted but the flags are kept with the results.
+"""
+import numpy as np
+
+
+class QualityLimits:
+    """
+    Thresholds for the checks
+        min_total_counts: fewest counts a spectrum can have
+        saturation_level: counts at or above this in a channel mean it's saturated (None to skip)
+        overflow_fraction: largest fraction of all counts allowed in the last channel
+        max_dead_time: largest 1 - live/real before the spectrum is flagged
+        min_roi_counts: fewest raw counts allowed in a fit window
+    """
+
+    def __init__(self, min_total_counts=100, saturation_level=2**31 - 1, overflow_fraction=0.01, max_dead_time=0.2,
+                 min_roi_counts=10):
+        self.min_total_counts = min_total_counts
+        self.saturation_level = saturation_level
+        self.overflow_fraction = overflow_fraction
+        self.max_dead_time = max_dead_time
+        self.min_roi_counts = min_roi_counts
+
+
+def dead_time_ratio(live_time, real_time):
+    """fraction of the real time the detector was dead (0 if the times are missing)"""
+    live_time = np.asarray(live_time, dtype=float)
+    real_time = np.asarray(real_time, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = 1 - live_time / real_time
+    return np.where(np.isfinite(ratio), np.clip(ratio, 0, 1), 0.0)
+
+
+def spectrum_checks(counts, live_time, real_time, background, limits=None):
+    """
+    Function to run the whole spectrum checks (channels, empty, saturation, dead time) on a stack of spectra at once
+    Inputs: (spectra x channels) raw counts, live and real time of each spectrum (sec), background counts, QualityLimits
+    Output: dictionary of check name -> boolean array (True where the spectrum fails that check)
+    """
+    limits = limits or QualityLimits()
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    background = np.asarray(background, dtype=float)
+
+    failed = {}
+    failed["channels"] = np.full(len(counts), counts.shape[1] != background.shape[-1])
+
+    total = counts.sum(axis=1)
+    failed["empty"] = total < limits.min_total_counts
+
+    saturated = np.zeros(len(counts), dtype=bool)
+    if limits.saturation_level is not None:
+        saturated |= (counts >= limits.saturation_level).any(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        saturated |= np.nan_to_num(counts[:, -1] / total) > limits.overflow_fraction
+    failed["saturated"] = saturated
+
+    failed["dead time"] = dead_time_ratio(live_time, real_time).reshape(-1) > limits.max_dead_time
+    return failed
+
+
+def roi_checks(counts, meas_time, background, background_time, roi_masks, limits=None):
+    """
+    Function to run the fit window checks (raw counts, rate above the background) on a stack of spectra at once
+    Inputs: (spectra x channels) raw counts, measurement time of each spectrum (sec), background counts and the time they
+            were counted over, boolean masks of the fit windows (rois x channels, e.g. DetectorProfile.roi_masks, or
+            one mask), QualityLimits
+    Output: dictionary of check name -> boolean array (spectra x rois, or spectra for one mask)
+    """
+    limits = limits or QualityLimits()
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    background = np.asarray(background, dtype=float)
+    meas_time = np.asarray(meas_time, dtype=float).reshape(-1)
+    roi_masks = np.asarray(roi_masks, dtype=bool)
+    masks = np.atleast_2d(roi_masks)[:, :counts.shape[1]]
+
+    failed = {}
+    roi_counts = counts @ masks.T
+    failed["roi counts"] = roi_counts < limits.min_roi_counts
+    if counts.shape[1] == background.shape[-1]:
+        background_rate = masks @ background / np.sum(background_time)
+        failed["roi rate"] = roi_counts / meas_time[:, None] <= background_rate
+    else:
+        failed["roi rate"] = np.zeros(roi_counts.shape, dtype=bool)
+
+    return {name: value[:, 0] for name, value in failed.items()} if roi_masks.ndim == 1 else failed
+
+
+def check_batch(counts, live_time, real_time, meas_time, background, background_time, roi_mask, limits=None):
+    """
+    Function to run every check on a stack of spectra at once
+    Inputs:
+        counts: (spectra x channels) raw counts
+        live_time, real_time, meas_time: one value per spectrum (sec)
+        background, background_time: background counts and the time they were counted over
+        roi_mask: boolean mask of the fit window (channels), e.g. from DetectorProfile.roi_masks
+        limits: QualityLimits
+    Output: dictionary of check name -> boolean array (True where the spectrum fails that check)
+    """
+    failed = spectrum_checks(counts, live_time, real_time, background, limits)
+    failed.update(roi_checks(counts, meas_time, background, background_time, roi_mask, limits))
+    return failed
+
+
+#checks that stop a spectrum being fitted, the rest only flag it
+REJECTING = ("channels", "empty", "saturated", "roi counts")
+
+
+def roi_mask(peak_range, n_channels):
+    """boolean mask of a fit window given as channel indices, for windows that aren't a profile's (e.g. moved by
+    gain_drift.py), the profile's own come ready made from DetectorProfile.roi_masks"""
+    mask = np.zeros(n_channels, dtype=bool)
+    peak_range = np.asarray(peak_range)
+    mask[peak_range[peak_range < n_channels]] = True
+    return mask
+
+
+def _verdict(failed, i=0):
+    """rejected and flagged checks of spectrum (or ROI) i out of a dictionary of failed checks"""
+    return {"rejected": [name for name in REJECTING if name in failed and failed[name][i]],
+            "flags": [name for name in failed if name not in REJECTING and failed[name][i]]}
+
+
+def check_spectrum(header, counts, background_header, background, limits=None):
+    """
+    Function to run the whole spectrum checks on one spectrum, once before fitting any of its ROIs
+    Inputs: header and counts of the spectrum and of the background (from file_parser), QualityLimits
+    Output: dictionary with "rejected" (list of failed rejecting checks) and "flags" (list of failed warning checks)
+    """
+    live_time = header.get("LIVE_TIME") or header["MEAS_TIME"]
+    real_time = header.get("REAL_TIME") or header["MEAS_TIME"]
+    return _verdict(spectrum_checks(counts, live_time[:1], real_time[:1], background, limits))
+
+
+def check_rois(header, counts, background_header, background, roi_masks, limits=None):
+    """
+    Function to run the fit window checks on every ROI of one spectrum at once
+    Inputs: header and counts of the spectrum and of the background (from file_parser), boolean masks of the fit windows
+            (rois x channels, rows of DetectorProfile.roi_masks or roi_mask), QualityLimits
+    Output: list of verdicts (as from check_spectrum), one per ROI
+    """
+    roi_masks = np.atleast_2d(roi_masks)
+    failed = roi_checks(counts, header["MEAS_TIME"][:1], background, background_header["MEAS_TIME"][:1], roi_masks, limits)
+    failed = {name: value[0] for name, value in failed.items()}
+    return [_verdict(failed, i) for i in range(len(roi_masks))]
+
+
+def combine(spectrum_verdict, roi_verdict):
+    """verdict of fitting one ROI: the spectrum's failed checks followed by the ROI's"""
+    return {"rejected": spectrum_verdict["rejected"] + roi_verdict["rejected"],
+            "flags": spectrum_verdict["flags"] + roi_verdict["flags"]}
@@ -5,6 +5,10 @@ import scipy
 from scipy.optimize import curve_fit
 import pandas as pd
 import argparse
+import sys
+
+import fit_cache
+import profiling
 
 """
 resolution.py
@@ -36,7 +40,7 @@ def res_curve_fit(E, R2):
     #R2_data = R #**2
 
     p0_guess = [1.0, 1.0, 0.0]
-    popt, pcov = curve_fit(resolution_eq, x_data, R2, p0=p0_guess)
+    popt, pcov = profiling.curve_fit(resolution_eq, x_data, R2, p0=p0_guess, stage="resolution fit")
     perr = np.sqrt(np.diag(pcov))
 
     return popt, pcov, x_data, perr
@@ -48,7 +52,8 @@ def resolution_plot(csv, detector):
     Inputs: Csv file, title for plot
     Output: plot of resolution by energy for peaks in a given table
     """
-    table = pd.read_csv(csv)
+    #fits that failed in spectrum_reader.py are left out
+    table = pd.read_csv(csv).dropna(subset=["FWHM (keV)"])
     table["resolution"] = table["FWHM (keV)"] / table["energy"]
     table = table.sort_values("energy")
 
@@ -80,22 +85,36 @@ def resolution_plot(csv, detector):
     #plt.xscale("log")
     plt.tight_layout()
     plt.legend()
-    plt.show()
+    with profiling.stage("plt.show"):
+        plt.show()
 
     return popt, perr
 
-def main(csv, detector):
+def main(csv, detector, cache_path=None):
     """Main function to run what the script does"""
-    popt, perr = resolution_plot(csv, detector)  
+    if cache_path:
+        #resolution node: only refit if the csv from spectrum_reader or the resolution code actually changed
+        cache = fit_cache.FitCache(cache_path)
+        key = fit_cache.make_key("resolution", detector, fit_cache.file_fingerprint(csv), fit_cache.code_fingerprint(sys.modules[__name__]))
+        popt, perr = cache.cached("resolution", key, lambda: list(resolution_plot(csv, detector)))
+        cache.save()
+    else:
+        popt, perr = resolution_plot(csv, detector)  
     print(f"Fit line with uncertainty: R^2 = ({popt[0]} +/1 {perr[0]})E^(-2) + ({popt[1]} +/1 {perr[1]})E^(-1) + ({popt[2]} +/1 {perr[2]})")
 
 if __name__ == '__main__': 
     parser = argparse.ArgumentParser(description='''This script will return a plot of resolution by energy for given detector readings''')
     parser.add_argument('csv', type = str, help = "path to the csv", default = None)
     parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--cache', type = str, help = "cache file for incremental runs", default = None)
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
-    main(args.csv, args.detector)
+    if args.profile:
+        profiling.enable()
+    main(args.csv, args.detector, args.cache)
+    if args.profile:
+        profiling.finish(args.profile, args.profile_format)
 
 
     
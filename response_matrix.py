@@ -0,0 +1,236 @@
+"""
+response_matrix.py
+
+Full-spectrum response of a detector, for unfolding a measured spectrum back to the energies of the photons that hit it
+(instead of only using the photopeaks).
+
+The response matrix R has one row per detector channel and one column per incident energy bin: column j is the
+spectrum expected from one photon of energy E_j hitting the crystal,
+    1. photopeak: efficiency eps(E) (efficiency_model.py) spread as a gaussian with the FWHM of the resolution law
+       R^2 = a/E^2 + b/E + c (resolution.py), placed with the channel calibration E = slope * channel + intercept
+       (spectrum_reader.calibrate)
+    2. Compton continuum: compton_ratio * eps(E) counts, flat from 0 up to the Compton edge and smeared there by the
+       resolution (the same shape benchmarks/synthetic.py uses)
+Entries below a small fraction of their column's peak are dropped and R is stored as a scipy.sparse CSR matrix. Built
+matrices are cached in response_tables/ under a hash of everything they were built from.
+
+Unfolding uses MLEM, where every iteration is two sparse matrix-vector products:
+    x <- x / (R^T 1) * R^T (y / (R x))
+
+How to use:
+    python response_matrix.py spectrum.Spe background.Spe BGOresults.csv BGO --model BGO_efficiency.json --output unfolded.csv
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import erf
+
+TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "response_tables")
+TABLE_VERSION = 1
+ELECTRON_MASS_KEV = 510.999
+#entries smaller than this fraction of their column's largest are left out of the sparse matrix
+THRESHOLD = 1e-5
+
+
+def fwhm_keV(energies, resolution_law):
+    """FWHM (keV) at the energies from the resolution law (a, b, c) of resolution.py"""
+    a, b, c = resolution_law
+    energies = np.asarray(energies, dtype=float)
+    return energies * np.sqrt(np.clip(a / energies**2 + b / energies + c, 1e-8, None))
+
+
+def compton_edge(energies):
+    """energy (keV) of the Compton edge of lines at the energies"""
+    return energies * (1 - 1 / (1 + 2 * energies / ELECTRON_MASS_KEV))
+
+
+class ResponseMatrix:
+    """
+    Sparse response of one detector
+        matrix: (channels x energy bins) CSR matrix, expected counts per channel per incident photon
+        energies: centre of each incident energy bin (keV)
+        params: everything the matrix was built from (see response_params)
+    """
+
+    def __init__(self, matrix, energies, params):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.matrix_t = self.matrix.T.tocsr()
+        self.energies = np.asarray(energies, dtype=float)
+        self.params = params
+        self.sensitivity = np.asarray(self.matrix.sum(axis=0)).ravel()
+
+    @classmethod
+    def build(cls, params):
+        """
+        Function to build the response matrix from response_params, every energy bin at once
+        Output: ResponseMatrix
+        """
+        slope, intercept = params["calibration"]
+        resolution_law = params["resolution_law"]
+        energies = np.asarray(params["energies"], dtype=float)
+        eps = np.asarray(params["efficiency"], dtype=float)
+
+        #channel edges in keV, so each entry is the integral of the shapes over the channel
+        edges = slope * (np.arange(params["n_channels"] + 1) - 0.5) + intercept
+        low_edges, high_edges = edges[:-1, None], edges[1:, None]
+        sigma = fwhm_keV(energies, resolution_law) / 2.355
+        peak = 0.5 * (erf((high_edges - energies) / (np.sqrt(2) * sigma)) - erf((low_edges - energies) / (np.sqrt(2) * sigma)))
+
+        edge = compton_edge(energies)
+        edge_sigma = fwhm_keV(np.maximum(edge, 1.0), resolution_law) / 2.355
+        centres = 0.5 * (low_edges + high_edges)
+        shelf = 0.5 * (1 - np.tanh((centres - edge) / (edge_sigma * np.sqrt(2)))) * (centres > 0)
+        shelf_total = shelf.sum(axis=0)
+        shelf = shelf / np.where(shelf_total > 0, shelf_total, 1)
+
+        response = eps * (peak + params["compton_ratio"] * shelf)
+        response[response < THRESHOLD * response.max(axis=0)] = 0
+
+        return cls(sparse.csr_matrix(response), energies, params)
+
+    def save(self, path):
+        """writes the matrix (and what it was built from) to an .npz file"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=self.matrix.shape, energies=self.energies, params=json.dumps(self.params))
+
+    @classmethod
+    def load(cls, path):
+        """reads a matrix written by save"""
+        with np.load(path) as data:
+            matrix = sparse.csr_matrix((data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"]))
+            return cls(matrix, data["energies"], json.loads(str(data["params"])))
+
+    def fold(self, incident):
+        """expected counts per channel for the incident photons per energy bin"""
+        return self.matrix @ np.asarray(incident, dtype=float)
+
+    def unfold(self, counts, iterations=100, start=None):
+        """
+        Function to unfold a spectrum with MLEM
+        Inputs: counts per channel (background subtracted, negatives are set to 0), iterations, optional first guess
+        Output: incident photons per energy bin
+        """
+        counts = np.clip(np.asarray(counts, dtype=float), 0, None)
+        sensitivity = np.where(self.sensitivity > 0, self.sensitivity, 1)
+        if start is None:
+            estimate = np.full(len(self.energies), counts.sum() / sensitivity.sum())
+        else:
+            estimate = np.asarray(start, dtype=float)
+
+        for _ in range(iterations):
+            expected = self.matrix @ estimate
+            ratio = np.divide(counts, expected, out=np.zeros_like(counts), where=expected > 0)
+            estimate = estimate * (self.matrix_t @ ratio) / sensitivity
+
+        return estimate
+
+
+def response_params(calibration, resolution_law, n_channels, efficiency=None, energies=None, compton_ratio=1.5):
+    """
+    Function to collect everything a response matrix is built from
+    Inputs:
+        calibration: (slope, intercept) of E = slope * channel + intercept
+        resolution_law: (a, b, c) of R^2 = a/E^2 + b/E + c
+        n_channels: channels in the spectra
+        efficiency: callable eps(E) (e.g. an EfficiencyModel), None for 1 at every energy; energies it gives NaN for
+                    (outside an EfficiencyModel's fitted range) get no response
+        energies: incident energy bin centres (keV), default n_channels/2 bins over the calibrated range
+        compton_ratio: counts in the Compton continuum per count in the photopeak
+    Output: json friendly dictionary for ResponseMatrix.build
+    """
+    slope, intercept = calibration
+    if energies is None:
+        energies = np.linspace(max(intercept, 10.0), slope * (n_channels - 1) + intercept, n_channels // 2)
+    energies = np.asarray(energies, dtype=float)
+    eps = np.ones_like(energies) if efficiency is None else np.nan_to_num(np.asarray(efficiency(energies), dtype=float))
+
+    return {"calibration": [float(slope), float(intercept)], "resolution_law": [float(value) for value in resolution_law],
+            "n_channels": int(n_channels), "energies": energies.tolist(), "efficiency": eps.tolist(),
+            "compton_ratio": float(compton_ratio)}
+
+
+def params_key(params):
+    """short hash of a set of build parameters, used to name the cached matrix"""
+    text = json.dumps([TABLE_VERSION, params], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def load_response(detector, params, table_dir=TABLE_DIR):
+    """
+    Function to get a detector's response matrix from the cache folder, building (and saving) it if it isn't there
+    Inputs: detector name, parameters from response_params, folder to cache matrices in
+    Output: ResponseMatrix
+    """
+    path = os.path.join(table_dir, f"{detector}_{params_key(params)}.npz")
+    if os.path.exists(path):
+        return ResponseMatrix.load(path)
+
+    response = ResponseMatrix.build(params)
+    response.save(path)
+    return response
+
+
+def read_calibration(results_csv):
+    """
+    Function to get the channel calibration and the resolution law from a spectrum_reader.py results csv
+    Input: results csv
+    Output: (slope, intercept) of E = slope * channel + intercept, (a, b, c) of R^2 = a/E^2 + b/E + c
+    """
+    import resolution
+    import spectrum_reader
+
+    table = pd.read_csv(results_csv)
+    slope, intercept = spectrum_reader.calibrate(table)[0]
+    fitted = table.dropna(subset=["FWHM (keV)"])
+    resolution_law = resolution.res_curve_fit(fitted["energy"], (fitted["FWHM (keV)"] / fitted["energy"])**2)[0]
+    return (float(slope), float(intercept)), tuple(float(value) for value in resolution_law)
+
+
+def detector_params(results_csv, n_channels, model_path=None, compton_ratio=1.5):
+    """
+    Function to get the calibration and resolution law from a spectrum_reader.py results csv (and the efficiency
+    curve from efficiencies.py, if there is one)
+    Inputs: results csv, channels in the spectra, efficiency model json (or None), Compton to photopeak ratio
+    Output: parameters for load_response
+    """
+    import efficiency_model
+
+    calibration, resolution_law = read_calibration(results_csv)
+    efficiency = efficiency_model.EfficiencyModel.load(model_path) if model_path else None
+
+    return response_params(calibration, resolution_law, n_channels, efficiency, compton_ratio=compton_ratio)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will unfold a spectrum to the energies of the photons that hit the detector''')
+    parser.add_argument('spectrum', type = str, help = "spectrum file to unfold", default = None)
+    parser.add_argument('bg_path', type = str, help = "background spectrum file", default = None)
+    parser.add_argument('results', type = str, help = "csv of results from spectrum_reader.py (for the calibration and resolution)", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--model', type = str, help = "efficiency curve json from efficiencies.py", default = None)
+    parser.add_argument('--compton-ratio', type = float, help = "Compton continuum counts per photopeak count", default = 1.5)
+    parser.add_argument('--iterations', type = int, help = "MLEM iterations", default = 100)
+    parser.add_argument('--output', type = str, help = "csv to write the unfolded spectrum to", default = None)
+    args = parser.parse_args()
+
+    import spectrum_reader
+
+    data_header, data_spectrum = spectrum_reader.file_parser(args.spectrum)
+    background_header, background_spectrum = spectrum_reader.file_parser(args.bg_path)
+    #background subtracted counts over the spectrum's measurement time
+    net = data_spectrum["counts"] - background_spectrum["counts"] * data_header["MEAS_TIME"][0] / background_header["MEAS_TIME"][0]
+
+    response_matrix = load_response(args.detector, detector_params(args.results, len(net), args.model, args.compton_ratio))
+    incident = response_matrix.unfold(net, args.iterations)
+
+    unfolded = pd.DataFrame({"energy (keV)": response_matrix.energies, "photons": incident,
+                             "photons/sec": incident / data_header["MEAS_TIME"][0]})
+    if args.output:
+        unfolded.to_csv(args.output, index=False)
+    print(unfolded.sort_values("photons", ascending=False).head(10).to_string(index=False))
@@ -0,0 +1,221 @@
+"""
+shared_pool.py
+
+Spectra in shared memory, so the peak fits of a detector can be spread over worker processes without pickling count
+arrays to them.
+
+SpectrumPool parses every spectrum (and the background) once in the main process and copies the counts into one
+multiprocessing.shared_memory block, a (spectra x channels) float64 array, with the measurement, live and real times
+of each spectrum in a second small block. Workers attach to the blocks by name once, when they start, and only ever
+see read only numpy views of them. A task is just (spectrum row, background row, ROI number), so what gets sent to a
+worker doesn't grow with the spectra, and the memory used by the spectra doesn't grow with the number of workers.
+
+Fits go through spectrum_reader.gated_fit like in make_results_dict (quality checks, fit scheduler, high rate
+corrections), and the results come back in the same order as make_results_dict would give them.
+
+How to use:
+    python spectrum_reader.py BGO_detector/unangled/ BGO_detector/unangled/bgBGO.Spe BGO --workers 4
+    python shared_pool.py BGO_detector/unangled/ BGO_detector/unangled/bgBGO.Spe BGO --workers 4
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import catalog
+import profiles
+import profiling
+import quality
+import spectrum_reader
+
+TIME_KEYS = ("MEAS_TIME", "LIVE_TIME", "REAL_TIME")
+
+
+class PoolHandle:
+    """
+    What a worker needs to find the pool: names of the shared blocks and the shape of the counts array
+    (a few strings and ints, so it's cheap to pickle)
+    """
+
+    def __init__(self, counts_name, times_name, shape):
+        self.counts_name = counts_name
+        self.times_name = times_name
+        self.shape = tuple(shape)
+
+
+def _attach(name):
+    """opens an existing shared block without tracking it, the process that made it is the one that frees it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        #python < 3.13 has no track argument, but the workers share the resource tracker of the process that made the
+        #block (which already tracks it), so attaching doesn't add anything for it to clean up
+        return shared_memory.SharedMemory(name=name)
+
+
+class SpectrumPool:
+    """
+    Counts and times of many spectra in shared memory
+        counts: (spectra x channels) read only view, shorter spectra are padded with zeros
+        lengths: number of channels of each spectrum
+        times: (spectra x 3) MEAS_TIME, LIVE_TIME, REAL_TIME (NaN where the file didn't have it)
+    The process that made the pool owns the blocks and frees them in close() (or at the end of a with block).
+    """
+
+    def __init__(self, handle, owner=False):
+        self.handle = handle
+        self.owner = owner
+        open_block = shared_memory.SharedMemory if owner else _attach
+        self._counts_block = open_block(name=handle.counts_name)
+        self._times_block = open_block(name=handle.times_name)
+        #last column of the counts block is the length of each spectrum
+        table = np.ndarray((handle.shape[0], handle.shape[1] + 1), dtype=np.float64, buffer=self._counts_block.buf)
+        self.counts = table[:, :-1]
+        self.lengths = table[:, -1].astype(int)
+        self.times = np.ndarray((handle.shape[0], len(TIME_KEYS)), dtype=np.float64, buffer=self._times_block.buf)
+        for arr in (self.counts, self.times):
+            arr.flags.writeable = False
+
+    @classmethod
+    def create(cls, spectra):
+        """
+        Function to copy parsed spectra into new shared blocks
+        Input: list of (header, spectrum) from file_parser
+        Output: SpectrumPool owning the blocks
+        """
+        n_channels = max(len(spectrum["counts"]) for header, spectrum in spectra)
+        shape = (len(spectra), n_channels)
+        counts_block = shared_memory.SharedMemory(create=True, size=8 * shape[0] * (shape[1] + 1))
+        times_block = shared_memory.SharedMemory(create=True, size=8 * shape[0] * len(TIME_KEYS))
+
+        table = np.ndarray((shape[0], shape[1] + 1), dtype=np.float64, buffer=counts_block.buf)
+        times = np.ndarray((shape[0], len(TIME_KEYS)), dtype=np.float64, buffer=times_block.buf)
+        table[:] = 0
+        for i, (header, spectrum) in enumerate(spectra):
+            table[i, :len(spectrum["counts"])] = spectrum["counts"]
+            table[i, -1] = len(spectrum["counts"])
+            times[i] = [header[key][0] if header.get(key) else np.nan for key in TIME_KEYS]
+
+        handle = PoolHandle(counts_block.name, times_block.name, shape)
+        counts_block.close()
+        times_block.close()
+        return cls(handle, owner=True)
+
+    @classmethod
+    def from_files(cls, paths, workers=4):
+        """loads spectrum files (parsed with a pool of threads) into a new pool, in the order given"""
+        parsed = spectrum_reader.parse_many(list(paths), workers)
+        return cls.create([parsed[path] for path in paths])
+
+    def __len__(self):
+        return self.handle.shape[0]
+
+    def header(self, i):
+        """header dictionary of spectrum i, like file_parser's (times only)"""
+        return {key: [] if np.isnan(value) else [float(value)] for key, value in zip(TIME_KEYS, self.times[i])}
+
+    def spectrum(self, i):
+        """read only counts of spectrum i (a view, nothing is copied)"""
+        return self.counts[i, :self.lengths[i]]
+
+    def close(self):
+        """lets go of the blocks, and frees them if this process made them"""
+        #views into the buffers have to go before the blocks can be closed
+        self.counts = self.times = None
+        self._counts_block.close()
+        self._times_block.close()
+        if self.owner:
+            self._counts_block.unlink()
+            self._times_block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+#set up once in every worker process by _start_worker
+_worker = {}
+
+
+def _start_worker(handle, detector, budget, high_rate, policy):
+    """worker initializer: attaches to the pool and loads the detector profile once"""
+    _worker.update(pool=SpectrumPool(handle), profile=profiles.load_profile(detector), budget=budget,
+                   high_rate=high_rate, policy=policy)
+
+
+def _fit_task(task):
+    """fits one ROI of one spectrum, task = (spectrum row, background row, ROI number)"""
+    spectrum, background, roi = task
+    pool, profile = _worker["pool"], _worker["profile"]
+    counts = pool.spectrum(spectrum)
+    #the tasks of a spectrum come one after another, so its whole spectrum checks are kept for the next ROI
+    if _worker.get("checked", (None,))[0] != (spectrum, background):
+        _worker["checked"] = ((spectrum, background), quality.check_spectrum(pool.header(spectrum), counts,
+                                                                             pool.header(background), pool.spectrum(background)))
+    return spectrum_reader.gated_fit(pool.header(spectrum), counts, pool.header(background), pool.spectrum(background),
+                                     profile.roi_index[roi], _worker["budget"], high_rate=_worker["high_rate"],
+                                     policy=_worker["policy"], roi_mask=profile.roi_masks(len(counts))[roi],
+                                     spectrum_verdict=_worker["checked"][1])
+
+
+@profiling.timed("shared pool fits")
+def results_dict(filepath, background, detector, workers=4, catalog_path=None, budget=None, high_rate=None, policy=None,
+                 chunksize=8):
+    """
+    Function to do what make_results_dict does for a folder of spectra, with the fits spread over worker processes
+    that read the spectra from shared memory
+    Inputs: folder of spectra, background file, detector name, number of worker processes, optional catalog csv,
+            FitBudget, HighRate settings, fit scheduler policy, tasks sent to a worker at a time
+    Output: results dataframe (same rows and order as make_results_dict), whether the measurements are angled
+    """
+    results = {'energy': [], 'peak loc': [], 'FWHM': [], 'amp': [], 'angle': [], 'status': [], 'attempts': [],
+               'error': [], 'quality': [], 'date': []}
+    profile = profiles.load_profile(detector)
+    files = catalog.build_catalog(filepath, catalog_path, recursive=False)
+
+    rows, tasks = [], []
+    paths = [background]
+    for source, source_rois in zip(profile.sources, profile.source_rois):
+        selected = catalog.select(files, source=source, fmt=profile.format)
+        for (det, src, angle), file, date in zip(selected.index, selected["path"], selected["date_meas"]):
+            profiling.count("files")
+            paths.append(file)
+            for roi in source_rois:
+                #row 0 of the pool is the background
+                tasks.append((len(paths) - 1, 0, int(roi)))
+                rows.append((profile.energies[roi], angle, date))
+
+    if not tasks:
+        return pd.DataFrame(results), False
+
+    with SpectrumPool.from_files(paths) as pool:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker,
+                                 initargs=(pool.handle, detector, budget, high_rate, policy)) as executor:
+            records = list(executor.map(_fit_task, tasks, chunksize=chunksize))
+
+    for (energy, angle, date), record in zip(rows, records):
+        spectrum_reader.append_fit(results, energy, record, angle, date)
+
+    return pd.DataFrame(results), any(angle != 0 for energy, angle, date in rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will fit a detector's spectra with worker processes reading them from shared memory''')
+    parser.add_argument('data_path', type = str, help = "path to the folder with data files", default = None)
+    parser.add_argument('bg_path', type = str, help = "background spectrum file", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--workers', type = int, help = "number of worker processes", default = os.cpu_count())
+    parser.add_argument('--catalog', type = str, help = "csv to keep the catalog of the data folder in between runs", default = None)
+    parser.add_argument('--output', type = str, help = "csv to write the results to", default = None)
+    args = parser.parse_args()
+
+    table, angled = results_dict(args.data_path, args.bg_path, args.detector, args.workers, args.catalog)
+    print(table[['energy', 'peak loc', 'FWHM', 'amp', 'angle', 'status']].to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
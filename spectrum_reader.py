@@ -22,102 +22,130 @@ import scipy
 from scipy.optimize import curve_fit
 import pandas as pd
 
-from glob import glob
 import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import archives
+import background_library
+import catalog
+import fit_cache
+import fit_scheduler
+import gain_drift
+import global_fit
+import high_rate as high_rate_module
+import kernels
+import profiling
+import quality
+import shared_pool
+import profiles
+import spectrum_store
 
 def file_type_checker(filename):
     """Checks the file type, because the header will have diff formatting"""
     
+    #works for .gz files and archive members too (see archives.py)
+    filename = archives.spectrum_name(filename)
     if filename[-3:] == "Spe":
         return "Spe"
     elif filename[-3:] == "mca":
         return "mca"
     else: return "error"
 
-def file_parser(filename):
+def parse_spectrum(text, file_type):
+    """
+    Function to parse the text of a spectrum file. The data block is decoded in one go with numpy instead of line by line
+    Inputs: full text of the file, file type from file_type_checker
+    Outputs: header and spectrum dictionaries (same as file_parser)
+    """
 
     #the function will fill and return these dictionaries:
     
+    #MEAS_TIME is the time counts get normalised by (live time for .Spe, real time for .mca),
+    #LIVE_TIME and REAL_TIME are both kept for the quality checks
     header_dict = {
         "DATE_MEAS": [],
-        "MEAS_TIME": []
+        "MEAS_TIME": [],
+        "LIVE_TIME": [],
+        "REAL_TIME": []
     }
 
+    lines = text.splitlines()
+    data_start, data_stop = 0, 0
+
+    if file_type == "Spe" :
+        for i, line in enumerate(lines):
+            line = line.strip()
+
+            if line.startswith('$MEAS_TIM:'):
+                live, real = lines[i + 1].split()[:2]
+                header_dict["MEAS_TIME"].append(float(live))
+                header_dict["LIVE_TIME"].append(float(live))
+                header_dict["REAL_TIME"].append(float(real))
+            elif line.startswith('$DATE_MEA:'):
+                header_dict["DATE_MEAS"].append(lines[i + 1].strip())
+            elif line == '$DATA:':
+                #the line after $DATA: is the first and last channel number
+                first, last = lines[i + 1].split()
+                data_start = i + 2
+                data_stop = data_start + int(last) - int(first) + 1
+                break
+        counts = kernels.decode_counts(lines[data_start:data_stop], float)
+
+    elif file_type == "mca" :
+        for i, line in enumerate(lines):
+            line = line.strip()
+
+            if line.startswith('REAL_TIME'):
+                header_dict["MEAS_TIME"].append(float(line.partition(" - ")[2]))
+                header_dict["REAL_TIME"].append(float(line.partition(" - ")[2]))
+            elif line.startswith('LIVE_TIME'):
+                header_dict["LIVE_TIME"].append(float(line.partition(" - ")[2]))
+            elif line.startswith('START_TIME'):
+                header_dict["DATE_MEAS"].append(line.partition(" - ")[2])
+            elif line.startswith('<<DATA>>'):
+                data_start = i + 1
+            elif line.startswith("<<END>>") and data_start:
+                data_stop = i
+                break
+        counts = kernels.decode_counts(lines[data_start:data_stop], np.int64)
+
+    else:
+        print("give me the right file type (mca or spe) pretty please!")
+        return None
+
     spectrum_dict = {
-        "bins": [], 
-        "counts": []
+        "bins": np.arange(len(counts)), 
+        "counts": counts
     }
 
-    if file_type_checker(filename) == "Spe" :
-        IS_DATA = False
-
-        with open(filename, "r") as file:
-            for line in file:
-                line = line.strip()
-
-            # if it's data, reset the flag
-                if line == '$DATA:':
-                    IS_DATA = True
-                    continue
-                elif line.startswith('$MEAS_TIM:'):
-                    next_line = next(file).split(" ")
-                    header_dict["MEAS_TIME"].append(float(next_line[0]))
-                    IS_DATA = False
-                elif line.startswith('$DATE_MEA:'):
-                    next_line = next(file).strip()
-                    header_dict["DATE_MEAS"].append(next_line)
-                    IS_DATA = False
-
-            #this is for all lines following # DATA
-            #while IS_DATA == True:  
-                if IS_DATA == True:
-                    try:
-                        spectrum_dict["counts"].append(float(line))
-                    except ValueError:
-                        continue   
-        #change if bin range changes
-        for i in range(len(spectrum_dict["counts"])):
-            spectrum_dict["bins"].append(i)
-        
-        return header_dict, spectrum_dict
+    return header_dict, spectrum_dict
 
-    elif  file_type_checker(filename) == "mca" :
-        IS_DATA = False
+@profiling.timed("parse")
+def file_parser(filename):
+    """
+    Function to read in a .Spe or .mca file (plain, gzipped, or inside a zip/tar archive as "archive::member")
+    Input: path to the spectrum
+    Outputs: header dictionary (DATE_MEAS, MEAS_TIME, LIVE_TIME, REAL_TIME) and spectrum dictionary (bins, counts)
+    """
+    if file_type_checker(filename) == "error":
+        print("give me the right file type (mca or spe) pretty please!")
+        return None
 
-        with open(filename, "r") as file:
-            for line in file:
-                line = line.strip()
-    
-                # if it's data, reset the flag
-                if line.startswith('<<DATA>>'):
-                    IS_DATA = True
-                    continue
-                elif line.startswith('REAL_TIME'):
-                    line = line.strip()
-                    header_dict["MEAS_TIME"].append(float(line[12:]))
-                    IS_DATA = False
-                elif line.startswith('START_TIME'):
-                    line = line.strip()
-                    header_dict["DATE_MEAS"].append(line[13:])
-                    IS_DATA = False
-                elif line.startswith("<<END>>"):
-                    IS_DATA = False
-               
-                if IS_DATA == True:
-                    try:
-                        spectrum_dict["counts"].append(int(line))
-                    except Exception as e:
-                        print(e)
-                        continue   
-        #change if bin range changes
-        for i in range(len(spectrum_dict["counts"])):
-            spectrum_dict["bins"].append(i)
-        
-        return header_dict, spectrum_dict
+    return parse_spectrum(archives.read_text(filename), file_type_checker(filename))
 
-    elif file_type_checker(filename) == "error":
-        print("give me the right file type (mca or spe) pretty please!")
+def parse_many(filenames, workers=4):
+    """
+    Function to read and parse many spectra at once with a pool of threads, straight out of archives if need be
+    Inputs: list of spectrum paths, number of threads
+    Output: dictionary of path -> (header dictionary, spectrum dictionary)
+    """
+    texts = archives.read_many(filenames, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parsed = pool.map(lambda path: parse_spectrum(texts[path], file_type_checker(path)), filenames)
+        return dict(zip(filenames, parsed))
 
+@profiling.timed("background subtract")
 def background_subtract(data, background):
     """
     Converts spectrum to units of counts/sec then subtracts background from data
@@ -127,13 +155,27 @@ def background_subtract(data, background):
     data_header, data_spectrum = file_parser(data)
     background_header, background_spectrum = file_parser(background)
 
-    background_ct = background_header["MEAS_TIME"]
-    data_ct = data_header["MEAS_TIME"]
+    return subtract_counts(data_spectrum["counts"], data_header["MEAS_TIME"],
+                           background_spectrum["counts"], background_header["MEAS_TIME"])
 
-    background_subtracted = (np.array(data_spectrum["counts"]) / data_ct) - (np.array(background_spectrum["counts"]) / background_ct)
+def subtract_counts(data_counts, data_ct, background_counts, background_ct):
+    """
+    Same as background_subtract, but for spectra that are already arrays (e.g. read out of an hdf5 store)
+    Inputs: data counts, data measurement time, background counts, background measurement time
+    Outputs: dataframe object of bins and counts per second of background subtracted spectra
+    """
+    return subtract_rate(data_counts, data_ct, np.array(background_counts) / background_ct)
+
+def subtract_rate(data_counts, data_ct, background_rate):
+    """
+    Same as subtract_counts, but against a background that's already in counts/sec (e.g. from background_library.py)
+    Inputs: data counts, data measurement time, background rate (counts/sec in every channel)
+    Outputs: dataframe object of bins and counts per second of background subtracted spectra
+    """
+    background_subtracted = (np.array(data_counts) / data_ct) - background_rate
 
     table = {
-        'bins' : data_spectrum["bins"],
+        'bins' : np.arange(len(background_subtracted)),
         'counts/sec' : background_subtracted
     }
 
@@ -156,29 +198,16 @@ def peak_finder(table):
     
     return int(max_point)
 
+@profiling.timed("ignore_peak")
 def ignore_peak(flux):
     """
     Function used to ignore the peak part of the data for plotting the baseline
     Input: y data (flux)
-    Output: list of ajdusted y data, were values associated with the peak are replaced with mean flux
-    """
-    background_y = []
-    mean_flux = np.mean(flux)
-    flux_std = np.std(flux)
-    for i in flux:
-        if i < (0.5 * flux_std):
-            background_y.append(i)
-            background_mean = np.mean(background_y) #make a mean background level
-        elif background_y == []:
-            background_y.append(mean_flux)
-        else:
-            background_mean = np.mean(background_y)
-            background_y.append(background_mean)
-       # if i > 0.5 * (flux_std): #if the flux is higher than this, the point is probably part of the peak
-      #      background_y.append(mean_flux) 
-       #else:
-        #    background_y.append(i)
-    return background_y
+    Output: array of ajdusted y data, were values associated with the peak are replaced with the mean of the points kept before them
+    """
+    #points below half a standard deviation are kept, the rest (probably part of the peak) get the running mean of
+    #the kept ones (the mean of all the flux if the first point isn't kept). See kernels.baseline
+    return kernels.baseline(flux)
 
 #fitting functions: 
 def quadratic(x, a, b, c):
@@ -189,14 +218,24 @@ def gaussian(x, mu, sig, amp):
     """A Gaussian function, used for scipi curve fit"""
     return amp * np.exp(-0.5 * (x-mu)**2 / sig**2) / np.sqrt(2 * np.pi * sig**2)
 
+#coarse to fine fitting: rebinning factors to pick from, fewest bins worth fitting, half width of the final window in FWHMs,
+#ftol/xtol of the coarse fits
+COARSE_FACTORS = (8, 4, 2)
+MIN_COARSE_BINS = 12
+FINE_WINDOW_FWHM = 2.5
+COARSE_TOLERANCE = 1e-2
+
 def compound_model(x, mu, sig, amp, a, b, c):
     """Combines the quadratic fit of the background with the Gaussian fit which better represents the peak"""
-    return quadratic(x, a, b, c) + gaussian(x, mu, sig, amp)
+    return kernels.compound_model(x, mu, sig, amp, a, b, c)
 
-def fit_compound_model(x, y, p0=None):
+#analytic derivatives, curve_fit uses them instead of finite differences (wrappers of the model carry it along)
+compound_model.jacobian = kernels.compound_jacobian
+
+def fit_compound_model(x, y, p0=None, model=compound_model, **fit_kwargs):
     """
     Function to fit data using curve_fit and compound_model
-    Inputs: x, y (list of x, y data)
+    Inputs: x, y (list of x, y data), optional initial guess and model, anything else is passed to curve_fit (e.g. maxfev)
     Outputs: popt (parameters array), pcov (covarience array) 
     """
 
@@ -208,23 +247,28 @@ def fit_compound_model(x, y, p0=None):
         sigma_guess = (np.max(x) - np.min(x)) / 10
         #getting the polynomial parameters: 
         background_y = ignore_peak(y)
-        b_popt, b_pcov = curve_fit(quadratic, x, background_y, p0 = None)
+        b_popt, b_pcov = profiling.curve_fit(quadratic, x, background_y, p0 = None, stage = "baseline fit", **fit_kwargs)
+
+        p0 = [mu_guess, sigma_guess, A_guess, *b_popt]
 
-    p0 = [mu_guess, sigma_guess, A_guess, *b_popt]
-    popt, pcov = curve_fit(compound_model, x, y, p0 = p0)
+    if getattr(model, "jacobian", None) is not None and "jac" not in fit_kwargs:
+        fit_kwargs = dict(fit_kwargs, jac=model.jacobian)
+    popt, pcov = profiling.curve_fit(model, x, y, p0 = p0, stage = "compound fit", **fit_kwargs)
 
     return popt, pcov
 
 
-def gauss_fitter(table, peak_range):
+@profiling.timed("peak fit")
+def gauss_fitter(table, peak_range, p0=None, model=compound_model, **fit_kwargs):
     """
     Function to fit a gaussian to data and find the location of peaks
-    Input: table of bins and counts/sec for a spectrum and a range of interest to look for peaks in
+    Input: table of bins and counts/sec for a spectrum and a range of interest to look for peaks in,
+           optional initial guess/model and curve_fit options (used by fit_scheduler.py when retrying)
     Output: mu0, singma0, and amp from the gaussian fit
     """
     
     background_y = ignore_peak(table["counts/sec"][peak_range])
-    b_popt, b_pcov = curve_fit(quadratic, table["bins"][peak_range], background_y, p0 = None)
+    b_popt, b_pcov = profiling.curve_fit(quadratic, table["bins"][peak_range], background_y, p0 = None, stage = "baseline fit", **fit_kwargs)
     quad_fit = quadratic(np.array(table["bins"][peak_range]), *b_popt)
 
     #plotting data with polynomial baseline fit overlaid:
@@ -241,7 +285,7 @@ def gauss_fitter(table, peak_range):
     #plt.show()
 
     #fitting and plotting gauss model: plotting is commented out rn since theres soooo many plots when this is run. was ran to get some for the report
-    popt, pcov = fit_compound_model(np.array(table["bins"][peak_range]), np.array(table["counts/sec"][peak_range]))
+    popt, pcov = fit_compound_model(np.array(table["bins"][peak_range]), np.array(table["counts/sec"][peak_range]), p0, model, **fit_kwargs)
     gauss_fit = gaussian(np.array(table["bins"][peak_range]), *popt[:3])
 
     #plt.close("all")
@@ -261,6 +305,87 @@ def gauss_fitter(table, peak_range):
     #returning peak location, sigma, and amplitude: 
     return popt[0], popt[1], popt[2]
 
+def rebin_window(x, y, factor):
+    """
+    Function to merge every factor channels of a window into one bin
+    Inputs: channels and counts/sec of the window, channels per bin
+    Output: bin centres, counts/sec per channel in each bin (sum over the bin / channels in it), channels in each bin
+    """
+    starts = np.arange(0, len(y), factor)
+    width = np.diff(np.append(starts, len(y)))
+    return np.add.reduceat(x, starts) / width, np.add.reduceat(y, starts) / width, width
+
+def moment_guess(x, y, **fit_kwargs):
+    """
+    Function to guess compound_model's parameters from the centroid, spread and area of what's above the baseline
+    (the baseline is fitted the same way as in fit_compound_model)
+    Inputs: x, y data, curve_fit options
+    Output: initial guess [mu, sig, amp, a, b, c]
+    """
+    b_popt, b_pcov = profiling.curve_fit(quadratic, x, ignore_peak(y), p0 = None, stage = "baseline fit", **fit_kwargs)
+    excess = np.clip(y - quadratic(x, *b_popt), 0, None)
+    if excess.sum() <= 0:
+        excess = np.ones_like(y)
+    step = np.mean(np.diff(x)) if len(x) > 1 else 1.0
+    mu = np.sum(x * excess) / excess.sum()
+    sigma = max(np.sqrt(np.sum((x - mu)**2 * excess) / excess.sum()), step)
+    amp = excess.sum() * step
+
+    return [mu, sigma, amp, *b_popt]
+
+@profiling.timed("coarse to fine fit")
+def coarse_to_fine_fitter(table, peak_range, p0=None, model=compound_model, factors=COARSE_FACTORS, window_fwhm=FINE_WINDOW_FWHM,
+                          **fit_kwargs):
+    """
+    Function to fit a peak coarse to fine: the window rebinned by the coarsest factor that still leaves MIN_COARSE_BINS
+    bins locates and sizes the peak, then one fit at full resolution of only window_fwhm FWHMs either side of the centroid.
+    The centroid and spread of the rebinned window are usually enough to place the fine window, so the rebinned window is
+    only fitted when they aren't (peak off the window or wider than it) or when the guess passed in is closer to the data
+    Input: table of bins and counts/sec, range of interest, optional initial guess/model (the guess from the data is for
+           compound_model, so pass p0 with any other model), rebinning factors to pick from, half width of the final
+           window in FWHMs, curve_fit options
+    Output: mu0, sigma0 and amp, like gauss_fitter
+    """
+    x = np.array(table["bins"][peak_range], dtype=float)
+    y = np.array(table["counts/sec"][peak_range], dtype=float)
+
+    usable = [factor for factor in factors if len(x) // factor >= MIN_COARSE_BINS]
+    if not usable:
+        #window too narrow to rebin, so it's a normal fit
+        popt, pcov = fit_compound_model(x, y, p0, model, **fit_kwargs)
+        return popt[0], popt[1], popt[2]
+
+    factor = max(usable)
+    x_coarse, y_coarse, width = rebin_window(x, y, factor)
+    popt = moment_guess(x_coarse, y_coarse, **fit_kwargs)
+    if getattr(model, "jacobian", None) is not None and "jac" not in fit_kwargs:
+        fit_kwargs = dict(fit_kwargs, jac=model.jacobian)
+    located = x[0] <= popt[0] <= x[-1] and 2.355 * popt[1] <= x[-1] - x[0]
+    if p0 is not None and len(p0) == len(popt):
+        #a guess passed in is only used if it's closer to the rebinned data than the one from the data
+        chi2 = [np.sum((model(x_coarse, *start) - y_coarse)**2) for start in (p0, popt)]
+        if chi2[0] < chi2[1]:
+            popt, located = p0, False
+    elif p0 is not None:
+        popt, located = p0, False
+
+    if not located:
+        #the coarse fit only needs to locate and size the peak, so it stops at a looser tolerance
+        popt, pcov = profiling.curve_fit(model, x_coarse, y_coarse, p0 = popt, stage = "coarse fit", ftol = COARSE_TOLERANCE,
+                                         xtol = COARSE_TOLERANCE, **fit_kwargs)
+    #a bin of factor channels adds (factor^2 - 1)/12 to the peak's variance
+    p0 = np.array(popt, dtype=float)
+    p0[1] = np.sqrt(max(popt[1]**2 - (factor**2 - 1) / 12, 0.25))
+
+    half = max(window_fwhm * 2.355 * abs(p0[1]), MIN_COARSE_BINS / 2)
+    fine = (x >= p0[0] - half) & (x <= p0[0] + half)
+    if fine.sum() < MIN_COARSE_BINS:
+        #the coarse fit wandered off the window, refine over all of it
+        fine[:] = True
+    popt, pcov = profiling.curve_fit(model, x[fine], y[fine], p0 = p0, stage = "fine fit", **fit_kwargs)
+
+    return popt[0], popt[1], popt[2]
+
 def subtract_and_fit(data, background, peak_range):
     """
     Function to subtract background from a sepctrum then fit a peak within a given range
@@ -272,42 +397,149 @@ def subtract_and_fit(data, background, peak_range):
 
     return mu0, sigma, amp
 
+def gated_fit(data_header, data_counts, background_header, background_counts, peak_range, budget=None, limits=None,
+              high_rate=None, policy=None, background_rate=None, roi_mask=None, spectrum_verdict=None):
+    """
+    Function to check a spectrum with the quality checks (quality.py) and, if it passes, subtract the background and
+    fit the peak through the fit scheduler (budgets and retries, fit_scheduler.py)
+    Inputs: header and counts of the spectrum and background, range to look for peak at, FitBudget, QualityLimits,
+            HighRate settings to correct both spectra for dead time and pile-up (high_rate.py), None to not,
+            escalation policy of the fit scheduler (None for its default),
+            background already in counts/sec (from background_library.py) to subtract instead of working it out,
+            boolean mask of the range (a row of DetectorProfile.roi_masks, made from peak_range if not given),
+            quality.check_spectrum verdict of the spectrum when fitting several of its ROIs (worked out here if not given)
+    Outputs: fit record (mu, sig, amp, status, attempts, error, quality)
+    """
+    if spectrum_verdict is None:
+        spectrum_verdict = quality.check_spectrum(data_header, data_counts, background_header, background_counts, limits)
+    roi_mask = quality.roi_mask(peak_range, len(data_counts)) if roi_mask is None else roi_mask
+    roi_verdict = quality.check_rois(data_header, data_counts, background_header, background_counts, roi_mask, limits)[0]
+    verdict = quality.combine(spectrum_verdict, roi_verdict)
+    if verdict["rejected"]:
+        profiling.count("rejected spectra")
+        return fit_scheduler.failed_record(ValueError("failed quality checks: " + ", ".join(verdict["rejected"])), status="rejected")
+
+    data_time, background_time = data_header["MEAS_TIME"], background_header["MEAS_TIME"]
+    if high_rate is not None:
+        data_counts, data_time = high_rate.correct(data_header, data_counts)
+        background_counts, background_time = high_rate.correct(background_header, background_counts)
+
+    if background_rate is not None and high_rate is None:
+        table = subtract_rate(data_counts, data_time, background_rate)
+    else:
+        table = subtract_counts(data_counts, data_time, background_counts, background_time)
+    record = fit_scheduler.schedule_fit(table, peak_range, budget, policy or fit_scheduler.DEFAULT_POLICY)
+    record["quality"] = ", ".join(verdict["flags"])
+
+    return record
+
+def cached_subtract_and_fit(data, background, peak_range, cache=None, budget=None, high_rate=None, policy=None):
+    """
+    Same as subtract_and_fit, but goes through the quality checks and the fit scheduler (see gated_fit) and looks
+    the fit up in the cache first (incremental mode). The key is the content hash of the data and background files,
+    the peak range and the fitting code, so only changed inputs get refit. Failed fits aren't cached.
+    Inputs: spectrum data, background spectrum data (or a Background from background_library.py), range to look for peak at, FitCache (or None to always fit), FitBudget,
+            HighRate settings (or None), fit scheduler policy (or None)
+    Outputs: fit record (mu, sig, amp, status, attempts, error), never raises for a bad spectrum
+    """
+    return cached_fit_rois(data, background, [peak_range], cache, budget, high_rate, policy)[0]
+
+def cached_fit_rois(data, background, peak_ranges, cache=None, budget=None, high_rate=None, policy=None):
+    """
+    Same as cached_subtract_and_fit for several ranges of one spectrum: the files are parsed and the whole spectrum
+    quality checks are run once (and only if some range isn't in the cache), then each range is fitted
+    Inputs: as cached_subtract_and_fit, with a list of ranges
+    Outputs: list of fit records, one per range
+    """
+    from_library = not isinstance(background, str)
+    parsed = []
+
+    def fit(peak_range):
+        if not parsed:
+            try:
+                data_header, data_spectrum = file_parser(data)
+                if from_library:
+                    background_header, background_counts = background.header, background.counts
+                else:
+                    background_header, background_spectrum = file_parser(background)
+                    background_counts = background_spectrum["counts"]
+            except Exception as error:
+                #a file that can't be read is recorded as a failed fit like any other
+                parsed.append(error)
+            else:
+                verdict = quality.check_spectrum(data_header, data_spectrum["counts"], background_header, background_counts)
+                parsed.append((data_header, data_spectrum["counts"], background_header, background_counts, verdict))
+        if isinstance(parsed[0], Exception):
+            return fit_scheduler.failed_record(parsed[0])
+
+        data_header, data_counts, background_header, background_counts, verdict = parsed[0]
+        return gated_fit(data_header, data_counts, background_header, background_counts,
+                         peak_range, budget, high_rate=high_rate, policy=policy,
+                         background_rate=background.rate if from_library else None, spectrum_verdict=verdict)
+
+    if cache is None:
+        return [fit(peak_range) for peak_range in peak_ranges]
+
+    data_key = fit_cache.file_fingerprint(data)
+    background_key = background.key if from_library else fit_cache.file_fingerprint(background)
+    code_key = fit_cache.code_fingerprint(sys.modules[__name__], fit_scheduler, quality, high_rate_module, kernels)
+    records = []
+    for peak_range in peak_ranges:
+        key = fit_cache.make_key(data_key, background_key, peak_range, vars(high_rate) if high_rate is not None else None,
+                                 list(policy) if policy else None, code_key)
+        record = cache.get("fit", key)
+        if record is None:
+            record = fit(peak_range)
+            if record["status"] != "failed":
+                cache.put("fit", key, record)
+        records.append(record)
+
+    return records
+
 def angle_checker(filename):
     """
     Function to check what angle is being measured using the file name
     Input: string file name
     Outputs: boolean key for if the measurements are angled or not, angle being measured
     """
-    AM = False
-    if '_0' in filename: 
-        angle = 0
-    elif '45' in filename: 
-        angle = 45
-        AM = True
-    elif '90' in filename: 
-        angle = 90
-        AM = True
-    elif '135' in filename: 
-        angle = 135
-        AM = True
-    elif '165' in filename:
-        angle = 165
-        AM = True
-    else: 
-        return AM, 0
+    detector, source, angle = catalog.parse_filename(filename)
 
-    return AM, angle
+    return angle != 0, angle
     
 
-def make_results_dict(filepath, background, detector):
+def append_fit(results, energy, record, angle, date=""):
+    """adds the record of one peak fit (from fit_scheduler.py) and the date of its spectrum to the results dictionary"""
+    results['energy'].append(energy)
+    results['peak loc'].append(record['mu'])
+    results['FWHM'].append(2.355 * np.abs(record['sig']))
+    results['amp'].append(record['amp'])
+    results['angle'].append(angle)
+    results['status'].append(record['status'])
+    results['attempts'].append(record['attempts'])
+    results['error'].append(record['error'])
+    results['quality'].append(record.get('quality', ''))
+    results['date'].append("" if pd.isna(date) else str(date))
+
+@profiling.timed("make_results_dict")
+def make_results_dict(filepath, background, detector, cache=None, catalog_path=None, budget=None, drift_tolerance=None,
+                      high_rate=None, policy=None, log=print, backgrounds=None):
     """
     Funtion to take in a path to all the spectrum readings we'll use from a given detector, parse them, fit to specific ranges for peaks 
     for a given source in the file name, and append fit results to a dictionary for use characterizing the detector
-    Inputs: path to files, path to background file, detector input as string
+    Inputs: path to files (or an hdf5 store from spectrum_store.py), path to background file, detector input as string, optional FitCache for incremental runs,
+            optional csv to keep the catalog of the folder in (see catalog.py), optional FitBudget for each fit,
+            optional ROI shift (channels) above which a spectrum's gain drift is corrected (see gain_drift.py),
+            optional HighRate settings for dead time and pile-up corrections (see high_rate.py),
+            optional escalation policy for the fit scheduler (e.g. fit_scheduler.COARSE_TO_FINE_POLICY),
+            function the messages go to (print by default),
+            optional BackgroundLibrary to pick each spectrum's background from by date instead of the background file
     Outputs: a pandas data frame and a boolean of whether the measuremends are angled or not
 
-    Note: I know this function is very long and could probably be split up with another function to assign everything, 
-    but because of time constraints this is what I have. 
+    Fits that fail even after the retries in fit_scheduler.py are kept as rows with status "failed" and NaN results,
+    so one bad spectrum doesn't stop the run.
+
+    The energies and peak ranges for each detector come from its profile in detector_profiles/ (see profiles.py), and
+    the files for each source are picked out of the folder's catalog with a query
     """
     #dictionary of results to fill
     results = {
@@ -315,171 +547,76 @@ def make_results_dict(filepath, background, detector):
         'peak loc' : [],
         'FWHM' : [],
         'amp' : [], 
-        'angle': []
+        'angle': [],
+        'status': [],
+        'attempts': [],
+        'error': [],
+        'quality': [],
+        'date': []
     }
 
     #key for if spectrum_reader is being used for angled measurements: 
     ANGLED_MEASUREMENTS = False
 
-    #gathering results, based on detector so that energies and peak ranges can be hardocded (config file confusing). 
-    if detector == "NaITi":
-        energies = { 
-            #'Co' : [1173.228, 1332.492],  Co NOT USED FOR THIS DETECTOR THE PEAKS SUCK
-            'Cs' : [661.657],
-            'Ba' : [80.9979, 356.0129],
-            'Am' : [59.5409]
-        }
-    
-        ranges = {
-            'Cs' : [range(225, 400)],
-            'Ba' : [range(22, 85), range(90,200)],
-            'Am' : [range(0,60)]
-        }
-
-        datafiles = glob(filepath + '*.Spe')
-
-        for file in datafiles:
-
-            ANGLED_MEASUREMENTS, angle = angle_checker(file)
-
-            #getting rest of data needed from file: 
-            if 'Cs' in file:
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Cs'][0])
-                results['energy'].append(energies['Cs'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-            elif 'Ba' in file:
-                mu0, sig0, amp0 = subtract_and_fit(file, background, ranges['Ba'][0])
-                results['energy'].append(energies['Ba'][0])
-                results['peak loc'].append(mu0)
-                results['FWHM'].append(2.355 * np.abs(sig0))
-                results['amp'].append(amp0)
-                results['angle'].append(angle)
-                
-                mu1, sig1, amp1 = subtract_and_fit(file, background, ranges['Ba'][1])
-                results['energy'].append(energies['Ba'][1])
-                results['peak loc'].append(mu1)
-                results['FWHM'].append(2.355 * np.abs(sig1))
-                results['amp'].append(amp1)
-                results['angle'].append(angle)
-            elif 'Am' in file: 
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Am'][0])
-                results['energy'].append(energies['Am'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-
-    elif detector == "BGO":
-        energies = { 
-            'Co' : [1173.228],
-            'Cs' : [661.657],
-            'Ba' : [80.9979, 356.0129],
-            'Am' : [59.5409]
-        }
-
-        ranges = {
-            'Co' : [range(470, 600)],
-            'Cs' : [range(210, 350)],
-            'Ba' : [range(20, 50), range(100,200)],
-            'Am' : [range(0,60)]
-        }
-
-        datafiles = glob(filepath + '*.Spe')
-        
-        for file in datafiles:
-            ANGLED_MEASUREMENTS, angle = angle_checker(file)
-
-            #getting rest of data needed from file: 
-            if 'Co' in file:
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Co'][0])
-                results['energy'].append(energies['Co'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-            elif 'Cs' in file:
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Cs'][0])
-                results['energy'].append(energies['Cs'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-            elif 'Ba' in file:
-                mu0, sig0, amp0 = subtract_and_fit(file, background, ranges['Ba'][0])
-                results['energy'].append(energies['Ba'][0])
-                results['peak loc'].append(mu0)
-                results['FWHM'].append(2.355 * np.abs(sig0))
-                results['amp'].append(amp0)
-                results['angle'].append(angle)
-                
-                mu1, sig1, amp1 = subtract_and_fit(file, background, ranges['Ba'][1])
-                results['energy'].append(energies['Ba'][1])
-                results['peak loc'].append(mu1)
-                results['FWHM'].append(2.355 * np.abs(sig1))
-                results['amp'].append(amp1)
-                results['angle'].append(angle)
-            elif 'Am' in file: 
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Am'][0])
-                results['energy'].append(energies['Am'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-        
-    elif detector == "CdTe":
-        energies = { 
-            'Cs' : [661.657],
-            'Ba' : [53.1622, 383.8485],
-            'Am' : [59.5409]
-        }
-
-
-        ranges = {
-            'Cs' : [range(200, 250)],
-            'Ba' : [range(0, 80), range(200, 300)], # range(230, 300)], #range(500,600)],
-            'Am' : [range(100, 200)]
-        }
-
-        datafiles = glob(filepath + '*.mca')
-        
-        for file in datafiles:
-            ANGLED_MEASUREMENTS, angle = angle_checker(file)
-
-            #getting rest of data needed from file: 
-            if 'Cs' in file:
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Cs'][0])
-                results['energy'].append(energies['Cs'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-            elif 'Ba' in file:
-                mu0, sig0, amp0 = subtract_and_fit(file, background, ranges['Ba'][0])
-                results['energy'].append(energies['Ba'][0])
-                results['peak loc'].append(mu0)
-                results['FWHM'].append(2.355 * np.abs(sig0))
-                results['amp'].append(amp0)
-                results['angle'].append(angle)
-                
-                mu1, sig1, amp1 = subtract_and_fit(file, background, ranges['Ba'][1])
-                results['energy'].append(energies['Ba'][1])
-                results['peak loc'].append(mu1)
-                results['FWHM'].append(2.355 * np.abs(sig1))
-                results['amp'].append(amp1)
-                results['angle'].append(angle)
-            elif 'Am' in file: 
-                mu, sig, amp = subtract_and_fit(file, background, ranges['Am'][0])
-                results['energy'].append(energies['Am'][0])
-                results['peak loc'].append(mu)
-                results['FWHM'].append(2.355 * np.abs(sig))
-                results['amp'].append(amp)
-                results['angle'].append(angle)
-
-    else: 
-        print("Spell the Name of the Detector Right PLease: NaITi, BGO, or CdTe.")
+    try:
+        profile = profiles.load_profile(detector)
+    except FileNotFoundError:
+        log(f"Spell the Name of the Detector Right PLease: {', '.join(profiles.available_profiles())}.")
+        return pd.DataFrame(results), ANGLED_MEASUREMENTS
+
+    if spectrum_store.is_store(filepath):
+        #spectra packed into an hdf5 store (see spectrum_store.py) are fitted a chunk at a time straight from the arrays
+        if backgrounds is None:
+            background_header, background_spectrum = file_parser(background)
+        for meta, counts in spectrum_store.iter_chunks(filepath, profile.name):
+            chosen = backgrounds.lookup(meta["date_meas"]) if backgrounds is not None else np.full(len(meta), -1)
+            for row, spectrum, choice in zip(meta.itertuples(), counts, chosen):
+                if row.source not in profile.sources:
+                    continue
+                profiling.count("files")
+                ANGLED_MEASUREMENTS = ANGLED_MEASUREMENTS or row.angle != 0
+                if backgrounds is not None:
+                    library_background = backgrounds.background(choice)
+                    background_header, background_spectrum = library_background.header, {"counts": library_background.counts}
+
+                header = {"MEAS_TIME": [row.meas_time], "LIVE_TIME": [row.live_time], "REAL_TIME": [row.real_time]}
+                verdict = quality.check_spectrum(header, spectrum, background_header, background_spectrum["counts"])
+                for roi in profile.source_rois[profile.sources.index(row.source)]:
+                    record = gated_fit(header, spectrum, background_header, background_spectrum["counts"], profile.roi_index[roi], budget,
+                                       high_rate=high_rate, policy=policy,
+                                       background_rate=library_background.rate if backgrounds is not None else None,
+                                       roi_mask=profile.roi_masks(len(spectrum))[roi], spectrum_verdict=verdict)
+                    append_fit(results, profile.energies[roi], record, row.angle, row.date_meas)
+
+        return pd.DataFrame(results), ANGLED_MEASUREMENTS
+
+    files = catalog.build_catalog(filepath, catalog_path, recursive=False)
+
+    for source, source_rois in zip(profile.sources, profile.source_rois):
+        rows = catalog.select(files, source=source, fmt=profile.format)
+        drifted = {}
+        if drift_tolerance is not None and len(rows) > 0:
+            #spectra that drifted past the tolerance get the ROIs moved onto their channels, untrusted estimates don't
+            drifts = gain_drift.track_drift(rows, profile, tolerance=drift_tolerance)
+            for path in drifts.loc[~drifts["trusted"], "path"]:
+                log(f"{path}: gain drift estimate not trusted, ROIs left as they are")
+            for drift in drifts[drifts["recalibrate"]].itertuples():
+                log(f"{drift.path}: gain drift {drift.gain:.4f}, offset {drift.offset:.2f} (ROIs moved {drift.max_shift:.1f} channels)")
+                drifted[drift.path] = gain_drift.shifted_rois(profile, drift.gain, drift.offset, drift.channels)
+
+        #background of each spectrum: the file given, or the library's pick for its date (one binary search for all of them)
+        chosen = backgrounds.lookup(rows["date_meas"]) if backgrounds is not None else np.full(len(rows), -1)
+
+        for (det, src, angle), file, date, choice in zip(rows.index, rows["path"], rows["date_meas"], chosen):
+            ANGLED_MEASUREMENTS = ANGLED_MEASUREMENTS or angle != 0
+            profiling.count("files")
+            roi_index = drifted.get(file, profile.roi_index)
+            file_background = backgrounds.background(choice) if backgrounds is not None else background
+
+            #fitting every line of the source, using the precompiled ROI index arrays (the file is read and checked once): 
+            records = cached_fit_rois(file, file_background, [roi_index[roi] for roi in source_rois], cache, budget, high_rate, policy)
+            for roi, record in zip(source_rois, records):
+                append_fit(results, profile.energies[roi], record, angle, date)
     
     return pd.DataFrame(results), ANGLED_MEASUREMENTS
 
@@ -489,18 +626,34 @@ def line(x, m, b):
 
 def linear_fit(x_data, y_data, model):
     """Function to fit a line to points using curve_fit"""
-    popt, pcov = curve_fit(model, x_data, y_data)
+    popt, pcov = profiling.curve_fit(model, x_data, y_data, stage = "calibration fit")
     return popt, pcov
 
-def fit_energies(dictionary, detector_name):
+def calibrate(dictionary):
     """
-    Function to fit energies to channel numbers using curvefit
+    Function to fit energies to channel numbers using curvefit, without any plotting
     Input: dictionary of results from make_results_dict
+    Output: popt and perr of the channel-energy line
+    """
+    #failed fits (NaN peak locations) are left out of the calibration
+    fitted = dictionary.dropna(subset=['peak loc'])
+    if len(fitted) < 2:
+        raise ValueError(f"only {len(fitted)} of {len(dictionary)} peaks were fitted, the calibration needs at least 2")
+    popt, pcov = linear_fit(fitted['peak loc'], fitted['energy'], line)
+    perr = np.sqrt(np.diag(pcov))
+
+    return popt, perr
+
+def fit_energies(dictionary, detector_name, calibration=None, plot=True):
+    """
+    Function to fit energies to channel numbers using curvefit
+    Input: dictionary of results from make_results_dict, optional (popt, perr) from a cached calibration
     Output: slope and intercept of channel-energy relation line
     """
     
-    popt, pcov = linear_fit(dictionary['peak loc'], dictionary['energy'], line)
-    perr = np.sqrt(np.diag(pcov))
+    if calibration is None:
+        calibration = calibrate(dictionary)
+    popt, perr = calibration
 
     #grabbing uncertainties: 
     dictionary['peak unc'] = [(dictionary["peak loc"][i] * perr[0]) + perr[1] for i in range(len(dictionary["peak loc"]))]
@@ -511,26 +664,65 @@ def fit_energies(dictionary, detector_name):
 
     fit_line = line(dictionary['peak loc'], popt[0], popt[1])
 
-    plt.close("all")
-    fig, ax = plt.subplots(figsize = (8, 8))
-    
-    ax.set_title(f"Calibrating {detector_name}: Peak Energy by Channel Number")
-    ax.set_xlabel("Channel Number")
-    ax.set_ylabel("Energy (keV)")
-    ax.errorbar(dictionary['peak loc'], dictionary['energy'], yerr= np.array(dictionary['peak unc']), fmt='o', ecolor='blue', capsize=5, label = "data")
-    ax.scatter(dictionary['peak loc'], dictionary['energy'], label = "data")
-    ax.plot(dictionary['peak loc'], fit_line, ls = "-", color = "red", label = "fit line")
-    ax.legend()
-    plt.show()
+    if plot:
+        plt.close("all")
+        fig, ax = plt.subplots(figsize = (8, 8))
+        
+        ax.set_title(f"Calibrating {detector_name}: Peak Energy by Channel Number")
+        ax.set_xlabel("Channel Number")
+        ax.set_ylabel("Energy (keV)")
+        ax.errorbar(dictionary['peak loc'], dictionary['energy'], yerr= np.array(dictionary['peak unc']), fmt='o', ecolor='blue', capsize=5, label = "data")
+        ax.scatter(dictionary['peak loc'], dictionary['energy'], label = "data")
+        ax.plot(dictionary['peak loc'], fit_line, ls = "-", color = "red", label = "fit line")
+        ax.legend()
+        with profiling.stage("plt.show"):
+            plt.show()
     
     #print(f"Slope: {popt[0]} and Intercept: {popt[1]}")
 
     return popt[0], popt[1], y_err
 
-def main(data_path, bg_path, detector):
+def main(data_path, bg_path, detector, cache_path=None, catalog_path=None, budget=None, drift_tolerance=None, high_rate=None,
+         global_mode=False, policy=None, workers=None, backgrounds=None):
     """Main function to run what the script does"""
-    dictionary, ANGLED_MEASUREMENTS = make_results_dict(data_path, bg_path, detector)
-    slope, intercept, error = fit_energies(dictionary, detector)
+    cache = fit_cache.FitCache(cache_path) if cache_path else None
+    if backgrounds is not None:
+        print(f"Backgrounds ({backgrounds.mode}):")
+        print(backgrounds.summary().to_string(index=False))
+    if global_mode:
+        #every peak in one optimizer run with shared calibration and resolution laws (see global_fit.py)
+        dictionary, ANGLED_MEASUREMENTS, global_result = global_fit.results_dict(data_path, bg_path, detector, catalog_path)
+        if global_result is not None:
+            print(global_fit.summary(global_result))
+    elif workers and workers > 1 and not spectrum_store.is_store(data_path):
+        #fits spread over worker processes that read the spectra from shared memory (see shared_pool.py)
+        dictionary, ANGLED_MEASUREMENTS = shared_pool.results_dict(data_path, bg_path, detector, workers, catalog_path, budget,
+                                                                   high_rate, policy)
+    else:
+        dictionary, ANGLED_MEASUREMENTS = make_results_dict(data_path, bg_path, detector, cache, catalog_path, budget, drift_tolerance,
+                                                            high_rate, policy, backgrounds=backgrounds)
+
+    failed = dictionary[dictionary['status'].isin(['failed', 'rejected'])]
+    if len(failed) > 0:
+        print(f"{len(failed)} of {len(dictionary)} fits failed or were rejected (kept in the csv with their status):")
+        for i, row in failed.iterrows():
+            print(f"    {row['energy']} keV, angle {row['angle']}: {row['error']}")
+
+    calibration = None
+    plot = True
+    if cache is not None:
+        #calibration node: only refit (and replot) when the fit results feeding it changed
+        key = fit_cache.make_key(detector, dictionary['energy'], dictionary['peak loc'], fit_cache.code_fingerprint(sys.modules[__name__]))
+        stored = cache.get("calibration", key)
+        if stored is None:
+            popt, perr = calibrate(dictionary)
+            cache.put("calibration", key, [popt, perr])
+        else:
+            popt, perr = np.array(stored[0]), np.array(stored[1])
+            plot = False
+        calibration = (popt, perr)
+
+    slope, intercept, error = fit_energies(dictionary, detector, calibration, plot)
 
     #adding FWHM in terms of energy to dictionary: 
     dictionary["FWHM (keV)"] = line(dictionary["FWHM"], slope, intercept)
@@ -548,7 +740,13 @@ def main(data_path, bg_path, detector):
     #csv_name = f"{detector} + results.csv"
 
     #writing results to csv: 
-    dictionary.to_csv(csv_name, index=False)  
+    if cache is None:
+        dictionary.to_csv(csv_name, index=False)  
+    else:
+        #only touching the csv if it changed keeps resolution.py/efficiencies.py caches valid
+        fit_cache.write_if_changed(dictionary, csv_name)
+        print(f"Incremental run: {cache.hits} cached, {cache.misses} recomputed")
+        cache.save()
     
 
 if __name__ == '__main__': 
@@ -557,6 +755,47 @@ if __name__ == '__main__':
     parser.add_argument('data_path', type = str, help = "path to the folder with data files", default = None)
     parser.add_argument('bg_path', type = str, help = "background spectrum file", default = None)
     parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--cache', type = str, help = "cache file for incremental runs (only changed inputs get refit)", default = None)
+    parser.add_argument('--catalog', type = str, help = "csv to keep the catalog of the data folder in between runs", default = None)
+    parser.add_argument('--maxfev', type = int, help = "max function evaluations per fit attempt (default 2000)", default = None)
+    parser.add_argument('--fit-seconds', type = float, help = "max wall clock seconds per fit attempt (default 5)", default = None)
+    parser.add_argument('--drift-tolerance', type = float, help = "track gain drift and move the ROIs of spectra that drifted more than this many channels", default = None)
+    parser.add_argument('--high-rate', action = "store_true", help = "normalise by live time and take off the pile-up continuum (for hot sources)")
+    parser.add_argument('--pileup-time', type = float, help = "pile-up resolving time (sec) for --high-rate", default = 1e-6)
+    parser.add_argument('--dead-time', type = float, help = "dead time per count (sec) for files without a live time, for --high-rate", default = None)
+    parser.add_argument('--coarse-to-fine', action = "store_true", help = "fit each peak on a rebinned window first, then only around the centroid at full resolution")
+    parser.add_argument('--workers', type = int, help = "fit with this many worker processes sharing the spectra in shared memory (not for an hdf5 store, no --cache, --drift-tolerance or --backgrounds)", default = None)
+    parser.add_argument('--global-fit', action = "store_true", help = "fit every peak at once with shared calibration and resolution laws (global_fit.py, none of the per peak fit options)")
+    parser.add_argument('--backgrounds', type = str, help = "background library (.npz from background_library.py, or a folder of background files) to use instead of bg_path (not with --workers or --global-fit)", default = None)
+    parser.add_argument('--background-mode', type = str, choices = background_library.MODES, help = "background nearest in time to each spectrum, or all of them pooled", default = "nearest")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
-    main(args.data_path, args.bg_path, args.detector)
+    #options a mode has no use for are refused instead of quietly dropped
+    if args.global_fit:
+        unused = [name for name, value in [("--cache", args.cache), ("--maxfev", args.maxfev), ("--fit-seconds", args.fit_seconds),
+                                           ("--drift-tolerance", args.drift_tolerance), ("--high-rate", args.high_rate),
+                                           ("--coarse-to-fine", args.coarse_to_fine), ("--workers", args.workers),
+                                           ("--backgrounds", args.backgrounds)] if value is not None and value is not False]
+        if unused:
+            parser.error(f"--global-fit fits every peak in one run and doesn't use {', '.join(unused)}")
+    elif args.workers and args.workers > 1:
+        if spectrum_store.is_store(args.data_path):
+            parser.error("--workers doesn't work with an hdf5 store, it's fitted a chunk at a time in one process")
+        unused = [name for name, value in [("--cache", args.cache), ("--drift-tolerance", args.drift_tolerance),
+                                           ("--backgrounds", args.backgrounds)] if value is not None]
+        if unused:
+            parser.error(f"--workers doesn't use {', '.join(unused)}")
+
+    budget = fit_scheduler.FitBudget()
+    budget.maxfev = budget.maxfev if args.maxfev is None else args.maxfev
+    budget.seconds = budget.seconds if args.fit_seconds is None else args.fit_seconds
+
+    if args.profile:
+        profiling.enable()
+    main(args.data_path, args.bg_path, args.detector, args.cache, args.catalog, budget,
+         args.drift_tolerance, high_rate_module.HighRate(args.pileup_time, args.dead_time) if args.high_rate else None,
+         args.global_fit, fit_scheduler.COARSE_TO_FINE_POLICY if args.coarse_to_fine else None, args.workers,
+         background_library.load_library(args.backgrounds, args.detector, mode=args.background_mode) if args.backgrounds else None)
+    if args.profile:
+        profiling.finish(args.profile, args.profile_format)
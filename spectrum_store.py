@@ -0,0 +1,163 @@
+"""
+spectrum_store.py
+
+Packs lots of parsed spectra into one chunked, compressed HDF5 file instead of one text file per acquisition.
+
+Layout of the file, one group per detector:
+    /<detector>/counts       (number of spectra, number of channels) counts, chunked and gzip compressed
+    /<detector>/path         original file each row came from
+    /<detector>/source       source name ("bg" for backgrounds)
+    /<detector>/angle        angle in degrees
+    /<detector>/date_meas    start of the measurement (iso format)
+    /<detector>/meas_time    time the parser normalises counts by (same as file_parser's MEAS_TIME)
+    /<detector>/live_time, /<detector>/real_time
+
+Rows can be appended to an existing store. Chunks span many spectra but only part of the channels, so reading
+a chunk of spectra or one channel window across every spectrum are both contiguous reads.
+
+Needs h5py (pip install h5py), everything else in the pipeline works without it.
+
+How to use:
+    python spectrum_store.py store.h5 path/to/tree            packs every spectrum under the folder into store.h5
+then pass store.h5 as the data path to spectrum_reader.py
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+import catalog
+
+META_COLUMNS = ["path", "source", "angle", "date_meas", "meas_time", "live_time", "real_time"]
+STRING_COLUMNS = ("path", "source", "date_meas")
+#spectra x channels per chunk
+CHUNK_SHAPE = (256, 128)
+
+
+def _require_h5py():
+    """raises a helpful error if h5py isn't installed"""
+    if h5py is None:
+        raise ImportError("the hdf5 spectrum store needs h5py: pip install h5py")
+
+
+def is_store(path):
+    """checks if a path is an hdf5 spectrum store (by its name)"""
+    return path.endswith((".h5", ".hdf5"))
+
+
+def _create_group(store, detector, n_channels):
+    """makes the (resizable) datasets for a detector"""
+    group = store.create_group(detector)
+    group.create_dataset("counts", shape=(0, n_channels), maxshape=(None, n_channels), dtype="f8",
+                         chunks=(CHUNK_SHAPE[0], min(CHUNK_SHAPE[1], n_channels)), compression="gzip", shuffle=True)
+    for column in META_COLUMNS:
+        dtype = h5py.string_dtype() if column in STRING_COLUMNS else ("i4" if column == "angle" else "f8")
+        group.create_dataset(column, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(CHUNK_SHAPE[0],))
+    return group
+
+
+def append_spectra(store_path, detector, meta, counts):
+    """
+    Function to append spectra of one detector to a store (makes the store/group if needed)
+    Inputs: path to the store, detector name, dataframe with META_COLUMNS, 2d array of counts (spectra x channels)
+    """
+    _require_h5py()
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+
+    with h5py.File(store_path, "a") as store:
+        group = store[detector] if detector in store else _create_group(store, detector, counts.shape[1])
+        if group["counts"].shape[1] != counts.shape[1]:
+            raise ValueError(f"{detector} store has {group['counts'].shape[1]} channels, got spectra with {counts.shape[1]}")
+
+        start = group["counts"].shape[0]
+        stop = start + counts.shape[0]
+        group["counts"].resize(stop, axis=0)
+        group["counts"][start:stop] = counts
+        for column in META_COLUMNS:
+            group[column].resize(stop, axis=0)
+            values = meta[column].to_numpy()
+            group[column][start:stop] = values.astype(object) if column in STRING_COLUMNS else values
+
+
+def export_hdf5(root, store_path, workers=4, batch_size=256):
+    """
+    Function to pack every spectrum under a folder (or archive) into a store, one group per detector
+    Inputs: folder to pack, path of the store, threads used to parse, spectra parsed per batch
+    Output: number of spectra written
+    """
+    #imported here since spectrum_reader reads stores too
+    import spectrum_reader
+
+    table = catalog.build_catalog(root).reset_index()
+    written = 0
+    for detector, rows in table.groupby("detector", sort=True):
+        for start in range(0, len(rows), batch_size):
+            batch = rows.iloc[start:start + batch_size]
+            parsed = spectrum_reader.parse_many(list(batch["path"]), workers)
+
+            meta = batch[["path", "source", "angle", "live_time", "real_time"]].copy()
+            meta["date_meas"] = batch["date_meas"].dt.strftime("%Y-%m-%dT%H:%M:%S").fillna("")
+            meta["meas_time"] = [parsed[path][0]["MEAS_TIME"][0] for path in batch["path"]]
+            counts = np.vstack([parsed[path][1]["counts"] for path in batch["path"]])
+
+            append_spectra(store_path, detector or "unknown", meta, counts)
+            written += len(batch)
+
+    return written
+
+
+def read_meta(store_path, detector):
+    """
+    Function to read the per spectrum information (not the counts) of one detector
+    Output: dataframe with META_COLUMNS, one row per spectrum
+    """
+    _require_h5py()
+    with h5py.File(store_path, "r") as store:
+        group = store[detector]
+        meta = {}
+        for column in META_COLUMNS:
+            meta[column] = group[column].asstr()[:] if column in STRING_COLUMNS else group[column][:]
+    return pd.DataFrame(meta, columns=META_COLUMNS)
+
+
+def iter_chunks(store_path, detector, chunk_size=CHUNK_SHAPE[0]):
+    """
+    Function to go through the spectra of a detector a chunk at a time
+    Inputs: path to the store, detector name, spectra per chunk
+    Yields: dataframe of the chunk's META_COLUMNS, 2d array of the chunk's counts
+    """
+    meta = read_meta(store_path, detector)
+    with h5py.File(store_path, "r") as store:
+        counts = store[detector]["counts"]
+        for start in range(0, counts.shape[0], chunk_size):
+            stop = min(start + chunk_size, counts.shape[0])
+            yield meta.iloc[start:stop].reset_index(drop=True), counts[start:stop]
+
+
+def read_window(store_path, detector, first_channel, last_channel, rows=None):
+    """
+    Function to read one channel window across every spectrum (or the given rows) of a detector
+    Inputs: path to the store, detector name, first channel, last channel + 1, optional row indices
+    Output: 2d array (spectra x channels in the window)
+    """
+    _require_h5py()
+    with h5py.File(store_path, "r") as store:
+        counts = store[detector]["counts"]
+        if rows is None:
+            return counts[:, first_channel:last_channel]
+        return counts[np.sort(np.asarray(rows)), first_channel:last_channel]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will pack all the spectra in a folder into one hdf5 file''')
+    parser.add_argument('store', type = str, help = "hdf5 file to write (appends if it exists)", default = None)
+    parser.add_argument('root', type = str, help = "folder (or archive) of spectra to pack", default = None)
+    parser.add_argument('--workers', type = int, help = "threads used to parse the spectra", default = 4)
+    args = parser.parse_args()
+
+    print(f"Wrote {export_hdf5(args.root, args.store, args.workers)} spectra to {args.store}")
@@ -0,0 +1,135 @@
+"""
+spectrum_sum.py
+
+Adds up repeated short runs of the same source (e.g. several Am or Cs acquisitions) into one spectrum to fit.
+
+The sum is streamed: spectra are added one at a time into a single running array, so stacking hundreds of runs
+only ever holds one spectrum (plus the sum) in memory. Before a spectrum is added it is lined up with the first one
+(the reference) using the gain/offset drift from gain_drift.py and rebinned onto the reference's channels keeping its
+counts. A spectrum whose drift estimate can't be trusted (see gain_drift.py) is added as it is. The live, real and measurement times are added up too, so the summed spectrum is normalised to counts/sec the
+same way a single file is.
+
+How to use:
+    python spectrum_sum.py BGO_detector/Am_angled BGO_detector/unangled/bgBGO.Spe BGO --source Am
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import catalog
+import gain_drift
+import profiles
+import quality
+import spectrum_reader
+
+
+class SpectrumSum:
+    """
+    Running sum of spectra
+        counts: summed counts per channel (on the reference's channels)
+        meas_time, live_time, real_time: summed times (sec)
+        drifts: (gain, offset) each spectrum was aligned with ((1, 0) for the reference and untrusted estimates)
+    """
+
+    def __init__(self, align=True):
+        self.align = align
+        self.counts = None
+        self.meas_time = 0.0
+        self.live_time = 0.0
+        self.real_time = 0.0
+        self.date_meas = ""
+        self.drifts = []
+        self._reference = None
+
+    def __len__(self):
+        return len(self.drifts)
+
+    def add(self, header, counts):
+        """
+        Function to add one spectrum to the sum
+        Inputs: header dictionary and counts of the spectrum (as from spectrum_reader.file_parser)
+        """
+        counts = np.asarray(counts, dtype=float)
+        if self.counts is None:
+            self.counts = np.zeros(len(counts))
+            self.date_meas = header["DATE_MEAS"][0] if header.get("DATE_MEAS") else ""
+            self._reference = gain_drift.peak_signal(counts)
+        elif len(counts) != len(self.counts):
+            raise ValueError(f"spectrum has {len(counts)} channels, the sum has {len(self.counts)}")
+
+        gain, offset = 1.0, 0.0
+        if self.align and self.drifts:
+            gain, offset, _, trusted = gain_drift.estimate_drift(self._reference, gain_drift.peak_signal(counts))
+            if trusted:
+                counts = gain_drift.align_counts(counts, gain, offset)
+
+        self.counts += counts
+        self.drifts.append((gain, offset))
+        meas_time = header["MEAS_TIME"][0]
+        self.meas_time += meas_time
+        self.live_time += header["LIVE_TIME"][0] if header.get("LIVE_TIME") else meas_time
+        self.real_time += header["REAL_TIME"][0] if header.get("REAL_TIME") else meas_time
+
+    def add_file(self, path):
+        """adds a spectrum file (anything file_parser reads) to the sum"""
+        header, spectrum = spectrum_reader.file_parser(path)
+        self.add(header, spectrum["counts"])
+
+    def header(self):
+        """header dictionary of the summed spectrum, in the same form as file_parser's"""
+        return {"DATE_MEAS": [self.date_meas], "MEAS_TIME": [self.meas_time], "LIVE_TIME": [self.live_time],
+                "REAL_TIME": [self.real_time]}
+
+    def spectrum(self):
+        """spectrum dictionary (bins, counts) of the summed spectrum, in the same form as file_parser's"""
+        return {"bins": np.arange(len(self.counts)), "counts": self.counts}
+
+
+def sum_spectra(paths, align=True):
+    """
+    Function to stream a list of spectrum files into a SpectrumSum
+    Inputs: spectrum paths (any iterable, e.g. a generator over a big folder), whether to line up the gains
+    Output: SpectrumSum
+    """
+    total = SpectrumSum(align)
+    for path in paths:
+        total.add_file(path)
+    return total
+
+
+def sum_and_fit(paths, background, peak_ranges, budget=None, align=True):
+    """
+    Function to sum spectra and fit peaks in the sum (through the quality checks and fit scheduler, see gated_fit)
+    Inputs: spectrum paths, background file, list of channel windows, FitBudget, whether to line up the gains
+    Output: SpectrumSum, list of fit records (one per window)
+    """
+    total = sum_spectra(paths, align)
+    background_header, background_spectrum = spectrum_reader.file_parser(background)
+    verdict = quality.check_spectrum(total.header(), total.counts, background_header, background_spectrum["counts"])
+    records = [spectrum_reader.gated_fit(total.header(), total.counts, background_header, background_spectrum["counts"],
+                                         peak_range, budget, spectrum_verdict=verdict)
+               for peak_range in peak_ranges]
+    return total, records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will sum the spectra of a source and fit its peaks in the sum''')
+    parser.add_argument('data_path', type = str, help = "path to the folder with data files", default = None)
+    parser.add_argument('bg_path', type = str, help = "background spectrum file", default = None)
+    parser.add_argument('detector', type = str, help = "name of detector used", default = None)
+    parser.add_argument('--source', type = str, help = "source whose spectra get summed", default = None)
+    parser.add_argument('--no-align', action = "store_true", help = "add the spectra as they are, without lining up their gains")
+    args = parser.parse_args()
+
+    detector_profile = profiles.load_profile(args.detector)
+    source_files = catalog.select(catalog.build_catalog(args.data_path, recursive=False), source=args.source,
+                                  fmt=detector_profile.format)["path"]
+    rois = detector_profile.source_rois[detector_profile.sources.index(args.source)]
+
+    summed, fits = sum_and_fit(source_files, args.bg_path, [detector_profile.roi_index[roi] for roi in rois],
+                               align=not args.no_align)
+    print(f"Summed {len(summed)} spectra: {summed.live_time:.1f} s live, {summed.real_time:.1f} s real")
+    print(pd.DataFrame({"energy": detector_profile.energies[list(rois)], "peak loc": [fit["mu"] for fit in fits],
+                        "FWHM": [2.355 * abs(fit["sig"]) for fit in fits], "amp": [fit["amp"] for fit in fits],
+                        "status": [fit["status"] for fit in fits]}).to_string(index=False))
@@ -0,0 +1,354 @@
+"""
+work_queue.py
+
+Batch mode for reprocessing a whole campaign (many detectors and folders) with any number of worker processes, on one
+machine or on several that see the same filesystem.
+
+The campaign is planned into tasks the same way make_results_dict plans a detector (one task per spectrum file and
+ROI, in the same order), and the tasks are grouped into work units:
+    roi: one task per unit
+    file: every ROI of one spectrum file
+    session: every spectrum of a detector measured on the same day
+The units go into a queue kept in one SQLite file. Workers claim units with a lease (a claim that runs out after
+lease_seconds, renewed while the worker is still fitting the unit), fit them with cached_subtract_and_fit and write the
+results back in the same transaction that marks the unit done. So:
+    - a worker that crashes or is killed just lets its leases run out, and the units go back to the other workers
+      (a unit whose lease ran out max_attempts times is marked failed, its rows come out as failed fits)
+    - results are written once per unit: a late worker finishing a unit that's already done changes nothing
+    - planning is idempotent too, fits that are already in the queue aren't added again, so init can be run again
+      to pick up new files of a job
+The fit settings (budget, coarse to fine, high rate) are stored in the queue, so every worker fits the same way.
+
+For several machines put the queue file on the shared filesystem (it uses SQLite's normal rollback journal, which
+works over NFS as long as file locking does). run_local starts the workers as local processes running the same
+loop, for one machine or for testing.
+
+How to use:
+    python work_queue.py campaign.db init --job BGO_detector/unangled/ BGO_detector/unangled/bgBGO.Spe BGO --job NaITi_detector/unangled/ NaITi_detector/unangled/Bg_NaITi.Spe NaITi --unit file
+    python work_queue.py campaign.db work --workers 4          (on every node)
+    python work_queue.py campaign.db status
+    python work_queue.py campaign.db collect                   (writes <detector>results_<job>.csv for every job)
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import catalog
+import fit_scheduler
+import high_rate as high_rate_module
+import profiles
+import spectrum_reader
+
+UNIT_KINDS = ("roi", "file", "session")
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    detector TEXT NOT NULL,
+    job TEXT NOT NULL,
+    unit_key TEXT NOT NULL,
+    background TEXT NOT NULL,
+    tasks TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_expires);
+CREATE INDEX IF NOT EXISTS units_job ON units (detector, job);
+"""
+
+
+def connect(queue_path):
+    """opens the queue (making its tables if it's new), in autocommit mode so transactions are only the explicit ones"""
+    connection = sqlite3.connect(queue_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def plan_tasks(data_path, detector, catalog_path=None):
+    """
+    Function to list the fits of one detector, in the order make_results_dict does them
+    Inputs: folder of spectra, detector name, optional catalog csv
+    Output: list of task dictionaries (path, roi, energy, angle, date)
+    """
+    profile = profiles.load_profile(detector)
+    files = catalog.build_catalog(data_path, catalog_path, recursive=False)
+    tasks = []
+    for source, source_rois in zip(profile.sources, profile.source_rois):
+        rows = catalog.select(files, source=source, fmt=profile.format)
+        for (det, src, angle), path, date in zip(rows.index, rows["path"], rows["date_meas"]):
+            date = "" if pd.isna(date) else str(date)
+            for roi in source_rois:
+                tasks.append({"path": path, "roi": int(roi), "energy": float(profile.energies[roi]), "angle": int(angle),
+                              "date": date})
+    return tasks
+
+
+def unit_key(task, kind):
+    """what the tasks of one unit have in common"""
+    if kind == "roi":
+        return f"{task['path']}#{task['roi']}"
+    if kind == "file":
+        return task["path"]
+    return task["date"][:10] or "undated"
+
+
+def init(queue_path, jobs, kind="file", catalog_path=None, budget=None, coarse_to_fine=False, high_rate=None):
+    """
+    Function to plan jobs into work units and add them to the queue (fits already in it are left alone)
+    Inputs: queue file, list of (data_path, bg_path, detector), unit kind, optional catalog csv, FitBudget, whether to fit
+            coarse to fine, HighRate settings (the fit settings are only stored the first time)
+    Output: number of new units
+    """
+    if kind not in UNIT_KINDS:
+        raise ValueError(f"unit kind has to be one of {', '.join(UNIT_KINDS)}, not {kind!r}")
+    budget = budget or fit_scheduler.FitBudget()
+    settings = {"maxfev": budget.maxfev, "fit_seconds": budget.seconds, "coarse_to_fine": coarse_to_fine,
+                "high_rate": vars(high_rate) if high_rate is not None else None}
+
+    connection = connect(queue_path)
+    added = 0
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany("INSERT OR IGNORE INTO settings VALUES (?, ?)", [(key, json.dumps(value)) for key, value in settings.items()])
+        for data_path, bg_path, detector in jobs:
+            queued = {(task["path"], task["roi"]) for (tasks,) in connection.execute(
+                "SELECT tasks FROM units WHERE detector = ? AND job = ?", (detector, data_path)) for task in json.loads(tasks)}
+            units = {}
+            for order, task in enumerate(plan_tasks(data_path, detector, catalog_path)):
+                if (task["path"], task["roi"]) in queued:
+                    continue
+                #order within the job, so collect can put every row back where make_results_dict would have it
+                units.setdefault(unit_key(task, kind), []).append(dict(task, order=order))
+            connection.executemany("INSERT INTO units (detector, job, unit_key, background, tasks) VALUES (?, ?, ?, ?, ?)",
+                                   [(detector, data_path, key, bg_path, json.dumps(tasks)) for key, tasks in units.items()])
+            added += len(units)
+    connection.close()
+    return added
+
+
+def read_settings(connection):
+    """FitBudget, fit scheduler policy and HighRate settings stored in the queue"""
+    settings = {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM settings")}
+    budget = fit_scheduler.FitBudget(settings.get("maxfev", 2000), settings.get("fit_seconds", 5.0))
+    policy = fit_scheduler.COARSE_TO_FINE_POLICY if settings.get("coarse_to_fine") else None
+    high_rate = high_rate_module.HighRate(**settings["high_rate"]) if settings.get("high_rate") else None
+    return budget, policy, high_rate
+
+
+def claim(connection, owner, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """
+    Function to lease the next unit that's pending (or whose lease ran out)
+    Inputs: queue connection, name of the worker, lease length (sec), leases a unit can run out of before it's failed
+    Output: (id, detector, background, tasks) of the claimed unit, None if there's nothing to claim
+    """
+    now = time.time()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("UPDATE units SET state = 'failed', owner = NULL, error = 'lease ran out ' || attempts || ' times' "
+                           "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, max_attempts))
+        row = connection.execute("SELECT id, detector, background, tasks FROM units WHERE state = 'pending' "
+                                 "OR (state = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE units SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                           (owner, now + lease_seconds, row[0]))
+    return row[0], row[1], row[2], json.loads(row[3])
+
+
+def renew(connection, unit_id, owner, lease_seconds=LEASE_SECONDS):
+    """
+    Function to extend a worker's lease on a unit it's still fitting
+    Inputs: queue connection, unit id, name of the worker, lease length (sec) from now
+    Output: whether the worker still holds the lease (False if it ran out and another worker took the unit over)
+    """
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        cursor = connection.execute("UPDATE units SET lease_expires = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                                    (time.time() + lease_seconds, unit_id, owner))
+    return cursor.rowcount == 1
+
+
+def complete(connection, unit_id, rows):
+    """
+    Function to write a unit's results and mark it done, once: if another worker already finished it nothing changes
+    Output: whether this call wrote the results
+    """
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        cursor = connection.execute("UPDATE units SET state = 'done', owner = NULL, result = ?, error = NULL "
+                                    "WHERE id = ? AND state != 'done'", (json.dumps(rows, default=float), unit_id))
+    return cursor.rowcount == 1
+
+
+def process(tasks, background, detector, budget=None, policy=None, high_rate=None, keep_lease=None):
+    """
+    Function to do the fits of one unit
+    Inputs: tasks of the unit, background file, detector name, FitBudget, fit scheduler policy, HighRate settings,
+            optional function called between tasks that renews the unit's lease and says if it's still held
+    Output: list of rows (order, energy, angle, date and the fit record), None if the lease was lost part way
+    """
+    profile = profiles.load_profile(detector)
+    rows = []
+    for task in tasks:
+        if rows and keep_lease is not None and not keep_lease():
+            return None
+        record = spectrum_reader.cached_subtract_and_fit(task["path"], background, profile.roi_index[task["roi"]], None,
+                                                         budget, high_rate, policy)
+        rows.append({"order": task["order"], "energy": task["energy"], "angle": task["angle"], "date": task["date"],
+                     "record": record})
+    return rows
+
+
+def _lease_keeper(connection, unit_id, owner, lease_seconds):
+    """function for process that renews the lease once half of it has gone (not on every task, each renewal is a write)"""
+    expires = [time.time() + lease_seconds]
+
+    def keep_lease():
+        if time.time() < expires[0] - lease_seconds / 2:
+            return True
+        expires[0] = time.time() + lease_seconds
+        return renew(connection, unit_id, owner, lease_seconds)
+
+    return keep_lease
+
+
+def work(queue_path, owner=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, wait=False, poll_seconds=5.0):
+    """
+    Function to run one worker: claim a unit, fit it, write the results, until there's nothing left to claim
+    Inputs: queue file, name of the worker (default host:pid), lease length (sec), leases a unit can run out of,
+            whether to keep waiting while other workers still hold leases (to pick up their units if they die),
+            seconds between looks at the queue while waiting
+    Output: number of units this worker finished
+    """
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    connection = connect(queue_path)
+    budget, policy, high_rate = read_settings(connection)
+    finished = 0
+    while True:
+        unit = claim(connection, owner, lease_seconds, max_attempts)
+        if unit is None:
+            leased = connection.execute("SELECT COUNT(*) FROM units WHERE state = 'leased'").fetchone()[0]
+            if wait and leased:
+                time.sleep(poll_seconds)
+                continue
+            break
+        unit_id, detector, background, tasks = unit
+        rows = process(tasks, background, detector, budget, policy, high_rate,
+                       _lease_keeper(connection, unit_id, owner, lease_seconds))
+        #a unit whose lease was lost belongs to another worker now, which writes its results
+        if rows is not None:
+            finished += complete(connection, unit_id, rows)
+    connection.close()
+    return finished
+
+
+def run_local(queue_path, workers=os.cpu_count(), **options):
+    """
+    Function to work through the queue with local worker processes (the same loop every node runs)
+    Inputs: queue file, number of processes, options for work
+    Output: number of units each worker finished
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(work, queue_path, f"{socket.gethostname()}:local{i}", **options) for i in range(workers)]
+        return [future.result() for future in futures]
+
+
+def status(queue_path):
+    """table of the number of units in each state for every job"""
+    connection = connect(queue_path)
+    table = pd.read_sql_query("SELECT detector, job, state, COUNT(*) AS units, SUM(attempts) AS attempts FROM units "
+                              "GROUP BY detector, job, state", connection)
+    connection.close()
+    return table
+
+
+def collect(queue_path, detector, job):
+    """
+    Function to put the results of one job back together
+    Inputs: queue file, detector name, folder of spectra of the job
+    Output: results dataframe (same rows and order as make_results_dict), whether the measurements are angled,
+            number of units not done yet
+    """
+    results = {'energy': [], 'peak loc': [], 'FWHM': [], 'amp': [], 'angle': [], 'status': [], 'attempts': [],
+               'error': [], 'quality': [], 'date': []}
+    connection = connect(queue_path)
+    units = connection.execute("SELECT state, tasks, result, error FROM units WHERE detector = ? AND job = ?", (detector, job)).fetchall()
+    connection.close()
+
+    rows, missing = [], 0
+    for state, tasks, result, error in units:
+        if state == "done":
+            rows += json.loads(result)
+        elif state == "failed":
+            #units no worker could get through still give a row for every fit, as failed fits
+            rows += [dict(task, record=fit_scheduler.failed_record(RuntimeError(error))) for task in json.loads(tasks)]
+        else:
+            missing += 1
+
+    for row in sorted(rows, key=lambda row: row["order"]):
+        spectrum_reader.append_fit(results, row["energy"], row["record"], row["angle"], row["date"])
+    return pd.DataFrame(results), any(row["angle"] != 0 for row in rows), missing
+
+
+def write_results(queue_path, detector, job):
+    """
+    Function to write the collected results of a job with the energy calibration, like spectrum_reader.py does
+    Inputs: queue file, detector name, folder of spectra of the job
+    Output: name of the csv written (None if there's nothing to write), spectrum_reader.py's name with the job's folder
+            added so jobs of the same detector don't overwrite each other (e.g. BGOresults_BGO_detector_unangled.csv)
+    """
+    table, angled, missing = collect(queue_path, detector, job)
+    if missing:
+        print(f"{detector} {job}: {missing} units aren't done yet, their rows are left out")
+    if table["peak loc"].notna().sum() < 2:
+        return None
+    slope, intercept, error = spectrum_reader.fit_energies(table, detector, plot=False)
+    table["FWHM (keV)"] = spectrum_reader.line(table["FWHM"], slope, intercept)
+    job_name = re.sub(r"[^A-Za-z0-9.-]+", "_", os.path.normpath(job)).strip("_")
+    csv_name = detector + ("results_angled" if angled else "results") + f"_{job_name}.csv"
+    table.to_csv(csv_name, index=False)
+    return csv_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''This script will spread the fits of a campaign over worker processes and nodes through a queue file''')
+    parser.add_argument('queue', type = str, help = "queue file (SQLite), on a shared filesystem for several nodes", default = None)
+    parser.add_argument('command', type = str, choices = ["init", "work", "status", "collect"], help = "what to do with the queue", default = None)
+    parser.add_argument('--job', type = str, nargs = 3, action = "append", metavar = ("DATA_PATH", "BG_PATH", "DETECTOR"), help = "folder of spectra, background file and detector to add (init, can be given many times)", default = [])
+    parser.add_argument('--unit', type = str, choices = UNIT_KINDS, help = "what one work unit is (init)", default = "file")
+    parser.add_argument('--catalog', type = str, help = "csv to keep the catalog of the data folders in between runs (init)", default = None)
+    parser.add_argument('--maxfev', type = int, help = "max function evaluations per fit attempt (init)", default = 2000)
+    parser.add_argument('--fit-seconds', type = float, help = "max wall clock seconds per fit attempt (init)", default = 5.0)
+    parser.add_argument('--coarse-to-fine', action = "store_true", help = "fit each peak coarse to fine (init)")
+    parser.add_argument('--high-rate', action = "store_true", help = "dead time and pile-up corrections (init)")
+    parser.add_argument('--workers', type = int, help = "worker processes to start on this node (work)", default = os.cpu_count())
+    parser.add_argument('--lease', type = float, help = "seconds a worker holds a unit before others can take it over (work)", default = LEASE_SECONDS)
+    parser.add_argument('--wait', action = "store_true", help = "keep going until every unit is done, picking up units of workers that died (work)")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        added = init(args.queue, args.job, args.unit, args.catalog, fit_scheduler.FitBudget(args.maxfev, args.fit_seconds),
+                     args.coarse_to_fine, high_rate_module.HighRate() if args.high_rate else None)
+        print(f"{added} new units")
+    elif args.command == "work":
+        finished = run_local(args.queue, args.workers, lease_seconds=args.lease, wait=args.wait)
+        print(f"{sum(finished)} units finished by {len(finished)} workers")
+    elif args.command == "collect":
+        for name, job in status(args.queue)[["detector", "job"]].drop_duplicates().itertuples(index=False):
+            print(f"{name} {job}: {write_results(args.queue, name, job)}")
+    print(status(args.queue).to_string(index=False))